@@ -1,9 +1,8 @@
 import os
 import typing
 from uuid import uuid4
-import h5py
-from PyQt5.QtWidgets import QApplication, QFileDialog
-from PyQt5.QtCore import QObject, QSettings, QUrl
+from PyQt5.QtWidgets import QApplication, QFileDialog, QMessageBox
+from PyQt5.QtCore import QEventLoop, QObject, QRunnable, QSettings, QThreadPool, QUrl, pyqtSignal
 from PyQt5.QtGui import QDesktopServices
 from ui.active import ActiveWidget
 from ui.mainwindow import MainWindow
@@ -36,6 +35,10 @@ def create_new(parent: QObject) -> None:
     """Sets up the NewDialog and creates a new change tracker file
     using user inputs"""
     mw = findMainWindow()
+    # the TempFile can't be replaced while it's being saved
+    if mw.saving:
+        QApplication.beep()
+        return
     mw.close()
     new_dialog = NewTracker(parent)
     if not new_dialog.exec():
@@ -43,7 +46,9 @@ def create_new(parent: QObject) -> None:
     TempFile.create_new()  # init the temp file for future editing
     # write attributes to the new file and init groups
     TempFile.manager.lockForWrite()
-    with h5py.File(TempFile.path, 'r+') as store:
+    TempFile.manager.mark('positions')
+    TempFile.manager.mark('comparisons')
+    with TempFile.store() as store:
         store.attrs['name'] = new_dialog.name
         store.attrs['description'] = new_dialog.desc
         store.attrs['creator'] = os.getlogin()
@@ -63,8 +68,22 @@ def open_file(parent: QObject) -> None:
     """Creates an open file dialog window for user to select an existing
     .opticord file to open"""
     mw = findMainWindow()
+    # the TempFile can't be replaced while it's being saved
+    if mw.saving:
+        QApplication.beep()
+        return
     filepath, _ = QFileDialog.getOpenFileName(parent, 'Open existing...',
                                               QSettings().value('last_open_location', ''), '*.opticord')
+    # an interrupted save is rolled back, a file is only refused if that
+    # fails, before the open file is closed
+    if filepath and TempFile.incomplete(filepath):
+        QMessageBox.critical(parent, 'Open failed',
+                             f'{os.path.basename(filepath)} was not '
+                             'completely saved and may be corrupt. If '
+                             'OptiCORD closed while saving it, recover '
+                             'the changes when OptiCORD next starts and '
+                             'save them over it.')
+        return
     mw.close()
     if not filepath:
         print("no filepath")
@@ -77,7 +96,7 @@ def open_file(parent: QObject) -> None:
     TempFile.create_from_existing(filepath)
     # read the h5 file
     TempFile.manager.lockForRead()
-    with h5py.File(TempFile.path, 'r+') as store:
+    with TempFile.store() as store:
         name = store.attrs['name']
         [log.debug(f'{i}: {j}') for (i, j) in store.attrs.items()]
     TempFile.manager.unlock()
@@ -95,8 +114,7 @@ def save(parent: QObject) -> bool:
     if TempFile.saved_path == '':
         return save_as(parent)
     # otherwise overwrite the file where it was opened
-    TempFile.save_to_location(TempFile.saved_path)
-    return True
+    return save_in_background(TempFile.saved_path)
 
 
 def save_as(parent: QObject) -> bool:
@@ -113,17 +131,76 @@ def save_as(parent: QObject) -> bool:
     if not save_dialog.exec():
         return False
     path = save_dialog.selectedFiles()[0]
-    TempFile.save_to_location(path)
-    return True
+    return save_in_background(path)
+
+
+def save_in_background(filepath: str) -> bool:
+    """Saves the temp file to filepath with a SaveWorker, showing its
+    progress in the main window. Events are processed until the save
+    finishes so the window stays responsive. Returns True if the save
+    was successful, False if it failed or another save is running."""
+    mw = findMainWindow()
+    if mw.saving:
+        QApplication.beep()
+        return False
+    worker = SaveWorker(filepath)
+    loop = QEventLoop()
+    worker.signals.progress.connect(mw.save_progress)
+    worker.signals.finished.connect(mw.save_finished)
+    worker.signals.finished.connect(lambda ok: loop.exit(int(ok)))
+    mw.save_started()
+    worker.start()
+    return bool(loop.exec())
+
+
+class SaveSignals(QObject):
+    """Signals for the SaveWorker"""
+    progress = pyqtSignal(int, int)  # bytes written, bytes to write
+    finished = pyqtSignal(bool)  # True if the save was successful
+
+
+class SaveWorker(QRunnable):
+    """A QRunnable object to save the temp file off the GUI thread. Saves
+    have a pool of their own so they never queue behind the workers of
+    the global pool, such as exports waiting on the memory budget."""
+    pool: QThreadPool = None  # created by the first save
+
+    def __init__(self, filepath: str) -> None:
+        super(QRunnable, self).__init__()
+        self.filepath = filepath
+        self.signals = SaveSignals()
+
+    def start(self) -> None:
+        """Runs the save in the save pool"""
+        if SaveWorker.pool is None:
+            SaveWorker.pool = QThreadPool()
+            SaveWorker.pool.setMaxThreadCount(1)
+        SaveWorker.pool.start(self)
+
+    def run(self) -> None:
+        """"""
+        success = False
+        try:
+            TempFile.save_to_location(self.filepath,
+                                      self.signals.progress.emit)
+            success = True
+            log.debug(f'Saved to {self.filepath}')
+        except:
+            log.exception(f'Failed to save to {self.filepath}:\n')
+        finally:
+            self.signals.finished.emit(success)
 
 
 def attempt_recovery(parent: QObject) -> None:
     """Attempt recovery of a temp file"""
+    # the TempFile can't be replaced while it's being saved
+    if findMainWindow().saving:
+        QApplication.beep()
+        return
     recovery_dlg = RecoveryPopup(parent)
     if not recovery_dlg.exec():
         # if user chose not to attempt recovery delete temp file
-        os.remove(TempFile.recovery_path)
-        TempFile.recovery_path = ''
+        TempFile.discard_recovery()
         return
     TempFile.recover()
     # redirect to activity window
@@ -0,0 +1,231 @@
+"""The analysis.py module contains the metrics that can be added to the
+differences of an export as analysis columns.
+
+Each metric is a function of an AnalysisBlock, registered under the
+header of its column with the metric decorator, returning one value for
+each row of the block. The float values of the differences and the masks
+the metrics share are worked out once per block, so adding a metric
+doesn't add another pass over the differences. A metric is offered to
+users by giving an ExportOption under ExportOptions.analysis its header.
+
+Every metric of each changed series is also worked out when compared and
+saved beside the differences as a summary, so exports of all dates read
+the metrics rather than reducing the differences again.
+"""
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+
+# rows of the differences analysed at a time
+ROWS = 65536
+
+
+@dataclass
+class Metric():
+    func: Callable  # returns the metric for each row of an AnalysisBlock
+    uses_pre: bool  # True if it needs pre's values
+    date: bool  # True if it returns dates
+
+
+# metrics by the header of their column
+METRICS: Dict[str, Metric] = dict()
+# header of the summary column holding the bits of each row's status codes
+MISSING = 'Missing'
+
+
+def metric(header: str, uses_pre: bool = False,
+           date: bool = False) -> Callable:
+    """Decorator registering a function of an AnalysisBlock as the
+    metric of the analysis column header"""
+    def _register(func: Callable) -> Callable:
+        METRICS[header] = Metric(func, uses_pre, date)
+        return func
+    return _register
+
+
+def dates_at(dates: pd.Index, positions: np.ndarray,
+             valid: np.ndarray) -> np.ndarray:
+    """Returns the date at each position, NaN where not valid"""
+    labels = np.full(len(positions), np.nan, dtype=object)
+    labels[valid] = np.asarray(dates, dtype=object)[positions[valid]]
+    return labels
+
+
+class AnalysisBlock():
+    """A block of rows of the differences with the masks the metrics
+    share, each only worked out when first used"""
+
+    def __init__(self, diff: np.ndarray, dates: pd.Index,
+                 pre: np.ndarray = None) -> None:
+        self.diff = diff
+        self.dates = dates
+        self.pre = pre
+
+    @cached_property
+    def nan(self) -> np.ndarray:
+        return np.isnan(self.diff)
+
+    @cached_property
+    def filled(self) -> np.ndarray:
+        """The differences with NaN as 0"""
+        return np.where(self.nan, 0.0, self.diff)
+
+    @cached_property
+    def abs(self) -> np.ndarray:
+        """The absolute differences with NaN as 0"""
+        return np.abs(self.filled)
+
+    @cached_property
+    def abs_masked(self) -> np.ndarray:
+        """The absolute differences with NaN as -inf, so a NaN is never
+        picked over a value of 0"""
+        return np.where(self.nan, -np.inf, self.abs)
+
+    @cached_property
+    def counts(self) -> np.ndarray:
+        """The number of differences that aren't NaN in each row"""
+        return (~self.nan).sum(axis=1)
+
+    @cached_property
+    def changed(self) -> np.ndarray:
+        """True for the differences that aren't NaN or 0"""
+        return self.filled != 0.0
+
+    @cached_property
+    def relative(self) -> np.ndarray:
+        """The differences as a percentage of pre, 0 where either is
+        NaN"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = self.diff / self.pre
+        relative[np.isnan(relative)] = 0.0
+        return relative * 100
+
+    def row_max(self, values: np.ndarray) -> np.ndarray:
+        """Returns the max of each row of values, NaN if there are no
+        dates"""
+        if not values.shape[1]:
+            return np.full(len(values), np.nan)
+        return values.max(axis=1)
+
+    def row_argmax(self, values: np.ndarray) -> np.ndarray:
+        """Returns the position of the first max of each row of values"""
+        if not values.shape[1]:
+            return np.zeros(len(values), dtype=int)
+        return values.argmax(axis=1)
+
+
+@metric('Total Diff')
+def total_diff(block: AnalysisBlock) -> np.ndarray:
+    return block.filled.sum(axis=1)
+
+
+@metric('Total ABS Diff')
+def total_abs_diff(block: AnalysisBlock) -> np.ndarray:
+    return block.abs.sum(axis=1)
+
+
+@metric('Max ABS Diff')
+def max_abs_diff(block: AnalysisBlock) -> np.ndarray:
+    return np.where(block.counts > 0, block.row_max(block.abs), np.nan)
+
+
+@metric('Max ABS % Diff', uses_pre=True)
+def max_abs_perc_diff(block: AnalysisBlock) -> np.ndarray:
+    return np.round(block.row_max(np.abs(block.relative)), 1)
+
+
+@metric('Max ABS Diff Date', date=True)
+def max_abs_diff_date(block: AnalysisBlock) -> np.ndarray:
+    return dates_at(block.dates, block.row_argmax(block.abs_masked),
+                    block.counts > 0)
+
+
+@metric('RMS Diff')
+def rms_diff(block: AnalysisBlock) -> np.ndarray:
+    # NaN where a row has no differences to average
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt((block.filled ** 2).sum(axis=1) / block.counts)
+
+
+@metric('Changed Periods')
+def changed_periods(block: AnalysisBlock) -> np.ndarray:
+    return block.changed.sum(axis=1)
+
+
+@metric('First Changed Date', date=True)
+def first_changed_date(block: AnalysisBlock) -> np.ndarray:
+    return dates_at(block.dates, block.row_argmax(block.changed),
+                    block.changed.any(axis=1))
+
+
+@metric('Max Rel % Revision', uses_pre=True)
+def max_relative_revision(block: AnalysisBlock) -> np.ndarray:
+    # the revision relative to pre furthest from 0, keeping its sign
+    positions = block.row_argmax(np.abs(block.relative))
+    revisions = np.full(len(positions), np.nan)
+    if block.relative.shape[1]:
+        revisions = block.relative[np.arange(len(positions)), positions]
+    return np.round(revisions, 1)
+
+
+def uses_pre(headers: List[str]) -> bool:
+    """Returns True if any of the metrics of headers need pre's values"""
+    return any(METRICS[header].uses_pre for header in headers)
+
+
+def analyse(headers: List[str], diff: np.ndarray, dates: pd.Index,
+            pre: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """Returns the metric of each of headers for every row of diff, whose
+    columns are dates, worked out ROWS rows at a time. pre's values must
+    be given, aligned to diff and NaN where missing, if uses_pre is True
+    for headers."""
+    columns = {header: [] for header in headers}
+    for start in range(0, max(len(diff), 1), ROWS):
+        stop = start + ROWS
+        block = AnalysisBlock(diff[start:stop], dates,
+                              None if pre is None else pre[start:stop])
+        for header in headers:
+            columns[header].append(METRICS[header].func(block))
+    return {header: np.concatenate(values)
+            for header, values in columns.items()}
+
+
+def status_bits(status: np.ndarray) -> np.ndarray:
+    """Returns the Status codes in each row of status as the bits of an
+    int, in a single pass over the codes"""
+    return np.bitwise_or.reduce(
+        np.left_shift(1, status, dtype=np.int16), axis=1)
+
+
+def summary_headers() -> List[str]:
+    """Returns the headers of the columns of a summary"""
+    return list(METRICS) + [MISSING]
+
+
+def summarise(diff: np.ndarray, status: np.ndarray,
+              pre: np.ndarray) -> np.ndarray:
+    """Returns the summary of each row of diff, with status its Status
+    codes and pre pre's values aligned to it. A summary row holds every
+    metric as a float, dates as the position of their column of diff,
+    then the bits of the row's status codes."""
+    headers = list(METRICS)
+    metrics = analyse(headers, diff, pd.RangeIndex(diff.shape[1]), pre)
+    return np.column_stack([metrics[header].astype(float)
+                            for header in headers] + [status_bits(status)])
+
+
+def from_summary(summary: pd.DataFrame, headers: List[str],
+                 dates: pd.Index) -> Dict[str, np.ndarray]:
+    """Returns the metric of each of headers for every row of a summary,
+    with the positions of dates as the dates they're at"""
+    columns = dict()
+    for header in headers:
+        values = summary[header].to_numpy()
+        if METRICS[header].date:
+            valid = ~np.isnan(values)
+            values = dates_at(dates, np.where(valid, values, 0).astype(int),
+                              valid)
+        columns[header] = values
+    return columns
@@ -0,0 +1,221 @@
+"""The blocks.py module contains objects for locating the periodicity
+blocks of a CORD visualisation csv by byte position, without loading
+the file into memory.
+"""
+import io
+import logging
+import mmap
+from dataclasses import dataclass
+from typing import List, Tuple
+import pandas as pd
+from validation import InvalidVisualisation
+try:
+    import pyarrow
+    from pyarrow import csv as arrow_csv
+    arrow_available = True
+except ImportError:
+    arrow_available = False
+
+log = logging.getLogger('OptiCORD')
+
+# byte patterns marking the structure of a CORD visualisation
+DATE_MARKER = b',Date'
+CRITERIA_MARKER = b'Criteria: '
+# bytes that can make up a line with no data, commas are included as
+# excel pads blank lines with them
+BLANK = b' \t\r\n,'
+# encoding CORD visualisations are read with
+ENCODING = 'unicode_escape'
+# values CORD uses to represent missing data
+NA_VALUES = ['.', 'NULL', '']
+
+
+class ParseEngine():
+    """Engines available for reading blocks of data"""
+    PANDAS = 0  # pandas C engine, single threaded
+    ARROW = 1  # pyarrow csv reader, multithreaded
+
+
+@dataclass
+class Block:
+    """Location of a single periodicity of data within the csv"""
+    header: str  # dimension header line, containing ',Date'
+    dates: str  # line of dates below the header
+    data: Tuple[int, int]  # byte range of the data lines
+
+
+class BlockIndex():
+    """Memory maps a visualisation csv and scans it for newline offsets
+    and marker byte patterns. Holds the byte ranges of the metadata and
+    each periodicity block so they can be read directly.
+    Can be used as a context manager to close the map once finished."""
+    filepath: str  # full filepath of visualisation file
+    head: List[str]  # first 3 lines of the file
+    meta: Tuple[int, int]  # byte range of the metadata lines
+    blocks: List[Block]  # blocks in the order they appear
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap raises a ValueError for empty files
+            self._file.close()
+            raise InvalidVisualisation(f'{filepath} is empty',
+                                       'File format error')
+        self._scan()
+
+    def __enter__(self) -> 'BlockIndex':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the memory map and file"""
+        self._map.close()
+        self._file.close()
+
+    def read(self, span: Tuple[int, int]) -> bytes:
+        """Returns the raw bytes in the given byte range"""
+        start, end = span
+        return self._map[start:end]
+
+    def _line_start(self, pos: int) -> int:
+        """Returns the offset of the start of the line containing pos"""
+        return self._map.rfind(b'\n', 0, pos) + 1
+
+    def _line_end(self, pos: int) -> int:
+        """Returns the offset just after the newline ending the line
+        containing pos, or the end of the file"""
+        end = self._map.find(b'\n', pos)
+        return len(self._map) if end == -1 else end + 1
+
+    def _decode(self, start: int, end: int) -> str:
+        """Decode the given byte range as text"""
+        return self._map[start:end].decode(ENCODING)
+
+    def _strip_blank_lines(self, start: int, end: int) -> int:
+        """Returns a new end offset for the range start:end with any
+        trailing blank lines removed"""
+        while end > start:
+            line_start = self._line_start(end - 1)
+            if self._map[max(line_start, start):end].strip(BLANK):
+                break
+            end = line_start
+        return end
+
+    def _scan(self) -> None:
+        """Scan the memory map for the markers which split the file into
+        the metadata and the periodicity blocks."""
+        size = len(self._map)
+        # read the first 3 lines to determine if file has been modified
+        self.head = []
+        pos = 0
+        while len(self.head) < 3 and pos < size:
+            end = self._line_end(pos)
+            self.head.append(self._decode(pos, end))
+            pos = end
+        # find the header line of each periodicity
+        headers = []
+        pos = self._map.find(DATE_MARKER)
+        while pos != -1:
+            start = self._line_start(pos)
+            headers.append(start)
+            pos = self._map.find(DATE_MARKER, self._line_end(pos))
+        if not headers:
+            raise InvalidVisualisation(f'No data blocks found in '
+                                       f'{self.filepath}', 'File format error')
+        # metadata is everything above the line before the first header,
+        # by CORD definition that line is the criteria line
+        self.meta = (0, self._line_start(max(headers[0] - 1, 0)))
+        self.blocks = []
+        for i, header_start in enumerate(headers):
+            header_end = self._line_end(header_start)
+            # the dates are always on the line after the header
+            dates_end = self._line_end(header_end)
+            # the block ends at the next criteria marker, the next header
+            # or the end of the file, whichever comes first
+            block_end = headers[i+1] if i+1 < len(headers) else size
+            criteria = self._map.find(CRITERIA_MARKER, dates_end, block_end)
+            if criteria != -1:
+                block_end = self._line_start(criteria)
+            self.blocks.append(Block(
+                self._decode(header_start, header_end),
+                self._decode(header_end, dates_end),
+                (dates_end, self._strip_blank_lines(dates_end, block_end))))
+
+
+def convert_column_dates(per: str, columns: pd.Series) -> pd.Series:
+    """Convert a given series 'columns' to a datetime series based
+    on periodicity 'per'."""
+    if per == "A":
+        return pd.to_datetime(columns, format="%Y")
+    if per == "Q":
+        return pd.to_datetime(pd.PeriodIndex(
+            columns, freq='Q').to_timestamp())
+    if per == "M":
+        return pd.to_datetime(columns, format="%Y%b")
+
+
+def _read_pandas(text: str, dimensions: List[str],
+                 dates: List[str]) -> pd.DataFrame:
+    """Reads the csv lines in 'text' with the pandas C engine"""
+    # create names
+    names = dimensions + dates
+    # create dtypes list
+    # without compression 'category' type for dimensions uses less
+    # memory, a compressed object however uses less memory than a
+    # compressed category
+    dtype_list = (['object']*len(dimensions)) + (['float64']*len(dates))
+    return pd.read_csv(io.StringIO(text), header=None,
+                       skip_blank_lines=False, index_col=False, names=names,
+                       dtype=dict(zip(names, dtype_list)),
+                       keep_default_na=False, na_values=NA_VALUES)
+
+
+def _read_arrow(text: str, dimensions: List[str],
+                dates: List[str]) -> pd.DataFrame:
+    """Reads the csv lines in 'text' with the multithreaded pyarrow
+    csv reader. Raises pyarrow.ArrowInvalid for lines it can't read."""
+    names = dimensions + dates
+    # columns are read by position so any extra trailing columns, such
+    # as the commas excel pads lines with, are left out
+    columns = [f'f{i}' for i in range(len(names))]
+    types = [pyarrow.string()]*len(dimensions) + \
+        [pyarrow.float64()]*len(dates)
+    table = arrow_csv.read_csv(
+        io.BytesIO(text.encode('utf-8')),
+        read_options=arrow_csv.ReadOptions(
+            use_threads=True, autogenerate_column_names=True),
+        parse_options=arrow_csv.ParseOptions(ignore_empty_lines=False),
+        convert_options=arrow_csv.ConvertOptions(
+            column_types=dict(zip(columns, types)),
+            include_columns=columns, include_missing_columns=True,
+            null_values=NA_VALUES, strings_can_be_null=True,
+            quoted_strings_can_be_null=True))
+    return table.rename_columns(names).to_pandas()
+
+
+def read_block(text: str, per: str, dimensions: List[str], dates: List[str],
+               engine: int = ParseEngine.PANDAS) -> pd.DataFrame:
+    """Reads a single periodicity of data from the csv lines in 'text'
+    into a dataframe indexed by dimensions with datetime columns.
+    Falls back to the pandas engine if 'engine' can't read the block."""
+    df = None
+    if engine == ParseEngine.ARROW and arrow_available:
+        try:
+            df = _read_arrow(text, dimensions, dates)
+        except pyarrow.ArrowInvalid as e:
+            log.debug(f'Arrow engine failed, reading {per} with pandas: {e}')
+    if df is None:
+        df = _read_pandas(text, dimensions, dates)
+    # forward fill the dimension columns
+    df[dimensions] = df[dimensions].ffill()
+    # set dimension columns as index
+    df.set_index(dimensions, inplace=True)
+    # convert the columns to regular python datetime
+    df.columns = convert_column_dates(per, df.columns)
+    return df
@@ -1,9 +1,15 @@
 from abc import ABC, abstractmethod
+import json
 import logging
+import numpy as np
 import pandas as pd
-import h5py
 import warnings
-from util import MetaDict, TempFile
+from PyQt5.QtCore import QSettings
+import h5py
+from analysis import summarise, summary_headers
+from frames import Dimensions, FrameWriter, StoredFrame, TableWriter, \
+    frame_shape, read_frame, write_frames
+from util import Catalog, MetaDict, ResultCache, TempFile
 log = logging.getLogger('OptiCORD')
 
 
@@ -16,6 +22,171 @@ class InvalidComparison(Exception):
         self.short = short
 
 
+class Status():
+    """Codes classifying each cell of a comparison"""
+    EQUAL = 0
+    DIFFERENT = 1
+    MISSING_PRE = 2  # value is nan in pre only
+    MISSING_POST = 3  # value is nan in post only
+    SERIES_NOT_IN_PRE = 4
+    SERIES_NOT_IN_POST = 5
+    DATE_NOT_IN_PRE = 6
+    DATE_NOT_IN_POST = 7
+    BOTH_NAN = 8
+
+
+def status_labels(pre_position: str, post_position: str) -> list:
+    """Returns the string shown in exports for each Status code, indexed
+    by code. Cells with a difference show the difference instead."""
+    return ['',
+            '',
+            f'Missing in {pre_position}',
+            f'Missing in {post_position}',
+            f'Series not in {pre_position}',
+            f'Series not in {post_position}',
+            f'Date not in {pre_position}',
+            f'Date not in {post_position}',
+            '.']
+
+
+def _align_codes(pre: pd.MultiIndex, post: pd.MultiIndex) -> tuple:
+    """Aligns two MultiIndexes by their integer codes rather than their
+    labels. Only the small levels of each dimension are joined, then each
+    row's codes are packed into a single int64 key so rows are matched by
+    integer. Returns None if the keys would overflow or aren't unique."""
+    levels, pre_codes, post_codes = [], [], []
+    for i in range(post.nlevels):
+        level = post.levels[i].union(pre.levels[i])
+        # union leaves equal levels in their stored order, the keys are
+        # only in pandas' order if the levels are sorted
+        if not level.is_monotonic_increasing:
+            try:
+                level = level.sort_values()
+            except TypeError:
+                return None
+        levels.append(level)
+        for idx, codes in ((pre, pre_codes), (post, post_codes)):
+            recoded = level.get_indexer(idx.levels[i]).take(
+                idx.codes[i], mode='clip') if len(idx.levels[i]) else \
+                np.zeros(len(idx), dtype=np.int64)
+            # 0 is kept for blank labels so they sort first, like pandas
+            codes.append(np.where(idx.codes[i] < 0, 0, recoded + 1))
+    radix = [len(level) + 1 for level in levels]
+    if np.prod(radix, dtype=float) >= 2**62:
+        return None
+
+    def _keys(codes: list) -> np.ndarray:
+        keys = np.zeros(len(codes[0]), dtype=np.int64)
+        for code, size in zip(codes, radix):
+            keys = keys * size + code
+        return keys
+    pre_keys, post_keys = _keys(pre_codes), _keys(post_codes)
+    if not len(pre_keys):
+        return post, np.full(len(post), -1), np.arange(len(post))
+    if not len(post_keys):
+        return pre, np.arange(len(pre)), np.full(len(pre), -1)
+    if np.array_equal(pre_keys, post_keys):
+        return post, np.arange(len(post)), np.arange(len(post))
+    if len(np.unique(pre_keys)) < len(pre_keys) or \
+            len(np.unique(post_keys)) < len(post_keys):
+        return None
+    # the sorted union of the keys is the order pandas sorts the labels in
+    joined = np.union1d(pre_keys, post_keys)
+    codes = []
+    rest = joined
+    for size in reversed(radix):
+        rest, code = np.divmod(rest, size)
+        codes.insert(0, code - 1)
+    index = pd.MultiIndex(levels=levels, codes=codes, names=post.names,
+                          verify_integrity=False)
+    return (index, pd.Index(pre_keys).get_indexer(joined),
+            pd.Index(post_keys).get_indexer(joined))
+
+
+def align_axis(pre: pd.Index, post: pd.Index) -> tuple:
+    """Returns the outer joined index of post and pre, the same as
+    pandas arithmetic, with the position of each label in pre and post,
+    -1 where it's missing"""
+    if isinstance(pre, pd.MultiIndex) and isinstance(post, pd.MultiIndex) \
+            and pre.nlevels == post.nlevels:
+        aligned = _align_codes(pre, post)
+        if aligned is not None:
+            return aligned
+    joined, post_idx, pre_idx = post.join(pre, how='outer',
+                                          return_indexers=True)
+    if post_idx is None:
+        post_idx = np.arange(len(joined))
+    if pre_idx is None:
+        pre_idx = np.arange(len(joined))
+    return joined, pre_idx, post_idx
+
+
+def _take(df: pd.DataFrame, rows: np.ndarray,
+          cols: np.ndarray) -> np.ndarray:
+    """Returns the values of df at rows and cols as floats, nan where
+    the row or column is -1"""
+    values = np.full((df.shape[0]+1, df.shape[1]+1), np.nan)
+    values[:-1, :-1] = df.to_numpy(dtype=float)
+    # -1 picks the padding row and column
+    return values[np.ix_(rows, cols)]
+
+
+def classify(pre: pd.DataFrame, post: pd.DataFrame) -> tuple:
+    """Aligns pre and post once and returns the difference post - pre
+    as a DataFrame, with a Status code for each of its cells as an int8
+    array and pre's values aligned to it, in a tuple (diff, status, pre)"""
+    index, pre_rows, post_rows = align_axis(pre.index, post.index)
+    columns, pre_cols, post_cols = align_axis(pre.columns, post.columns)
+    pre_vals = _take(pre, pre_rows, pre_cols)
+    diff, status = _classify_values(
+        pre_vals, _take(post, post_rows, post_cols),
+        pre_rows, post_rows, pre_cols, post_cols)
+    return pd.DataFrame(diff, index=index, columns=columns), status, pre_vals
+
+
+def _classify_values(pre_vals: np.ndarray, post_vals: np.ndarray,
+                     pre_rows: np.ndarray, post_rows: np.ndarray,
+                     pre_cols: np.ndarray, post_cols: np.ndarray) -> tuple:
+    """Returns the difference of aligned pre and post values with the
+    Status code of each cell, given the position of each row and column
+    in pre and post, -1 where it's missing"""
+    diff = post_vals - pre_vals
+    # cells where both have a row and column, only these can be missing
+    both = ((pre_rows >= 0) & (post_rows >= 0))[:, None] & \
+        ((pre_cols >= 0) & (post_cols >= 0))
+    pre_nan = np.isnan(pre_vals)
+    post_nan = np.isnan(post_vals)
+    status = np.where(diff == 0, Status.EQUAL,
+                      Status.DIFFERENT).astype(np.int8)
+    status[np.isnan(diff)] = Status.BOTH_NAN
+    status[post_rows < 0] = Status.SERIES_NOT_IN_POST
+    status[pre_rows < 0] = Status.SERIES_NOT_IN_PRE
+    status[:, pre_cols < 0] = Status.DATE_NOT_IN_PRE
+    status[:, post_cols < 0] = Status.DATE_NOT_IN_POST
+    status[both & pre_nan & ~post_nan] = Status.MISSING_PRE
+    status[both & post_nan & ~pre_nan] = Status.MISSING_POST
+    return diff, status
+
+
+def _unchanged(status: np.ndarray) -> np.ndarray:
+    """Returns True for the rows of status codes that are in both pre
+    and post with every value the same or nan in both"""
+    return np.isin(status, [Status.EQUAL, Status.BOTH_NAN]).all(axis=1)
+
+
+def _same_digests(rows: np.ndarray, other: np.ndarray, length: int,
+                  same_dates: bool) -> np.ndarray:
+    """Returns True for each of the length rows with a digest in other,
+    the row digests of the other side. These rows are in both pre and
+    post with the same dimensions and values. All False if either side's
+    digests weren't saved or the dates aren't the same, as a row's digest
+    covers its values but not their dates."""
+    if rows is None or other is None or len(rows) != length or \
+            not same_dates:
+        return np.zeros(length, dtype=bool)
+    return np.isin(rows, other)
+
+
 class Comparison(ABC):
     """Abstract base class for all comparisons. Ensures a valid comparison
     can be made no matter the method."""
@@ -76,32 +247,47 @@ class Comparison(ABC):
         else:
             return False
 
+    def _frame_digest(self, vis_path: str, per: str) -> str:
+        """Returns the digest of a periodicity's data saved when it was
+        loaded, or None if it was loaded before digests were saved"""
+        if not Catalog.exists(f'{vis_path}/digests'):
+            return None
+        return Catalog.attrs(f'{vis_path}/digests').get(per)
+
+    def _row_digests(self, vis_path: str, per: str) -> np.ndarray:
+        """Returns the digests of each row of a periodicity's data, in
+        the order they're saved, or None if they weren't saved"""
+        if self._frame_digest(vis_path, per) is None:
+            return None
+        TempFile.manager.lockForRead()
+        with TempFile.store() as store:
+            rows = store[f'{vis_path}/digests/{per}'][()]
+        TempFile.manager.unlock()
+        return rows
+
+    def _identical(self, per: str) -> bool:
+        """Returns True if the digests of pre and post show they hold the
+        same data for the periodicity, in the same order"""
+        # reordered dimensions give each row a different digest
+        if self.diff_dims:
+            return False
+        pre_digest = self._frame_digest(self.pre_path, per)
+        return pre_digest is not None and \
+            pre_digest == self._frame_digest(self.post_path, per)
+
     def compare(self):
         """Main function to compare pre and post and save the difference
         dataframe to the .opticord file."""
         for per in self.periodicities:
             log.debug(f'comparing periodicity {per}')
-            log.debug('reading pre')
-            self.pre = self._read(f'{self.pre_path}/{per}')
-            log.debug('reading post')
-            self.post = self._read(f'{self.post_path}/{per}')
-            # reorder the pre df if diff dims was identified
-            if self.diff_dims:
-                log.warning('dimensions in different order, reordering')
-                self.pre = self.pre.reorder_levels(
-                    list(self.post_meta["Dimensions"]), axis=0)
-            # create the difference and nan dataframes
-            log.debug('calculating difference dataframes')
-            self.diff, self.nans = self._calc_difference()
-            # check for differences
-            log.debug('checking for differences')
-            if self._check_differences():
-                log.debug(f'differences found in {per}')
-                self.differences = True
-            log.debug('saving to file')
             # TODO ensure " vs " cannot be included in position name
-            self.save_to_file(f'comparisons/{self.pre_position}'
-                              f' vs {self.post_position}/{self.vis}/{per}')
+            path = f'comparisons/{self.pre_position}' \
+                f' vs {self.post_position}/{self.vis}/{per}'
+            if self._identical(per):
+                log.debug(f'{per} is identical, not reading data')
+                self.save_identical(path)
+                continue
+            self._compare_periodicity(per, path)
         self.msg_list.append(
             'Differences found' if self.differences else 'No differences')
         if self._get_per_mismatch():
@@ -110,6 +296,34 @@ class Comparison(ABC):
         self.save_metadata()
         self.item.update_msg((', ').join(self.msg_list))
 
+    def _compare_periodicity(self, per: str, path: str) -> None:
+        """Compares a single periodicity of pre and post in memory and
+        saves the difference at path"""
+        log.debug('reading pre')
+        self.pre = self._read(f'{self.pre_path}/{per}')
+        log.debug('reading post')
+        self.post = self._read(f'{self.post_path}/{per}')
+        self.pre_rows = None
+        self.post_rows = None
+        if not self.diff_dims:
+            self.pre_rows = self._row_digests(self.pre_path, per)
+            self.post_rows = self._row_digests(self.post_path, per)
+        # reorder the pre df if diff dims was identified
+        if self.diff_dims:
+            log.warning('dimensions in different order, reordering')
+            self.pre = self.pre.reorder_levels(
+                list(self.post_meta["Dimensions"]), axis=0)
+        # create the difference and status dataframes
+        log.debug('calculating difference dataframes')
+        self.diff, self.status = self._calc_difference()
+        # check for differences
+        log.debug('checking for differences')
+        if self._check_differences():
+            log.debug(f'differences found in {per}')
+            self.differences = True
+        log.debug('saving to file')
+        self.save_to_file(path)
+
     @abstractmethod
     def _read(self, path: str):
         ...
@@ -126,15 +340,37 @@ class Comparison(ABC):
     def save_to_file(self, path: str) -> None:
         ...
 
+    def save_identical(self, path: str) -> None:
+        """Saves a periodicity found to be identical by its digests. No
+        data is saved, exports use post as both pre and post."""
+        TempFile.manager.lockForWrite()
+        TempFile.manager.mark(path)
+        with TempFile.store() as store:
+            comp = store.require_group(path)
+            # remove the data of any earlier comparison
+            for name in list(comp.keys()):
+                del comp[name]
+            comp.attrs['periodicities'] = self.periodicities
+            comp.attrs['different'] = False
+            comp.attrs['identical'] = True
+            Catalog.update(store, path)
+        TempFile.manager.unlock()
+
     def save_metadata(self) -> None:
         """Saves metadata items for the overall visualisation comparison"""
+        path = f'comparisons/{self.pre_position}' \
+            f' vs {self.post_position}/{self.vis}'
         TempFile.manager.lockForWrite()
-        with h5py.File(TempFile.path, 'r+') as store:
-            comp = store[f'comparisons/{self.pre_position}'
-                         f' vs {self.post_position}/{self.vis}']
+        TempFile.manager.mark_attrs(path)
+        with TempFile.store() as store:
+            comp = store[path]
             comp.attrs['periodicities'] = self.periodicities
             comp.attrs['differences'] = self.differences
             comp.attrs['msg'] = (', ').join(self.msg_list)
+            # the positions keep these names if they're renamed later
+            comp.attrs['positions'] = json.dumps(
+                [self.pre_position, self.post_position])
+            Catalog.update(store, path)
         TempFile.manager.unlock()
 
 
@@ -142,86 +378,38 @@ class PandasComparison(Comparison):
     """"""
 
     def _read(self, path: str) -> pd.DataFrame:
-        # even though it's reading it needs a write lock, h5py raises a
-        # permission error even while read lock is on
-        TempFile.manager.lockForWrite()
-        df = pd.read_hdf(TempFile.path, path)
-        TempFile.manager.unlock()
-        return df
+        return read_frame(path)
+
+    def _compare_periodicity(self, per: str, path: str) -> None:
+        super()._compare_periodicity(per, path)
+        # keep what was read and saved so exporting straight after
+        # comparing doesn't read it back
+        entry = dict(self.results, pre=self.pre, post=self.post,
+                     unchanged=self.post_unchanged, summary=self.summary)
+        size = sum(df.memory_usage().sum() for df in
+                   [self.pre, self.post, self.summary,
+                    *self.results.values()])
+        ResultCache.put((self.pre_position, self.post_position, self.vis,
+                         per), entry, size + self.post_unchanged.nbytes)
 
     def _calc_difference(self) -> tuple:
-        """Creates and returns the difference and configured nan dataframes. 
-        The difference dataframe is post.sub(pre), the configured nan dataframe
-        is the difference dataframes NaN values configured as strings. 
-        NaN strings identify as:
-            "Series missing in <pre/post>": Entire series doesn't exist
-                in the pre/post dataframe.
-            "Date missing in <pre/post>": Date column doesn't exist
-                in pre/post.
-            "Missing in <pre/post>": A value is nan in pre/post but data 
-                for the series does exist.
-            ".": Data is NaN in both pre and post."""
-        # Get the difference between post and pre
-        # diff_df will have the combined index and columns
-        # with nan's where there was nan-nan or value-nan
-        diff_df = self.post.sub(self.pre)
-        # we'll need to keep track of the difference df as well
-        # as the original nans to split into 2 dataframes later on
-        diff_df_unconfigured = diff_df.copy()
-        nans = diff_df.isna()
-        # Get a boolean dataframe of everywhere there is a nan
-        # in pre/post and a nan in diff
-        pre_nans = self.pre.isna()[nans] == True
-        post_nans = self.post.isna()[nans] == True
-        # Currently pre_nans and post_nans have a True value
-        # for both nan-nan=nan and value-nan=nan. We need to
-        # differentiate between these nans as nan-nan should stay
-        # as nan since both are missing.
-        # To achieve this we mask the pre/post_nans with the
-        # post/pre_nans. The mask places the value of 'other'
-        # when the value in both dataframes is True. Therefore
-        # by setting our value of other to False we can remove
-        # the nan-nan=nan True's from the pre/post_nan dataframes.
-        missing_pre = pre_nans.mask(post_nans, other=False)
-        missing_post = post_nans.mask(pre_nans, other=False)
-        # Outer merging pre and post dataframes gives us a
-        # dataframe that has both indexes. Setting indicator=True
-        # give us a new column '_merge' which has the values
-        # 'left_only', 'right_only' or 'both' based on where data
-        # was found.
-        missing_rows = self.pre.merge(
-            self.post, how='outer', left_index=True, right_index=True,
-            indicator=True)['_merge']
-        # We can use the values of this missing_rows column
-        # to set the values of the diff df to the missing series
-        # string per where they were missing
-        diff_df[missing_rows ==
-                'left_only'] = f'Series not in {self.post_position}'
-        diff_df[missing_rows ==
-                'right_only'] = f'Series not in {self.pre_position}'
-        # Missing dates in pre/post can be filtered by a simple
-        # list comprehension and set to the missing date string
-        diff_df[[d for d in diff_df.columns if d not in self.pre.columns]
-                ] = f'Date not in {self.pre_position}'
-        diff_df[[d for d in diff_df.columns if d not in self.post.columns]
-                ] = f'Date not in {self.post_position}'
-        # Set the values of the diff_df where we found missing
-        # data in just one of the pre/post dataframes to the
-        # relevant missing in pre/post string. This has to be done at
-        # the end as an error can be raised:
-        # TypeError: Cannot do inplace boolean setting on mixed-types
-        # with a non np.nan value
-        # Not sure how to solve this other than doing this step last
-        diff_df[missing_pre] = f'Missing in {self.pre_position}'
-        diff_df[missing_post] = f'Missing in {self.post_position}'
-        # Finally we are left with just the nan-nan=nan nans
-        # that are not a missing column or row. These should
-        # be set to '.' as this is how they are displayed
-        # in CORD.
-        diff_df = diff_df.fillna('.')
-        # return the orignal difference dataframe and a
-        # dataframe of just the configured nan values
-        return (diff_df_unconfigured, diff_df[nans].astype(str))
+        """Creates and returns the difference and status dataframes.
+        The difference dataframe is post.sub(pre), the status dataframe
+        holds the int8 Status code of each cell, telling why a NaN in
+        the difference dataframe is NaN. status_labels gives the string
+        each code is shown as in exports. pre's aligned values are kept
+        to summarise the differences. Rows the digests show are unchanged
+        are left out, only the rest are aligned and classified."""
+        same_dates = self.pre.columns.tolist() == self.post.columns.tolist()
+        pre_same = _same_digests(self.pre_rows, self.post_rows,
+                                 len(self.pre), same_dates)
+        self.post_same = _same_digests(self.post_rows, self.pre_rows,
+                                       len(self.post), same_dates)
+        diff_df, status, self.pre_values = classify(
+            self.pre[~pre_same], self.post[~self.post_same])
+        status_df = pd.DataFrame(status, index=diff_df.index,
+                                 columns=diff_df.columns)
+        return (diff_df, status_df)
 
     def _check_differences(self) -> bool:
         """Returns true if differences are found between pre and post,
@@ -230,31 +418,168 @@ class PandasComparison(Comparison):
         # and values
         if self.pre.columns.tolist() != self.post.columns.tolist():
             return True
+        # the same rows in any order have the same set of digests
+        if self.pre_rows is not None and self.post_rows is not None:
+            return not np.array_equal(np.sort(self.pre_rows),
+                                      np.sort(self.post_rows))
         # independantly check the index for the same reasons as above
         if not self.pre.sort_index().index.equals(self.post.sort_index().index):
             return True
         return not self.post.sort_index().equals(self.pre.sort_index())
 
     def save_to_file(self, path: str) -> None:
+        # Only the series with differences are saved. Unchanged series are
+        # always in post, so they're recorded as a bitmap over post's rows.
+        status = self.status.to_numpy()
+        unchanged = _unchanged(status)
+        # the rows left out by their digests are unchanged too
+        post_unchanged = self.post_same.copy()
+        post_unchanged[self.post.index.get_indexer(
+            self.diff.index[unchanged])] = True
+        self.results = {'data': self.diff[~unchanged],
+                        'status': self.status[~unchanged]}
+        self.post_unchanged = post_unchanged
+        # the metrics of each saved series, so exports don't reduce the
+        # differences again
+        self.summary = pd.DataFrame(
+            summarise(self.diff.to_numpy()[~unchanged], status[~unchanged],
+                      self.pre_values[~unchanged]),
+            index=self.diff.index[~unchanged], columns=summary_headers())
+        del self.pre_values
         TempFile.manager.lockForWrite()
-        # We have to split the dataframes into the data and nans since hdf5
-        # format doesn't support saving as object data type (which is what
-        # is needed for float and string in same column).
-        self.diff.to_hdf(
-            TempFile.path,
-            f'{path}/data',
-            mode='a', complib='blosc:zlib', complevel=9,
-            format='fixed')
-        self.nans.to_hdf(
-            TempFile.path,
-            f'{path}/nans',
-            mode='a', complib='blosc:zlib', complevel=9,
-            format='fixed')
-        # save the metadata
-        with h5py.File(TempFile.path, 'r+') as store:
+        TempFile.manager.mark(path)
+        with TempFile.store() as store:
+            comp = self._clear_results(store, path)
+            # The reason for each NaN in the difference is saved as an int8
+            # status code rather than a string, with the strings for each
+            # code saved once in the metadata.
+            write_frames(comp, self.results)
+            TableWriter(comp, 'summary', summary_headers()).append(
+                store, self.summary.to_numpy())
+        self._save_results(path, post_unchanged)
+        TempFile.manager.unlock()
+
+    def _clear_results(self, store: h5py.File, path: str) -> h5py.Group:
+        """Removes the data of any earlier comparison at path, including
+        the nans dataframe of one made before status codes. Returns the
+        comparison's group."""
+        comp = store.require_group(path)
+        for name in list(comp.keys()):
+            del comp[name]
+        return comp
+
+    def _save_results(self, path: str, post_unchanged: np.ndarray) -> None:
+        """Saves the bitmap of post's unchanged rows and the metadata of
+        the comparison at path. Must be called with the write lock held."""
+        # marked again so the journal records the finished comparison
+        TempFile.manager.mark(path)
+        with TempFile.store() as store:
             comp = store[path]
+            comp.create_dataset('unchanged', data=np.packbits(post_unchanged))
+            comp['unchanged'].attrs['rows'] = len(post_unchanged)
             comp.attrs['periodicities'] = self.periodicities
             comp.attrs['different'] = self.differences
+            comp.attrs['identical'] = False
+            comp.attrs['status_labels'] = json.dumps(status_labels(
+                self.pre_position, self.post_position))
+            Catalog.update(store, path)
+
+
+class ChunkedComparison(PandasComparison):
+    """Compares periodicities too large to hold in memory a block of rows
+    at a time. Aligned blocks of the rows of pre and post with different
+    digests are read from the file in the order of their joined index and
+    the rows with differences are saved a block at a time, keeping peak
+    memory within the budget. Periodicities that fit within the budget
+    are compared in memory."""
+    # rough peak memory used per cell of the joined frames when comparing
+    CELL_BYTES = 64
+    # default memory budget for a single comparison, in MB
+    DEFAULT_BUDGET = 2048
+
+    def memory_budget() -> int:
+        """Returns the memory budget of a comparison in bytes, set in MB
+        by the comparison_memory_budget setting"""
+        return int(QSettings().value('comparison_memory_budget',
+                                     ChunkedComparison.DEFAULT_BUDGET)) * 2**20
+
+    def _compare_periodicity(self, per: str, path: str) -> None:
+        budget = ChunkedComparison.memory_budget()
+        pre_shape = frame_shape(f'{self.pre_path}/{per}')
+        post_shape = frame_shape(f'{self.post_path}/{per}')
+        cells = max(pre_shape[0], post_shape[0]) * \
+            max(pre_shape[1], post_shape[1])
+        if cells * ChunkedComparison.CELL_BYTES <= budget:
+            return super()._compare_periodicity(per, path)
+        log.debug(f'{per} is larger than the memory budget, comparing '
+                  'in blocks')
+        self._compare_chunked(per, path, budget)
+
+    def _compare_chunked(self, per: str, path: str, budget: int) -> None:
+        """Compares a periodicity a block of rows at a time and saves the
+        changed rows of each block at path"""
+        pre = StoredFrame(f'{self.pre_path}/{per}')
+        post = StoredFrame(f'{self.post_path}/{per}')
+        pre_index = pre.index
+        if self.diff_dims:
+            log.warning('dimensions in different order, reordering')
+            pre_index = pre_index.reorder_levels(
+                list(self.post_meta["Dimensions"]))
+        index, pre_rows, post_rows = align_axis(pre_index, post.index)
+        columns, pre_cols, post_cols = align_axis(pre.columns, post.columns)
+        # the same columns in a different order count as a difference
+        same_dates = pre.columns.tolist() == post.columns.tolist()
+        if not same_dates:
+            self.differences = True
+        size = max(1, budget // (len(columns) * ChunkedComparison.CELL_BYTES))
+        # rows the digests show are unchanged aren't read, they're only
+        # recorded as unchanged
+        post_unchanged = np.zeros(len(post.index), dtype=bool)
+        if not self.diff_dims:
+            post_unchanged = _same_digests(
+                self._row_digests(self.post_path, per),
+                self._row_digests(self.pre_path, per), len(post.index),
+                same_dates)
+        # -1 picks the padding, rows not in post are always changed
+        changed = np.flatnonzero(~np.append(post_unchanged, False)[post_rows])
+        TempFile.manager.lockForWrite()
+        TempFile.manager.mark(path)
+        with TempFile.store() as store:
+            comp = self._clear_results(store, path)
+            dimensions = Dimensions()
+            data = FrameWriter(comp, 'data', columns, index.names,
+                               dimensions)
+            status = FrameWriter(comp, 'status', columns, index.names,
+                                 dimensions, np.int8)
+            summary = TableWriter(comp, 'summary', summary_headers())
+        TempFile.manager.unlock()
+        for start in range(0, len(changed), size):
+            log.debug(f'comparing changed rows {start} to {start + size}')
+            rows = changed[start:start + size]
+            pre_vals = pre.gather(pre_rows[rows], pre_cols, size)
+            diff, codes = _classify_values(
+                pre_vals, post.gather(post_rows[rows], post_cols, size),
+                pre_rows[rows], post_rows[rows], pre_cols, post_cols)
+            unchanged = _unchanged(codes)
+            post_unchanged[post_rows[rows][unchanged]] = True
+            if unchanged.all():
+                continue
+            self.differences = True
+            labels = index[rows][~unchanged]
+            metrics = summarise(diff[~unchanged], codes[~unchanged],
+                                pre_vals[~unchanged])
+            TempFile.manager.lockForWrite()
+            with TempFile.store() as store:
+                data.append(store, pd.DataFrame(
+                    diff[~unchanged], index=labels, columns=columns))
+                status.append(store, pd.DataFrame(
+                    codes[~unchanged], index=labels, columns=columns))
+                summary.append(store, metrics)
+            TempFile.manager.unlock()
+        TempFile.manager.lockForWrite()
+        with TempFile.store() as store:
+            dimensions.save(store[path])
+        self._save_results(path, post_unchanged)
         TempFile.manager.unlock()
 
 
@@ -1,10 +1,16 @@
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum, auto
+from itertools import zip_longest
 import os
-from typing import Any
-from util import MetaDict, Switch, TempFile
-from PyQt5.QtCore import QSettings, QObject,  QDate
+import pickle
+from typing import Any, BinaryIO, Callable, Iterator
+from analysis import analyse, from_summary, status_bits, uses_pre
+from comparison import Status, align_axis, status_labels
+from frames import frame_shape, read_frame, read_table, select_dates
+from util import MetaDict, ProcessPool, ResultCache, Switch, TempFile
+from PyQt5.QtCore import QDir, QMutex, QSettings, QObject, QTemporaryFile, QDate
 from PyQt5.QtWidgets import QDateEdit, QTreeView
 from PyQt5.QtGui import QStandardItem
 from distutils.util import strtobool
@@ -28,6 +34,7 @@ class ExportOption():
     action: ExportOptionAction
     default_value: Any = False
     parent: Any = None
+    metric: str = None  # header of the analysis column it adds, if any
     setting: str = field(init=False, repr=False)
     item: QStandardItem = field(init=False, repr=False)
     placeholder_item: QStandardItem = field(init=False, repr=False)
@@ -125,15 +132,32 @@ class ExportOptions(object):
         parent=sheets)
     analysis = ExportOption("Analysis Columns", ExportOptionAction.NONE)
     total_diff = ExportOption(
-        "Total Difference", ExportOptionAction.TOGGLE, parent=analysis)
+        "Total Difference", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='Total Diff')
     total_abs_diff = ExportOption(
-        "Total ABS Difference", ExportOptionAction.TOGGLE, parent=analysis)
+        "Total ABS Difference", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='Total ABS Diff')
     max_abs_diff = ExportOption(
-        "Max ABS Difference", ExportOptionAction.TOGGLE, parent=analysis)
+        "Max ABS Difference", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='Max ABS Diff')
     max_abs_perc_diff = ExportOption(
-        "Max ABS % Difference", ExportOptionAction.TOGGLE, parent=analysis)
+        "Max ABS % Difference", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='Max ABS % Diff')
     max_abs_diff_date = ExportOption(
-        "Max ABS Difference Date", ExportOptionAction.TOGGLE, parent=analysis)
+        "Max ABS Difference Date", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='Max ABS Diff Date')
+    rms_diff = ExportOption(
+        "RMS Difference", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='RMS Diff')
+    changed_periods = ExportOption(
+        "Changed Periods", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='Changed Periods')
+    first_changed_date = ExportOption(
+        "First Changed Date", ExportOptionAction.TOGGLE, parent=analysis,
+        metric='First Changed Date')
+    max_relative_revision = ExportOption(
+        "Max Relative % Revision", ExportOptionAction.TOGGLE,
+        parent=analysis, metric='Max Rel % Revision')
     missing_data = ExportOption(
         "Missing Data", ExportOptionAction.TOGGLE, parent=analysis,
         default_value=True)
@@ -152,8 +176,30 @@ class ExportOptions(object):
         parent=skip_no_diffs)
 
 
+def date_labels(dates: pd.Index, per: str) -> pd.Index:
+    """Returns dates as the strings they're shown as for the periodicity
+    per. Dates of other periodicities are returned as datetimes."""
+    # ensure dates are of datetime format
+    dates = dates.astype('datetime64[ns]')
+    # convert them to strings
+    if per == "A":
+        return dates.strftime("%Y")
+    if per == "Q":
+        return dates.to_period("Q").astype(str)
+    if per == "M":
+        return dates.strftime("%Y%b")
+    return dates
+
+
 class Export():
     """"""
+    # rough peak memory used per cell of a periodicity while preparing it
+    CELL_BYTES = 160
+    # default memory budget shared by the exports running at once, in MB
+    DEFAULT_BUDGET = 2048
+    free: int = None  # MB of the budget not in use, set by the first queue
+    waiting: deque = deque()  # (MB, start) of exports waiting for memory
+    mutex: QMutex = QMutex()  # held while free or waiting are used
 
     def __init__(self, desc: list, pre: str, post: str,
                  export_folder: str, item) -> None:
@@ -175,15 +221,106 @@ class Export():
         else:
             return False
 
-    def export(self):
-        """Export the comparison data to an xlsx file using user 
-        specified settings."""
-        log.debug(f'Exporting {self.item.name}')
-        self.wb = xlsxwriter.Workbook(f'{self.exp_fol}/{self.item.name}.xlsx')
-        self._create_formats()
-        # keep track of whether or not we've written anything to the file
-        self.written = False
+    def memory_budget() -> int:
+        """Returns the memory budget shared by running exports in MB, set
+        by the export_memory_budget setting"""
+        return int(QSettings().value('export_memory_budget',
+                                     Export.DEFAULT_BUDGET))
+
+    def queue(mb: int, start: Callable[[], None]) -> None:
+        """Calls start once mb MB of the memory budget are free, taking
+        them, so exports wait for memory before they take a thread of
+        the pool rather than in it. Exports start in the order queued."""
+        Export.mutex.lock()
+        try:
+            if Export.free is None:
+                Export.free = Export.memory_budget()
+            ready = not Export.waiting and mb <= Export.free
+            if ready:
+                Export.free -= mb
+            else:
+                Export.waiting.append((mb, start))
+        finally:
+            Export.mutex.unlock()
+        if ready:
+            start()
+
+    def unqueue(start: Callable[[], None]) -> bool:
+        """Removes start from the exports waiting for memory, returning
+        True if it was waiting"""
+        Export.mutex.lock()
+        try:
+            entry = next((e for e in Export.waiting if e[1] == start), None)
+            if entry is not None:
+                Export.waiting.remove(entry)
+        finally:
+            Export.mutex.unlock()
+        if entry is not None:
+            # the exports behind it may fit now
+            Export.release_memory(0)
+        return entry is not None
+
+    def release_memory(mb: int) -> None:
+        """Gives back mb MB taken by queue and starts the waiting exports
+        that now fit"""
+        ready = []
+        Export.mutex.lock()
+        try:
+            Export.free += mb
+            while Export.waiting and Export.waiting[0][0] <= Export.free:
+                needed, start = Export.waiting.popleft()
+                Export.free -= needed
+                ready.append(start)
+        finally:
+            Export.mutex.unlock()
+        for start in ready:
+            start()
+
+    def memory_needed(self) -> int:
+        """Returns the MB of the memory budget the export needs, the most
+        cells of any periodicity it prepares, capped at the whole budget
+        so it can always run"""
+        cells = 0
         for per in self.meta['periodicities']:
+            pre = frame_shape(f'positions/{self.pre}/{self.item.name}/{per}')
+            post = frame_shape(
+                f'positions/{self.post}/{self.item.name}/{per}')
+            cells = max(cells, max(pre[0], post[0]) * max(pre[1], post[1]))
+        return max(1, min(cells * Export.CELL_BYTES // 2**20,
+                          Export.memory_budget()))
+
+    def export(self, progress: Callable[[str], None] = None) -> None:
+        """Export the comparison data to an xlsx file using user
+        specified settings. The sheets are prepared here and written by
+        write_workbook in the ProcessPool, as xlsxwriter holds the GIL
+        the whole time it's writing. progress is called with a message
+        as each step starts."""
+        log.debug(f'Exporting {self.item.name}')
+        # the sheets are handed to the process in a temp file, added a
+        # sheet at a time so only one periodicity is held in memory. It's
+        # removed once f is deleted.
+        f = QTemporaryFile(QDir.temp().absoluteFilePath(
+            'OptiCORD-export-XXXXXX.sheets'))
+        # open and close the temp file to ensure it gets a fileName
+        f.open()
+        f.close()
+        with open(f.fileName(), 'wb') as sheets:
+            written = self._prepare(sheets, progress)
+        # if nothing would be written in the file, don't create it
+        if written:
+            if progress is not None:
+                progress('Writing workbook')
+            ProcessPool.submit(
+                write_workbook, f'{self.exp_fol}/{self.item.name}.xlsx',
+                f.fileName(), self.pre, self.post).result()
+
+    def _prepare(self, sheets: BinaryIO, progress: Callable) -> bool:
+        """Reads and processes each periodicity, adding the sheets to be
+        written to the open file sheets. Returns True if any sheets were
+        added."""
+        written = False
+        periodicities = self.meta['periodicities']
+        for i, per in enumerate(periodicities):
             log.debug(f'Exporting periodicity {per}')
             per_path = f'{self.comp_path}/{per}'
             # if skip_no_diffs option is checked and the periodicity
@@ -191,41 +328,371 @@ class Export():
             if self.options.skip_no_diffs() and \
                     not MetaDict(per_path)['different']:
                 continue
-            # if it does have differences then read and process the pre and
-            # post dataframes then check again for differences as they may
-            # not have differences within the filtered dates.
-            log.debug('Reading pre')
-            pre = self._read_vis(
-                f'positions/{self.pre}/{self.item.name}/{per}')
-            log.debug('Reading post')
-            post = self._read_vis(
-                f'positions/{self.post}/{self.item.name}/{per}')
-            log.debug('Processing pre')
-            post = self._process_vis(post, per)
+            if progress is not None:
+                progress(f'Exporting {per} ({i+1}/{len(periodicities)})')
+            # if it does have differences then read and process the pre,
+            # post and compared dataframes then check again for differences
+            # as they may not have differences within the filtered dates.
+            pre_data, post_data, compared = self._read_data(per, per_path)
             log.debug('Processing post')
-            pre = self._process_vis(pre, per)
+            post = self._process_vis(post_data, per)
+            log.debug('Processing pre')
+            pre = self._process_vis(pre_data, per)
+            log.debug('Reading compared')
+            diff, status, labels, unchanged, summary = self._get_compared(
+                per_path, pre_data, post_data, compared)
+            del pre_data, post_data, compared
             if self.options.date_filter() and self.options.skip_no_diffs() and \
-                    not self._has_differences(pre, post):
+                    not self._has_differences(pre, post, diff, status):
                 continue
-            log.debug('Reading compared')
-            diff, nans = self._get_compared(per_path)
             log.debug('Processing compared')
-            pre, post, diff = self._process_comparison(
-                pre, post, diff, nans, per)
+            pre, post, diff, status = self._process_comparison(
+                pre, post, diff, status, per, unchanged, summary)
             if self.options.pre_sheet():
-                self._write_sheet(f'{self.pre} ({per})',
-                                  pre, self.pre_style)
+                self._add_sheet(sheets, 'write_sheet',
+                                name=f'{self.pre} ({per})', df=pre,
+                                style='pre')
             if self.options.post_sheet():
-                self._write_sheet(f'{self.post} ({per})',
-                                  post, self.post_style)
-            self._write_sheet(f'Differences ({per})', diff, self.diff_style,
-                              difference=True)
+                self._add_sheet(sheets, 'write_sheet',
+                                name=f'{self.post} ({per})', df=post,
+                                style='post')
+            self._add_sheet(sheets, 'write_sheet',
+                            name=f'Differences ({per})', df=diff,
+                            style='diff', difference=True, status=status,
+                            labels=labels)
+            written = True
         if self.options.meta_sheet():
-            self._write_meta()
+            self._add_sheet(
+                sheets, 'write_meta', desc=self.desc,
+                file=TempFile.saved_path, user=os.getlogin(),
+                pre_meta=dict(MetaDict(
+                    f'positions/{self.pre}/{self.item.name}')),
+                post_meta=dict(MetaDict(
+                    f'positions/{self.post}/{self.item.name}')))
+        return written
+
+    def _add_sheet(self, sheets: BinaryIO, method: str, **kwargs) -> None:
+        """Adds a sheet to the file sheets, written by calling the
+        WorkbookWriter method with kwargs"""
+        pickle.dump((method, kwargs), sheets, pickle.HIGHEST_PROTOCOL)
+
+    def _date_range(self) -> tuple:
+        """Returns the (from, to) dates of the date filter as timestamps,
+        or None if dates aren't filtered"""
+        if not self.options.date_filter():
+            return None
+        return (pd.Timestamp(self.options.date_filter_from()),
+                pd.Timestamp(self.options.date_filter_to()))
+
+    def _read_vis(self, path: str) -> pd.DataFrame:
+        """Read a visualisation dataframe from the .opticord file at the
+        given path. Only the dates within the date filter are read."""
+        return read_frame(path, self._date_range())
+
+    def _read_data(self, per: str, path: str) -> tuple:
+        """Returns pre and post's data for the periodicity per, along with
+        the comparison at path as a tuple (diff, status, unchanged,
+        summary) if it was kept in the ResultCache when compared, None if
+        it wasn't, in a tuple (pre, post, compared). The summary is None
+        if dates are filtered."""
+        dates = self._date_range()
+        entry = ResultCache.get((self.pre, self.post, self.item.name, per))
+        if entry is not None:
+            log.debug('Using the data kept when compared')
+            # shallow copies so the cached dataframes are left unchanged
+            pre, post, diff, status = [
+                select_dates(entry[name], dates).copy(deep=False)
+                for name in ['pre', 'post', 'data', 'status']]
+            summary = entry['summary'] if dates is None else None
+            return pre, post, (diff, status, entry['unchanged'].copy(),
+                               summary)
+        log.debug('Reading post')
+        post = self._read_vis(f'positions/{self.post}/{self.item.name}/{per}')
+        if MetaDict(path).get('identical'):
+            # pre holds the same data as post
+            return post, post, None
+        log.debug('Reading pre')
+        pre = self._read_vis(f'positions/{self.pre}/{self.item.name}/{per}')
+        return pre, post, None
+
+    def _has_differences(self, pre: pd.DataFrame, post: pd.DataFrame,
+                         diff: pd.DataFrame, status: pd.DataFrame) -> bool:
+        """Returns true if differences are found between pre and post,
+        false if not, using their difference and its status codes."""
+        # the same dates in a different order are still a difference
+        if pre.columns.tolist() != post.columns.tolist():
+            return True
+        # series in only one of pre or post have a status other than
+        # BOTH_NAN, so are a difference
+        return not ((diff.to_numpy() == 0.0) |
+                    (status.to_numpy() == Status.BOTH_NAN)).all()
+
+    def _get_compared(self, path: str, pre: pd.DataFrame,
+                      post: pd.DataFrame, compared: tuple = None) -> tuple:
+        """Read the comparison data dataframe as well as the status
+        dataframe from the .opticord file base at the given path, unless
+        already given as the tuple compared from _read_data.
+        Returns both as pandas dataframes along with the string for each
+        status code, the index of the unchanged series left out of them
+        and the summary of diff's series saved when compared in a tuple
+        (diff, status, labels, unchanged, summary). The summary is None if
+        dates are filtered, as it's of all dates, or it wasn't saved."""
+        meta = MetaDict(path)
+        unchanged = np.zeros(len(post), dtype=bool)
+        summary = None
+        if compared is not None:
+            diff, status, unchanged, summary = compared
+            labels = status_labels(self.pre, self.post)
+        elif meta.get('identical'):
+            # saved without data as pre and post are the same
+            diff = pd.DataFrame(index=post.index[:0], columns=post.columns,
+                                dtype=float)
+            status = diff.astype(np.int8)
+            labels = status_labels(self.pre, self.post)
+            unchanged[:] = True
+        else:
+            labels = meta.get('status_labels')
+            dates = self._date_range()
+            diff = read_frame(f'{path}/data', dates)
+            if labels is not None:
+                status = read_frame(f'{path}/status', dates)
+            else:
+                # compared before status codes, so has a nans dataframe
+                nans = read_frame(f'{path}/nans', dates)
+            TempFile.manager.lockForRead()
+            with TempFile.store() as store:
+                # only saved by comparisons that leave out unchanged series
+                if 'unchanged' in store[path]:
+                    bits = store[f'{path}/unchanged']
+                    unchanged = np.unpackbits(
+                        bits[()], count=bits.attrs['rows']).astype(bool)
+                summarised = 'summary' in store[path]
+            TempFile.manager.unlock()
+            if dates is None and summarised:
+                # saved in the same order as diff's rows
+                summary = read_table(f'{path}/summary')
+                summary.index = diff.index
+            if labels is None:
+                # the nans hold the names the positions had when compared,
+                # they may have been renamed since
+                labels = status_labels(
+                    *self.meta.get('positions', [self.pre, self.post]))
+                status = self._encode_nans(nans, labels)
+        if unchanged.any() and not self.options.excl_zero_series():
+            diff, status = self._restore_unchanged(
+                pre, post, diff, status, unchanged)
+            unchanged[:] = False
+        return diff, status, labels, post.index[unchanged], summary
+
+    def _restore_unchanged(self, pre: pd.DataFrame, post: pd.DataFrame,
+                           diff: pd.DataFrame, status: pd.DataFrame,
+                           unchanged: np.ndarray) -> tuple:
+        """Returns diff and status with the unchanged series rebuilt from
+        post, in the order they were compared in."""
+        same = post[unchanged].reindex(columns=diff.columns)
+        values = same.to_numpy(dtype=float)
+        nan = np.isnan(values)
+        same_diff = pd.DataFrame(np.where(nan, np.nan, 0.0),
+                                 index=same.index, columns=diff.columns)
+        same_status = pd.DataFrame(
+            np.where(nan, Status.BOTH_NAN, Status.EQUAL).astype(np.int8),
+            index=same.index, columns=diff.columns)
+        pre, post = self._align_index(pre, post)
+        index, _, _ = align_axis(pre.index, post.index)
+        diff = pd.concat([diff, same_diff]).reindex(index)
+        status = pd.concat([status, same_status]).reindex(index)
+        return diff, status
+
+    def _encode_nans(self, nans: pd.DataFrame,
+                     labels: list) -> pd.DataFrame:
+        """Converts a nans dataframe of strings to status codes. Cells
+        that weren't NaN in the difference are all coded as different."""
+        codes = {label: code for code, label in enumerate(labels)
+                 if code >= Status.MISSING_PRE}
+        return nans.apply(lambda col: col.map(codes)).fillna(
+            Status.DIFFERENT).astype(np.int8)
+
+    def _process_vis(self, df: pd.DataFrame, per: str) -> pd.DataFrame:
+        """Processes visualisation data and returns it ready to be written
+        in a sheet. The nan values are left as floats for the analysis
+        columns and only written as '.'."""
+        # a shallow copy so the columns of the dataframe read are unchanged
+        df = self._convert_columns(df.copy(deep=False), per)
+        return df
+
+    def _process_comparison(self, pre: pd.DataFrame, post: pd.DataFrame,
+                            diff: pd.DataFrame, status: pd.DataFrame,
+                            per: str, unchanged: pd.Index,
+                            summary: pd.DataFrame = None) -> tuple:
+        """Processes the comparison data and returns it ready to be written
+        in a sheet, with the status codes of diff's cells as an array."""
+        # make sure pre and post have the same index order
+        pre, post = self._align_index(pre, post)
+        # the chosen dates were already filtered when reading
+        diff = self._convert_columns(diff, per)
+        # add the analysis columns to the index
+        diff = self._add_analysis(pre, post, diff, summary)
+        # from here on the codes match diff's cells by position
+        status = status.to_numpy()
+        if self.options.missing_data():
+            diff = self._add_missing_data_col(diff, status)
+        if self.options.excl_zero_series():
+            pre, post, diff, status = self._drop_zero_series(
+                pre, post, diff, status, unchanged)
+        return pre, post, diff, status
+
+    def _align_index(self, pre: pd.DataFrame, post: pd.DataFrame) -> tuple:
+        """Reindex the pre dataframe so that it's in the same order as
+        post."""
+        # only re-order the index if there is more than one index column
+        if len(pre.index.names) + len(post.index.names) > 2:
+            pre = pre.reorder_levels(post.index.names, axis=0)
+        return pre, post
+
+    def _drop_zero_series(self, pre: pd.DataFrame, post: pd.DataFrame,
+                          diff: pd.DataFrame, status: np.ndarray,
+                          unchanged: pd.Index) -> tuple:
+        """Returns pre, post and diff dataframes and diff's status codes
+        with series that have no differences removed. The unchanged series
+        were left out of diff when compared so are only removed from pre
+        and post."""
+        # a series has no differences if every value is the same or nan
+        # in both pre and post
+        no_diffs = ((diff.to_numpy() == 0.0) |
+                    (status == Status.BOTH_NAN)).all(axis=1)
+        # get the index names that aren't in pre or post dataframes
+        extra_idxs = [
+            col for col in diff.index.names if col not in post.index.names]
+        # find idxs of rows that have no diffs without the extra idxs
+        idxs_to_drop = diff.index[no_diffs]
+        if extra_idxs:
+            idxs_to_drop = idxs_to_drop.droplevel(extra_idxs)
+        idxs_to_drop = idxs_to_drop.append(unchanged)
+        # drop the rows with no differences
+        pre = pre.drop(idxs_to_drop)
+        post = post.drop(idxs_to_drop)
+        diff = diff[~no_diffs]
+        return pre, post, diff, status[~no_diffs]
+
+    def _add_missing_data_col(self, df: pd.DataFrame,
+                              status: np.ndarray) -> pd.DataFrame:
+        """Creates the "Missing Data" analysis columns and adds it to the
+        given dataframe, using the status codes of its cells to tell where
+        the data is missing."""
+        # a single pass over the codes gives the codes in each row as the
+        # bits of a mask, so each check below only looks at one per row
+        codes = status_bits(status)
+
+        def _rows(code: int) -> np.ndarray:
+            """Returns True for the rows with a cell of the given code"""
+            return (codes & (1 << code)) != 0
+        missing_pre = _rows(Status.MISSING_PRE)
+        missing_post = _rows(Status.MISSING_POST)
+        # Detect whether or not there are any dates missing
+        # and set the default missing value respectively
+        dates_missing = (_rows(Status.DATE_NOT_IN_PRE) |
+                         _rows(Status.DATE_NOT_IN_POST)).any()
+        missing = np.full(len(df), 'Date' if dates_missing else 'None',
+                          dtype=object)
+        # The below sets the value of Missing data in an if elif fashion so
+        # order is important.
+        missing[missing_pre] = self.pre
+        missing[missing_post] = self.post
+        missing[_rows(Status.SERIES_NOT_IN_PRE)] = self.pre
+        missing[_rows(Status.SERIES_NOT_IN_POST)] = self.post
+        missing[missing_pre & missing_post] = 'Both'
+        # return the dataframe with missing data set as an index
+        df['Missing Data'] = missing
+        return df.set_index('Missing Data', append=True)
+
+    def _convert_columns(self, df: pd.DataFrame, per: str) -> pd.DataFrame:
+        """Converts the columns in a dataframe for datetime to
+        string format based on the periodicity per and returns the
+        dataframe."""
+        df.columns = date_labels(df.columns, per)
+        return df
+
+    def _add_analysis(self, pre: pd.DataFrame, post: pd.DataFrame,
+                      diff: pd.DataFrame,
+                      summary: pd.DataFrame = None) -> None:
+        """Adds all analysis columns selected by user to the given
+        dataframe 'df' and returns it. The metrics of the series in the
+        summary saved when compared are read from it if given."""
+        # the metrics of the options that are on, in the order of the
+        # options
+        headers = [option.metric for name, option in vars(ExportOptions).items()
+                   if isinstance(option, ExportOption) and
+                   option.metric is not None and getattr(self.options, name)()]
+        if summary is not None and summary.index.is_unique and \
+                set(headers) <= set(summary.columns):
+            columns = self._summarised(headers, pre, diff, summary)
+        else:
+            columns = self._analyse(headers, pre, diff)
+        analysis = pd.DataFrame(columns, index=diff.index)
+        # tidy up analysis before adding to diff
+        analysis = analysis.fillna('').replace(np.inf, 'inf')
+        # better for performance to add new columns to a small dataframe
+        # and then concatenate all at once to the large dataframe.
+        diff = pd.concat((analysis, diff), axis=1)
+        diff = diff.set_index(analysis.columns.tolist(), append=True)
+        return diff
+
+    def _analyse(self, headers: list, pre: pd.DataFrame,
+                 diff: pd.DataFrame) -> dict:
+        """Returns the metric of each of headers for every row of diff"""
+        pre_values = None
+        if uses_pre(headers):
+            pre_values = self._pre_values(pre, diff)
+        return analyse(headers, diff.to_numpy(dtype=float), diff.columns,
+                       pre_values)
+
+    def _summarised(self, headers: list, pre: pd.DataFrame,
+                    diff: pd.DataFrame, summary: pd.DataFrame) -> dict:
+        """Returns the metric of each of headers for every row of diff,
+        read from the summary where it has the row. Only the unchanged
+        series left out of the summary are analysed."""
+        rows = summary.index.get_indexer(diff.index)
+        found = rows >= 0
+        columns = from_summary(summary.iloc[rows[found]], headers,
+                               diff.columns)
+        if found.all():
+            return columns
+        rest = self._analyse(headers, pre, diff[~found])
+        for header in headers:
+            values = np.empty(len(diff), dtype=np.result_type(
+                columns[header], rest[header]))
+            values[found] = columns[header]
+            values[~found] = rest[header]
+            columns[header] = values
+        return columns
+
+    def _pre_values(self, pre: pd.DataFrame,
+                    diff: pd.DataFrame) -> np.ndarray:
+        """Returns pre's values as floats in the rows and columns of diff,
+        NaN where they're missing"""
+        rows = pre.index.get_indexer(diff.index)
+        cols = pre.columns.get_indexer(diff.columns)
+        padded = np.full((pre.shape[0]+1, pre.shape[1]+1), np.nan)
+        padded[:-1, :-1] = pre.to_numpy(dtype=float)
+        # -1 picks the padding row and column
+        return padded[np.ix_(rows, cols)]
+
+
+class WorkbookWriter():
+    """Writes the sheets of an export to an xlsx file, a row at a time"""
+    # rows of a sheet converted for writing at a time
+    BLOCK_ROWS = 10000
+
+    def __init__(self, path: str, pre: str, post: str) -> None:
+        self.pre = pre
+        self.post = post
+        # constant memory writes each row to disk as soon as the next is
+        # started, so sheets must be written a row at a time in order
+        self.wb = xlsxwriter.Workbook(path, {'constant_memory': True})
+        self._create_formats()
+
+    def close(self) -> None:
         self.wb.close()
-        # if nothing has been written in the file, delete it
-        if not self.written:
-            os.remove(f'{self.exp_fol}/{self.item.name}.xlsx')
 
     def _create_formats(self) -> None:
         """Creates the formats and styling for the output Excel sheet."""
@@ -286,222 +753,57 @@ class Export():
             'align': 'left',
             'num_format': 'd/m/yyyy, hh:MM AM/PM'})
 
-        self.pre_style = 'Table Style Medium 6'
-        self.post_style = 'Table Style Medium 7'
-        self.diff_style = 'Table Style Medium 1'
-
-    def _read_vis(self, path: str) -> pd.DataFrame:
-        """Read a visualisation dataframe from the .opticord file at the
-        given path."""
-        TempFile.manager.lockForWrite()
-        df = pd.read_hdf(TempFile.path, path)
-        TempFile.manager.unlock()
-        # Best to fill the nan values with '.' now for excel writing
-        return df.fillna('.')
-
-    def _has_differences(self, pre: pd.DataFrame, post: pd.DataFrame) -> bool:
-        """Returns true if differences are found between pre and post,
-        false if not."""
-        # independantly check the columns as pd.equals only checks shape
-        # and values
-        if pre.columns.tolist() != post.columns.tolist():
-            return True
-        # independantly check the index for the same reasons as above
-        if not pre.sort_index().index.equals(post.sort_index().index):
-            return True
-        return not post.sort_index().equals(pre.sort_index())
-
-    def _get_compared(self, path: str) -> tuple:
-        """Read the comparison data dataframe as well as the nans dataframe
-        from the .opticord file base at the given path.
-        Returns both as pandas dataframes in a tuple (diff, nans)."""
-        TempFile.manager.lockForWrite()
-        diff = pd.read_hdf(TempFile.path, f'{path}/data')
-        nans = pd.read_hdf(TempFile.path, f'{path}/nans')
-        TempFile.manager.unlock()
-        return diff, nans
-
-    def _process_vis(self, df: pd.DataFrame, per: str) -> pd.DataFrame:
-        """Processes visualisation data and returns it ready to be written
-        in a sheet."""
-        if self.options.date_filter():
-            df = self._apply_date_filter(df)
-        df = self._convert_columns(df, per)
-        return df
-
-    def _process_comparison(self, pre: pd.DataFrame, post: pd.DataFrame,
-                            diff: pd.DataFrame, nans: pd.DataFrame,
-                            per: str) -> pd.DataFrame:
-        """Processes the comparison data and returns it ready to be written
-        in a sheet."""
-        # make sure pre and post have the same index order
-        pre, post = self._align_index(pre, post)
-        # filter out the chosen dates is opted for
-        if self.options.date_filter():
-            diff = self._apply_date_filter(diff)
-            nans = self._apply_date_filter(nans)
-        diff = self._convert_columns(diff, per)
-        nans = self._convert_columns(nans, per)
-        # add the analysis columns to the index
-        diff = self._add_analysis(pre, post, diff)
-        # recombine difference and configured nans dataframes
-        diff[diff.isna()] = nans
-        # add missing data col, only possible after nans have been replaced
-        if self.options.missing_data():
-            diff = self._add_missing_data_col(diff)
-        if self.options.excl_zero_series():
-            pre, post, diff = self._drop_zero_series(pre, post, diff)
-        return pre, post, diff
-
-    def _align_index(self, pre: pd.DataFrame, post: pd.DataFrame) -> tuple:
-        """Reindex the pre dataframe so that it's in the same order as
-        post."""
-        # only re-order the index if there is more than one index column
-        if len(pre.index.names) + len(post.index.names) > 2:
-            pre = pre.reorder_levels(post.index.names, axis=0)
-        return pre, post
-
-    def _drop_zero_series(self, pre: pd.DataFrame, post: pd.DataFrame,
-                          diff: pd.DataFrame) -> tuple:
-        """Returns pre, post and diff dataframes with series that have no
-        differences removed."""
-        # get the index names that aren't in pre or post dataframes
-        extra_idxs = [
-            col for col in diff.index.names if col not in post.index.names]
-        # make a new version of diff with the extra idxs removed
-        search_diff = diff.reset_index().drop(extra_idxs, axis=1)
-        search_diff = search_diff.set_index(post.index.names).replace('.', 0.0)
-        # search through modified diff to find idxs of rows that have no diffs
-        idxs_to_drop = search_diff[(search_diff == 0.0).all(axis=1)].index
-        # remove the modified diff df from memory
-        del(search_diff)
-        # search through the normal diff to find idxs of rows without diffs
-        diff_idxs_to_drop = diff[(diff.replace(
-            '.', 0.0) == 0.0).all(axis=1)].index
-        # drop the rows with no differences
-        pre = pre.drop(idxs_to_drop)
-        post = post.drop(idxs_to_drop)
-        diff = diff.drop(diff_idxs_to_drop)
-        return pre, post, diff
-
-    def _apply_date_filter(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Drop all dates from the given dataframe outside of the 
-        user specified range."""
-        df.columns = pd.to_datetime(df.columns)
-        date_from = self.options.date_filter_from()
-        date_to = self.options.date_filter_to()
-        df = df[[c for c in df.columns if c >= date_from and c <= date_to]]
-        return df
-
-    def _add_missing_data_col(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Creates the "Missing Data" analysis columns and adds it to the
-        given dataframe. Must be done after df has configured nans as it
-        relies on their string values to tell where the data is missing."""
-        # stack the dataframe and cast values to type str
-        # this turns the dataframe into a series and allows us to use .str
-        stacked = df.astype(str).stack()
-        # Find values which match the appropriate missing data string. Cells
-        # where a match was found will be True, everywhere else will be False.
-        # Replace the False values with np.nan and drop them from the series.
-        # Unstack the dataframe otherwise the date column will be an index,
-        # this leaves us with the index of the original df where all rows that
-        # do not contain a match of the desired string have been dropped.
-        missing_pre = stacked.str.fullmatch(
-            f'Missing in {self.pre}').replace(
-            False, np.nan).dropna().unstack().index
-        missing_post = stacked.str.fullmatch(
-            f'Missing in {self.post}').replace(
-            False, np.nan).dropna().unstack().index
-        series_missing_pre = stacked.str.fullmatch(
-            f'Series not in {self.pre}').replace(
-            False, np.nan).dropna().unstack().index
-        series_missing_post = stacked.str.fullmatch(
-            f'Series not in {self.post}').replace(
-            False, np.nan).dropna().unstack().index
-        # get the index for both from the intersection of the missing_pre/post
-        missing_both = missing_pre.intersection(missing_post)
-        # Detect whether or not there are any dates missing
-        # and set the default missing value respectively
-        missing_col = pd.DataFrame(index=df.index, columns=['Missing Data'])
-        if stacked.str.match('Date not in').any():
-            missing_col['Missing Data'] = 'Date'
-        else:
-            missing_col['Missing Data'] = 'None'
-        df = pd.concat([df, missing_col], axis=1)
-        # The below sets the value of Missing data in an if elif fashion so
-        # order is important.
-        df.loc[missing_pre, 'Missing Data'] = self.pre
-        df.loc[missing_post, 'Missing Data'] = self.post
-        df.loc[series_missing_pre, 'Missing Data'] = self.pre
-        df.loc[series_missing_post, 'Missing Data'] = self.post
-        df.loc[missing_both, 'Missing Data'] = 'Both'
-        # return the dataframe with missing data set as an index
-        return df.set_index('Missing Data', append=True)
+        # tables can't be written a row at a time, so the colours of
+        # Table Style Medium 6, 7 and 1 are applied to the sheet's range
+        self.styles = {'pre': self._table_style('#4BACC6', '#DAEEF3'),
+                       'post': self._table_style('#F79646', '#FDE9D9'),
+                       'diff': self._table_style('#000000', '#D9D9D9')}
 
-    def _convert_columns(self, df: pd.DataFrame, per: str) -> pd.DataFrame:
-        """Converts the columns in a dataframe for datetime to
-        string format based on the periodicity per and returns the
-        dataframe."""
-        # ensure columns are of datetime format
-        df.columns = df.columns.astype('datetime64[ns]')
-        # convert them to strings
-        if per == "A":
-            df.columns = df.columns.strftime("%Y")
-        if per == "Q":
-            df.columns = df.columns.to_period("Q").astype(str)
-        if per == "M":
-            df.columns = df.columns.strftime("%Y%b")
-        return df
+    def _table_style(self, header_color: str, band_color: str) -> dict:
+        """Returns the formats of a sheet's header row and every other
+        row of its data, in a dict with keys 'header' and 'band'"""
+        return {
+            'header': self.wb.add_format({
+                'bold': True,
+                'font_color': '#FFFFFF',
+                'bg_color': header_color}),
+            'band': self.wb.add_format({'bg_color': band_color})}
 
-    def _add_analysis(self, pre: pd.DataFrame, post: pd.DataFrame,
-                      diff: pd.DataFrame) -> None:
-        """Adds all analysis columns selected by user to the given
-        dataframe 'df' and returns it."""
-        analysis = pd.DataFrame()
-
-        if self.options.total_diff():
-            analysis['Total Diff'] = diff.sum(axis=1)
-        if self.options.total_abs_diff():
-            analysis['Total ABS Diff'] = diff.abs().sum(axis=1)
-        if self.options.max_abs_diff():
-            analysis['Max ABS Diff'] = diff.abs().max(axis=1)
-        if self.options.max_abs_perc_diff():
-            analysis['Max ABS % Diff'] = diff.div(
-                pre.replace('.', np.nan)
-            ).fillna(0.0).mul(100).abs().max(axis=1).round(1)
-        if self.options.max_abs_diff_date():
-            analysis['Max ABS Diff Date'] = diff.abs().idxmax(
-                axis=1)
-        # tidy up analysis before adding to diff
-        analysis = analysis.fillna('').replace(np.inf, 'inf')
-        # better for performance to add new columns to a small dataframe
-        # and then concatenate all at once to the large dataframe.
-        diff = pd.concat((analysis, diff), axis=1)
-        diff = diff.set_index(analysis.columns.tolist(), append=True)
-        return diff
+    def _sheet_rows(self, df: pd.DataFrame, status: np.ndarray = None,
+                    labels: list = None) -> Iterator[list]:
+        """Yields each row of df with its index as a list of the values
+        to write, converting BLOCK_ROWS rows at a time. If given, the
+        NaNs in df are replaced with the labels of their status codes,
+        otherwise they're written as '.'."""
+        idx_cols = len(df.index.names)
+        if labels is not None:
+            labels = np.array(labels, dtype=object)
+        for start in range(0, len(df), WorkbookWriter.BLOCK_ROWS):
+            stop = start + WorkbookWriter.BLOCK_ROWS
+            block = df.iloc[start:stop]
+            values = block.reset_index().to_numpy(dtype=object)
+            cells = values[:, idx_cols:]
+            if status is not None:
+                # the codes are only converted to strings as they're written
+                codes = status[start:stop]
+                nan_cells = codes >= Status.MISSING_PRE
+                cells[nan_cells] = labels[codes[nan_cells]]
+            else:
+                cells[block.isna().to_numpy()] = '.'
+            yield from values.tolist()
 
-    def _write_sheet(self, name: str, df: pd.DataFrame,
-                     table_style: str = 'Table Style Medium 1',
-                     difference: bool = False) -> None:
-        """Creates a new sheet with given name and writes 'df' as a 
-        formatted table."""
+    def write_sheet(self, name: str, df: pd.DataFrame, style: str,
+                    difference: bool = False, status: np.ndarray = None,
+                    labels: list = None) -> None:
+        """Creates a new sheet with given name and writes 'df' a row at a
+        time, styled as a table with the formats of style 'pre', 'post' or
+        'diff'. If given, the NaNs in df are written as the labels of
+        their status codes."""
         log.debug(f'Writing sheet: {name}')
-
-        def _format() -> list:
-            format_list = []
-            for idx in df.index.names:
-                options = dict()
-                options['header'] = idx
-                options['format'] = self.idx_format
-                format_list.append(options)
-            for col in df.columns:
-                options = dict()
-                options['header'] = col
-                format_list.append(options)
-            return format_list
+        style = self.styles[style]
 
         def _set_col_widths():
-            for i, col in enumerate(df.columns.tolist()):
+            for i, col in enumerate(header):
                 # width is dynamic but has max of 16 and min of 8
                 width = min(max(len(col) + 3, 8), 16)
                 ws.set_column(i, i, width)
@@ -543,40 +845,47 @@ class Export():
                                    'value': f'"Missing in {self.post}"',
                                    'format': self.missing_post_format})
 
-        self.written = True
         ws = self.wb.add_worksheet(name)
-        column_format = _format()
         idx_cols = df.index.names
-        df = df.reset_index()
-        nrows, ncols = df.values.shape
-        ws.add_table(0, 0, nrows, ncols-1, {
-            'columns': column_format,
-            'data': df.values,
-            'style': table_style
-        })
+        nrows = len(df)
+        ncols = len(idx_cols) + len(df.columns)
+        header = [str(col) if col is not None else ''
+                  for col in [*idx_cols, *df.columns]]
+        ws.write_row(0, 0, header, style['header'])
+        for row, values in enumerate(
+                self._sheet_rows(df, status, labels), start=1):
+            ws.write_row(row, 0, values[:len(idx_cols)], self.idx_format)
+            ws.write_row(row, len(idx_cols), values[len(idx_cols):])
         _set_col_widths()
-        if difference:
-            _conditional_formatting()
+        ws.autofilter(0, 0, nrows, ncols-1)
+        if nrows:
+            if difference:
+                _conditional_formatting()
+            # added last so the formats above take precedence
+            ws.conditional_format(1, 0, nrows, ncols-1,
+                                  {'type': 'formula',
+                                   'criteria': '=MOD(ROW(),2)=0',
+                                   'format': style['band']})
         ws.freeze_panes(1, len(idx_cols))
 
-    def _write_meta(self) -> None:
-        """Write the metadata sheet for the comparison."""
+    def write_meta(self, desc: list, file: str, user: str,
+                   pre_meta: dict, post_meta: dict) -> None:
+        """Write the metadata sheet for the comparison of the file by
+        user, with pre and post's metadata."""
         log.debug('Writing metadata')
-        pre_meta = MetaDict(f'positions/{self.pre}/{self.item.name}')
-        post_meta = MetaDict(f'positions/{self.post}/{self.item.name}')
         ws = self.wb.add_worksheet('MetaData')
         r = 0
         ws.write(r, 0, 'OptiCORD File:', self.meta_idx_format)
-        ws.write(r, 1, TempFile.saved_path, self.meta_val_format)
+        ws.write(r, 1, file, self.meta_val_format)
         r += 1
         ws.write(r, 0, 'Exported By:', self.meta_idx_format)
-        ws.write(r, 1, os.getlogin(), self.meta_val_format)
+        ws.write(r, 1, user, self.meta_val_format)
         r += 1
         ws.write(r, 0, 'Exported:', self.meta_idx_format)
         ws.write_datetime(r, 1, datetime.now(), self.meta_val_format)
         r += 1
         ws.write(r, 0, 'Description:', self.meta_idx_format)
-        for line in self.desc:
+        for line in desc:
             ws.write(r, 1, line, self.meta_val_format)
             r += 1
         r += 1
@@ -586,8 +895,7 @@ class Export():
         ws.write(r, 4, self.post, self.meta_post_val_format)
         r += 1
 
-        def _write_pos_meta(sub_r: int, col: int, pos: dict,
-                            idx_format, val_format) -> None:
+        def _pos_meta_rows(pos: dict) -> list:
             # order that the metadata will be written
             order = ['Downloaded', 'Statistical Activity', 'Mode',
                      'Status', 'Dataset', 'Dimensions', 'Periodicities']
@@ -599,34 +907,45 @@ class Export():
             # ensure any extra metadata items are added
             for key, val in pos.items():
                 ordered[key] = val
-            # write items from the  ordered dictionary
+            # list the (key, value) of each row from the ordered dictionary
+            rows = []
             for key, val in ordered.items():
                 # Convert Downloaded to datetime since datetime format isn't
                 # supported in h5.
                 if key == 'Downloaded':
                     val = datetime.fromtimestamp(val)
                 key += ':'
-                ws.write(sub_r, col, key, idx_format)
                 if type(val) is np.ndarray:
                     val = val.tolist()
                 if type(val) is dict:
-                    ws.write(sub_r, col+1, '', val_format)
-                    for sub_key, sub_val in val.items():
-                        sub_r += 1
-                        ws.write(sub_r, col, sub_key, idx_format)
-                        ws.write(sub_r, col+1, sub_val, val_format)
+                    rows.append((key, ''))
+                    rows.extend(val.items())
                 elif type(val) is list:
-                    ws.write(sub_r, col+1, (', '.join(val)), val_format)
-                elif type(val) is datetime:
-                    ws.write_datetime(sub_r, col+1, val, val_format)
+                    rows.append((key, ', '.join(val)))
                 else:
-                    ws.write(sub_r, col+1, val, val_format)
-                sub_r += 1
+                    rows.append((key, val))
+            return rows
+
+        def _write_pos_meta(sub_r: int, col: int, row: tuple,
+                            idx_format, val_format) -> None:
+            key, val = row
+            ws.write(sub_r, col, key, idx_format)
+            if type(val) is datetime:
+                ws.write_datetime(sub_r, col+1, val, val_format)
+            else:
+                ws.write(sub_r, col+1, val, val_format)
 
-        _write_pos_meta(r, 0, pre_meta, self.meta_pre_idx_format,
-                        self.meta_pre_val_format)
-        _write_pos_meta(r, 3, post_meta, self.meta_post_idx_format,
-                        self.meta_post_val_format)
+        # rows have to be written in order, so pre and post's metadata are
+        # written side by side
+        for pre_row, post_row in zip_longest(_pos_meta_rows(pre_meta),
+                                             _pos_meta_rows(post_meta)):
+            if pre_row is not None:
+                _write_pos_meta(r, 0, pre_row, self.meta_pre_idx_format,
+                                self.meta_pre_val_format)
+            if post_row is not None:
+                _write_pos_meta(r, 3, post_row, self.meta_post_idx_format,
+                                self.meta_post_val_format)
+            r += 1
 
         ws.set_column(0, 0, width=25)
         ws.set_column(1, 1, width=40)
@@ -634,6 +953,23 @@ class Export():
         ws.set_column(4, 4, width=40)
 
 
+def write_workbook(path: str, sheets_path: str, pre: str,
+                   post: str) -> None:
+    """Writes the sheets Export added to the file at sheets_path to an
+    xlsx file at path, run in the ProcessPool by Export"""
+    writer = WorkbookWriter(path, pre, post)
+    with open(sheets_path, 'rb') as sheets:
+        while True:
+            try:
+                method, kwargs = pickle.load(sheets)
+            except EOFError:
+                break
+            getattr(writer, method)(**kwargs)
+            # only one sheet is held at a time
+            del kwargs
+    writer.close()
+
+
 """
 # I attempted to add the analysis columns in as Excel formulas but unfortunately
 # Excel was automatically adding in an "@" before the table name which
@@ -0,0 +1,352 @@
+"""The frames.py module contains objects for storing dataframes in the
+TempFile with h5py, in a chunked layout that can be read a block of rows
+or a range of dates at a time rather than all at once.
+
+A stored frame is a group holding:
+    values  2-D dataset of the frame's values, chunked into tiles of rows
+            and dates
+    index   2-D int32 dataset of each row's code for each dimension, -1
+            where the dimension is blank
+    dates   the column dates as int64 nanoseconds
+The label of each code is held in a dimensions group beside the frame,
+shared by every frame written with it, such as each periodicity of a
+visualisation.
+
+A table is a 2-D float64 dataset with the headers of its columns in its
+attributes, such as the summary of each row of a stored frame beside it.
+"""
+import json
+import logging
+from typing import List, Union
+import h5py
+import numpy as np
+import pandas as pd
+from util import TempFile
+
+log = logging.getLogger('OptiCORD')
+
+# attribute marking a group as a stored frame, holds the layout version
+LAYOUT = 'frame_layout'
+# target size of a compressed chunk of values in bytes
+CHUNK_BYTES = 2**18
+# most dates in a chunk so a range of dates only reads part of each row
+CHUNK_DATES = 64
+# zlib through h5py's built in gzip filter, blosc isn't available to h5py
+COMPRESSION = dict(compression='gzip', compression_opts=6, shuffle=True)
+
+
+def is_frame(node: Union[h5py.Group, h5py.Dataset]) -> bool:
+    """Returns True if the node is a frame stored by a FrameWriter"""
+    return LAYOUT in node.attrs
+
+
+def _chunks(dtype: np.dtype, dates: int) -> tuple:
+    """Returns the chunk shape of a values dataset"""
+    width = max(1, min(dates, CHUNK_DATES))
+    return (max(1, CHUNK_BYTES // (np.dtype(dtype).itemsize * width)), width)
+
+
+class Dimensions():
+    """Dictionary of the code of each label of each dimension, shared by
+    frames so a label is stored once however many frames it's in. Codes
+    are added as frames are written and saved once they're finished."""
+    # name of the group the dictionary is saved in, beside its frames
+    NAME = 'dimensions'
+    labels: dict  # code of each label, keyed by dimension name
+
+    def __init__(self) -> None:
+        self.labels = dict()
+
+    def levels(self, names: list) -> List[dict]:
+        """Returns the dictionary of each of the named dimensions"""
+        return [self.labels.setdefault(name, dict()) for name in names]
+
+    def save(self, parent: h5py.Group) -> None:
+        """Saves the dictionary under parent, replacing any earlier one"""
+        if Dimensions.NAME in parent:
+            del parent[Dimensions.NAME]
+        group = parent.create_group(Dimensions.NAME)
+        group.attrs[LAYOUT] = 1
+        group.attrs['names'] = json.dumps(list(self.labels))
+        for i, level in enumerate(self.labels.values()):
+            group.create_dataset(str(i), data=np.array(
+                [str(label) for label in level], dtype=object),
+                dtype=h5py.string_dtype())
+
+    def read(group: h5py.Group, names: list) -> List[pd.Index]:
+        """Returns the labels of each of the named dimensions from the
+        dictionary saved in group, indexed by code"""
+        saved = json.loads(group.attrs['names'])
+        return [pd.Index(group[str(saved.index(name))].asstr()[()],
+                         dtype=object) for name in names]
+
+
+class FrameWriter():
+    """Writes a frame into a group a block of rows at a time, coding the
+    labels of each dimension in a shared Dimensions dictionary. Only
+    holds paths so the TempFile can be unlocked between blocks."""
+    path: str  # path of the frame's group
+    levels: List[dict]  # code of each label of each dimension
+
+    def __init__(self, parent: h5py.Group, name: str, columns: pd.Index,
+                 names: list, dimensions: Dimensions,
+                 dtype: np.dtype = np.float64) -> None:
+        group = parent.create_group(name)
+        self.path = group.name
+        self.levels = dimensions.levels(names)
+        group.attrs[LAYOUT] = 1
+        group.attrs['names'] = json.dumps(list(names))
+        group.create_dataset('dates', data=pd.DatetimeIndex(
+            columns).asi8)
+        if len(columns):
+            group.create_dataset('values', (0, len(columns)), dtype=dtype,
+                                 maxshape=(None, len(columns)),
+                                 chunks=_chunks(dtype, len(columns)),
+                                 **COMPRESSION)
+        else:
+            # h5py can't chunk a dataset with no columns
+            group.create_dataset('values', (0, 0), dtype=dtype,
+                                 maxshape=(None, 0))
+        group.create_dataset('index', (0, len(names)), dtype=np.int32,
+                             maxshape=(None, len(names)),
+                             chunks=(max(1, CHUNK_BYTES // 4 //
+                                         max(1, len(names))),
+                                     max(1, len(names))),
+                             **COMPRESSION)
+
+    def append(self, store: h5py.File, df: pd.DataFrame) -> None:
+        """Appends the rows of df, which must have the frame's columns in
+        the same order"""
+        group = store[self.path]
+        start = group['values'].shape[0]
+        codes = np.empty((len(df), len(self.levels)), dtype=np.int32)
+        for i, level in enumerate(self.levels):
+            labels = df.index.get_level_values(i)
+            # factorize the block then map its uniques onto the codes so
+            # far, so each label is only looked up once per block
+            block_codes, uniques = pd.factorize(labels)
+            mapping = np.array(
+                [level.setdefault(label, len(level)) for label in uniques],
+                dtype=np.int32)
+            # factorize codes blank labels as -1, they stay -1
+            codes[:, i] = -1
+            found = block_codes >= 0
+            codes[found, i] = mapping[block_codes[found]]
+        for name, data in (('values', df.to_numpy()), ('index', codes)):
+            group[name].resize(start + len(df), axis=0)
+            group[name][start:] = data
+
+
+def write_frames(parent: h5py.Group, frames: dict) -> None:
+    """Writes each of the dataframes in frames to a stored frame under
+    parent named by its key, with one Dimensions dictionary between them"""
+    dimensions = Dimensions()
+    for name, df in frames.items():
+        writer = FrameWriter(
+            parent, name, df.columns, df.index.names, dimensions,
+            df.to_numpy().dtype if df.shape[1] else np.float64)
+        writer.append(parent.file, df)
+    dimensions.save(parent)
+
+
+class TableWriter():
+    """Writes a table of float columns named by headers a block of rows
+    at a time. Only holds the path of its dataset so the TempFile can be
+    unlocked between blocks."""
+    path: str  # path of the table's dataset
+
+    def __init__(self, parent: h5py.Group, name: str,
+                 headers: List[str]) -> None:
+        table = parent.create_dataset(
+            name, (0, len(headers)), dtype=np.float64,
+            maxshape=(None, len(headers)),
+            chunks=_chunks(np.float64, len(headers)), **COMPRESSION)
+        table.attrs['headers'] = json.dumps(list(headers))
+        self.path = table.name
+
+    def append(self, store: h5py.File, values: np.ndarray) -> None:
+        """Appends the rows of values, a column for each header"""
+        table = store[self.path]
+        start = table.shape[0]
+        table.resize(start + len(values), axis=0)
+        table[start:] = values
+
+
+def read_table(key: str) -> pd.DataFrame:
+    """Reads the whole table at key with a column for each header"""
+    TempFile.manager.lockForRead()
+    with TempFile.store() as store:
+        table = store[key]
+        df = pd.DataFrame(table[()],
+                          columns=json.loads(table.attrs['headers']))
+    TempFile.manager.unlock()
+    return df
+
+
+class StoredFrame():
+    """A frame stored in the TempFile, read a block of rows at a time
+    rather than all at once. Only the index and columns are held in
+    memory. Frames saved by pandas in fixed format before the stored
+    frame layout are read through PyTables."""
+    key: str  # path of the frame in the TempFile
+    index: pd.Index
+    columns: pd.Index
+    dtype: np.dtype  # dtype of the values
+    legacy: bool  # True if saved by pandas
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        TempFile.manager.lockForRead()
+        with TempFile.store() as store:
+            self.legacy = not is_frame(store[key])
+            if not self.legacy:
+                group = store[key]
+                self.columns = pd.DatetimeIndex(group['dates'][()])
+                self.index = self._build_index(group)
+                self.dtype = group['values'].dtype
+        TempFile.manager.unlock()
+        if self.legacy:
+            self._open_legacy()
+
+    def _build_index(self, group: h5py.Group) -> pd.Index:
+        """Rebuilds the index of a stored frame from its codes"""
+        names = json.loads(group.attrs['names'])
+        codes = group['index'][()]
+        levels = Dimensions.read(group.parent[Dimensions.NAME], names)
+        if len(names) == 1:
+            return pd.Index(levels[0].take(codes[:, 0], allow_fill=True,
+                                           fill_value=np.nan), name=names[0])
+        return pd.MultiIndex(levels=levels, codes=codes.T, names=names,
+                             verify_integrity=False)
+
+    def _open_legacy(self) -> None:
+        """Reads the index and columns of a frame saved by pandas"""
+        TempFile.manager.lockForRead()
+        with TempFile.released() as path, pd.HDFStore(path, 'r') as store:
+            storer = store.get_storer(self.key)
+            # axis0 is the columns of a frame and axis1 the index
+            self.index = storer.read_index('axis1')
+            self.columns = storer.read_index('axis0')
+            # position in columns of each column in each block of values
+            self._blocks = [
+                self.columns.get_indexer(storer.read_index(f'block{i}_items'))
+                for i in range(storer.nblocks)]
+            self.dtype = np.result_type(*[
+                store.get_node(f'{self.key}/block{i}_values').dtype
+                for i in range(storer.nblocks)] or [np.float64])
+        TempFile.manager.unlock()
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.index), len(self.columns))
+
+    def date_columns(self, dates: tuple) -> np.ndarray:
+        """Returns the positions of the columns from and to the dates in
+        the tuple (from, to), inclusive"""
+        date_from, date_to = dates
+        return np.flatnonzero((self.columns >= date_from) &
+                              (self.columns <= date_to))
+
+    def read(self, start: int = 0, stop: int = None,
+             cols: np.ndarray = None) -> np.ndarray:
+        """Returns the values of rows start to stop, only in the columns
+        at the increasing positions cols if given. Only the compressed
+        chunks holding those rows and columns are read."""
+        stop = len(self.index) if stop is None else stop
+        if not self.legacy:
+            TempFile.manager.lockForRead()
+            with TempFile.store() as store:
+                dataset = store[f'{self.key}/values']
+                if cols is None:
+                    values = dataset[start:stop]
+                elif not len(cols):
+                    values = dataset[start:stop, 0:0]
+                elif cols[-1] - cols[0] == len(cols) - 1:
+                    # a range of dates is a slice, cheaper than a selection
+                    values = dataset[start:stop, cols[0]:cols[-1] + 1]
+                else:
+                    values = dataset[start:stop, cols]
+            TempFile.manager.unlock()
+            return values
+        values = np.empty((max(0, stop - start), len(self.columns)),
+                          dtype=self.dtype)
+        TempFile.manager.lockForRead()
+        with TempFile.released() as path, pd.HDFStore(path, 'r') as store:
+            for i, positions in enumerate(self._blocks):
+                values[:, positions] = store.get_node(
+                    f'{self.key}/block{i}_values')[start:stop]
+        TempFile.manager.unlock()
+        return values if cols is None else values[:, cols]
+
+    def frame(self, start: int = 0, stop: int = None,
+              dates: tuple = None) -> pd.DataFrame:
+        """Returns rows start to stop as a dataframe, only with the dates
+        in the tuple (from, to) if given"""
+        stop = len(self.index) if stop is None else stop
+        cols = None if dates is None else self.date_columns(dates)
+        return pd.DataFrame(
+            self.read(start, stop, cols), index=self.index[start:stop],
+            columns=self.columns if cols is None else self.columns[cols])
+
+    def gather(self, rows: np.ndarray, cols: np.ndarray,
+               span: int) -> np.ndarray:
+        """Returns the values at rows and cols as floats, nan where the
+        row or column is -1. Rows are read in runs of at most span rows
+        of the stored frame, so when rows are close together in the file
+        only a few reads are needed."""
+        values = np.full((len(rows), len(cols)), np.nan)
+        wanted = np.flatnonzero(rows >= 0)
+        order = wanted[np.argsort(rows[wanted], kind='stable')]
+        positions = rows[order]
+        i = 0
+        while i < len(order):
+            first = positions[i]
+            # every wanted row within span of the first is read at once
+            j = np.searchsorted(positions, first + span)
+            block = self.read(first, positions[j - 1] + 1).astype(float)
+            # pad with a nan column for -1 to pick
+            block = np.hstack((block, np.full((len(block), 1), np.nan)))
+            values[order[i:j]] = block[positions[i:j] - first][:, cols]
+            i = j
+        return values
+
+
+def frame_shape(key: str) -> tuple:
+    """Returns the (rows, columns) shape of the frame at key without
+    reading it, whichever layout it was saved in"""
+    TempFile.manager.lockForRead()
+    with TempFile.store() as store:
+        node = store[key]
+        shape = node['values'].shape if is_frame(node) else None
+    TempFile.manager.unlock()
+    if shape is None:
+        TempFile.manager.lockForRead()
+        with TempFile.released() as path, pd.HDFStore(path, 'r') as store:
+            shape = store.get_storer(key).shape
+        TempFile.manager.unlock()
+    return tuple(shape)
+
+
+def select_dates(df: pd.DataFrame, dates: tuple) -> pd.DataFrame:
+    """Returns the columns of df from and to the dates in the tuple
+    (from, to), inclusive, or df itself if dates is None"""
+    if dates is None:
+        return df
+    return df.loc[:, (df.columns >= dates[0]) & (df.columns <= dates[1])]
+
+
+def read_frame(key: str, dates: tuple = None) -> pd.DataFrame:
+    """Reads the whole frame at key, whichever layout it was saved in.
+    If a tuple of dates (from, to) is given only the columns between them
+    are read from a stored frame."""
+    TempFile.manager.lockForRead()
+    with TempFile.store() as store:
+        legacy = not is_frame(store[key])
+    TempFile.manager.unlock()
+    if legacy:
+        TempFile.manager.lockForRead()
+        with TempFile.released() as path:
+            df = pd.read_hdf(path, key)
+        TempFile.manager.unlock()
+        return select_dates(df, dates)
+    return StoredFrame(key).frame(dates=dates)
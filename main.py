@@ -8,6 +8,7 @@ from logging.handlers import RotatingFileHandler
 import os
 import sys
 import ctypes
+import multiprocessing
 import warnings
 from shutil import copyfile
 from PyQt5.QtWidgets import QApplication
@@ -16,7 +17,7 @@ from actions import attempt_recovery
 from ui import mainwindow, welcome
 from PyQt5.QtCore import QSettings
 from ui.resources import resource_init  # looks redundant but isn't
-from util import TempFile, resource_path
+from util import ProcessPool, TempFile, resource_path
 from tables import NaturalNameWarning
 try:
     import pyi_splash
@@ -59,6 +60,8 @@ log.debug('----------------------NEW SESSION----------------------')
 
 
 if __name__ == "__main__":
+    # required for the ProcessPool to start processes from the exe
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     # set up the path for QSettings so it can be accessed anywhere
     app.setApplicationName("OptiCORD")
@@ -90,4 +93,5 @@ if __name__ == "__main__":
     except:  # TODO catch correct Exception.
         log.exception('System excited with exception:\n')
     finally:
+        ProcessPool.shutdown()
         copy_settings()
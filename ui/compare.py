@@ -6,12 +6,12 @@ from PyQt5.QtGui import QStandardItem, QStandardItemModel, QPixmap, QPainter, QF
 from PyQt5.uic import loadUi
 from PyQt5.QtCore import QEvent, QObject, QSettings, QModelIndex, QPoint, QRectF, Qt, pyqtSlot, QRunnable, pyqtSignal, QThreadPool
 from PyQt5.Qt import QSvgRenderer
-from PyQt5.QtWidgets import QAbstractItemView, QListView, QTreeView, QWidget, QStyledItemDelegate, QStyleOptionViewItem, QFileDialog, QMessageBox, QPushButton, QDialog, QApplication
-import h5py
+from PyQt5.QtWidgets import QAbstractItemView, QAction, QListView, QMenu, QTreeView, QWidget, QStyledItemDelegate, QStyleOptionViewItem, QFileDialog, QMessageBox, QPushButton, QDialog, QApplication
 import pandas as pd
-from comparison import InvalidComparison, PandasComparison
+from comparison import ChunkedComparison, InvalidComparison
 from export import Export, ExportOptions
-from util import CharacterSet, NameValidator, StandardFormats, TempFile, resource_path
+from ui.results import ResultBrowser
+from util import Catalog, CharacterSet, NameValidator, StandardFormats, TempFile, resource_path
 
 log = logging.getLogger('OptiCORD')
 
@@ -105,8 +105,33 @@ class ComparisonList(QListView):
             self.viewport().update)
         # connect click with checkbox
         self.clicked.connect(self.toggle_item_check)
+        # event filter to add right click menu
+        self.installEventFilter(self)
         # init select all item
         self.select_all = SelectAllItem()
+        self.pre_name = None
+        self.post_name = None
+
+    def eventFilter(self, source: QObject, event: QEvent) -> bool:
+        """Custom event filter to manage item right click event"""
+        if event.type() == QEvent.ContextMenu and source is self:
+            item = self.model.item(self.currentIndex().row(), 0)
+            # only compared items that aren't being processed have results
+            if type(item) is ComparisonItem and item.isSelectable() and \
+                    item.state == ComparisonItem.SUCCESS and Catalog.exists(
+                        f'comparisons/{self.pre_name} vs {self.post_name}'
+                        f'/{item.name}'):
+                menu = QMenu()
+                view_action = QAction('View Results', menu)
+                menu.addAction(view_action)
+                view_action.triggered.connect(lambda:
+                                              self.view_results(item))
+                menu.exec(event.globalPos())
+        return super().eventFilter(source, event)
+
+    def view_results(self, item: ComparisonItem) -> None:
+        """Opens the results of the item's comparison in a ResultBrowser"""
+        ResultBrowser(self, self.pre_name, self.post_name, item.name).exec()
 
     @pyqtSlot(QModelIndex)
     def toggle_item_check(self, index) -> None:
@@ -165,6 +190,8 @@ class ComparisonList(QListView):
         visualisation lists"""
         # check all items and set state
         existing = self.get_existing(pre_name, post_name)
+        self.pre_name = pre_name
+        self.post_name = post_name
         # clear list and fill with new items
         self.clear()
         self.select_all = SelectAllItem()
@@ -207,27 +234,16 @@ class ComparisonList(QListView):
         """Returns a list of existing comparisons given a pre and post
         position"""
         existing = []
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            comparison_list = store[f'comparisons'].keys()
-            theoretical_comp = f'{pre_it} vs {post_it}'
-            if theoretical_comp in comparison_list:
-                existing = list(
-                    store[f'comparisons/{theoretical_comp}'].keys())
-        TempFile.manager.unlock()
+        theoretical_comp = f'comparisons/{pre_it} vs {post_it}'
+        if Catalog.exists(theoretical_comp):
+            existing = Catalog.children(theoretical_comp)
         return existing
 
     @pyqtSlot(str)
     def get_meta(self, path: str) -> list:
         """Returns a list of existing comparisons given a pre and post
         position"""
-        meta = dict()
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            for key, val in store[path].attrs.items():
-                meta[key] = val
-        TempFile.manager.unlock()
-        return meta
+        return Catalog.attrs(path)
 
     @pyqtSlot()
     def clear(self) -> None:
@@ -519,18 +535,15 @@ class CompareWidget(QWidget, object):
     def get_positions(self) -> List[str]:
         """Returns a list of position names from current change tracker
         file sorted by creation date."""
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            # store in dataframe for easier sorting
-            df = pd.DataFrame(columns=['Name', 'Datetime'])
-            # fetch name of each position as list
-            df['Name'] = list(store['positions'].keys())
-            # fetch assosciated creation date for each position
-            df['Datetime'] = [pd.to_datetime(
-                store[f'positions/{x}'].attrs['creation_date'],
-                format=StandardFormats.DATETIME)
-                for x in df['Name'].tolist()]
-        TempFile.manager.unlock()
+        # store in dataframe for easier sorting
+        df = pd.DataFrame(columns=['Name', 'Datetime'])
+        # fetch name of each position as list
+        df['Name'] = Catalog.children('positions')
+        # fetch assosciated creation date for each position
+        df['Datetime'] = [pd.to_datetime(
+            Catalog.attrs(f'positions/{x}')['creation_date'],
+            format=StandardFormats.DATETIME)
+            for x in df['Name'].tolist()]
         # sort by creation date and return as list
         return df.sort_values(by='Datetime')['Name'].tolist()
 
@@ -551,11 +564,10 @@ class CompareWidget(QWidget, object):
         the ComparisonList"""
         log.debug('loading visualisations into comparison list for '
                   f'{self.pre_dropdown.currentText()} vs {self.post_dropdown.currentText()}')
-        with h5py.File(TempFile.path, 'r+') as store:
-            pre_vis = list(store[
-                f'positions/{self.pre_dropdown.currentText()}'].keys())
-            post_vis = list(store[
-                f'positions/{self.post_dropdown.currentText()}'].keys())
+        pre_vis = Catalog.children(
+            f'positions/{self.pre_dropdown.currentText()}')
+        post_vis = Catalog.children(
+            f'positions/{self.post_dropdown.currentText()}')
         common = [x for x in post_vis if x in pre_vis]
         pre_only = [x for x in pre_vis if x not in post_vis]
         post_only = [x for x in post_vis if x not in pre_vis]
@@ -690,7 +702,7 @@ class CompareWidget(QWidget, object):
                 item)
             self.export_worker.signals.finished.connect(self.try_unlock)
             self.signals.cancel.connect(self.export_worker.cancel)
-            QThreadPool.globalInstance().start(self.export_worker)
+            self.export_worker.queue()
 
     def lock(self) -> None:
         """Locks the UI for comparison"""
@@ -786,7 +798,7 @@ class ComparisonWorker(QRunnable):
             else:
                 log.debug(f'Attempting comparison for {self.item.name}')
                 self.item.state = ComparisonItem.PROCESSING
-                comp = PandasComparison(self.pre, self.post, self.item)
+                comp = ChunkedComparison(self.pre, self.post, self.item)
                 comp.compare()
                 self.item.state = ComparisonItem.SUCCESS
                 log.debug(f'{self.item.name} compared successfully')
@@ -834,9 +846,31 @@ class ExportWorker(QRunnable):
         self.original_state = self.item.state
         self.item.state = ComparisonItem.QUEUED
         self.should_cancel = False
+        self.memory = 0  # MB of the export memory budget taken
+
+    def queue(self) -> None:
+        """Starts the export in the global pool once there's enough of
+        the memory budget free for it, so waiting exports don't hold
+        threads of the pool that comparisons need"""
+        try:
+            exporter = Export(self.desc, self.pre, self.post,
+                              self.exp_fol, self.item)
+            if not exporter.should_skip:
+                self.memory = exporter.memory_needed()
+        except Exception:
+            # run fails the same way and reports it
+            self.memory = 0
+        Export.queue(self.memory, self.start)
+
+    def start(self) -> None:
+        QThreadPool.globalInstance().start(self)
 
     def cancel(self) -> None:
         self.should_cancel = True
+        # an export still waiting for memory is started to cancel it
+        if Export.unqueue(self.start):
+            self.memory = 0
+            self.start()
 
     def run(self) -> None:
         """"""
@@ -844,18 +878,22 @@ class ExportWorker(QRunnable):
             if self.should_cancel:
                 log.debug(f'Cancelled export for {self.item.name}')
                 self.item.state = self.original_state
-            else:
-                log.debug(f'Attempting export for {self.item.name}')
-                self.item.state = ComparisonItem.EXPORTING
-                exporter = Export(self.desc, self.pre, self.post,
-                                  self.exp_fol, self.item)
-                if exporter.should_skip:
-                    log.info(f'Skipped export of {self.item.name}'
-                             ' (no differences)')
-                else:
-                    exporter.export()
+                return
+            exporter = Export(self.desc, self.pre, self.post,
+                              self.exp_fol, self.item)
+            if exporter.should_skip:
+                log.info(f'Skipped export of {self.item.name}'
+                         ' (no differences)')
                 self.item.state = ComparisonItem.SUCCESS
-                log.debug(f'{self.item.name} exported successfully')
+                return
+            log.debug(f'Attempting export for {self.item.name}')
+            self.item.state = ComparisonItem.EXPORTING
+            msg = self.item.msg
+            exporter.export(self.signals.update_msg.emit)
+            # put back the message of the comparison
+            self.signals.update_msg.emit(msg)
+            self.item.state = ComparisonItem.SUCCESS
+            log.debug(f'{self.item.name} exported successfully')
         except:
             log.exception(
                 f'{self.item.name} encountered error during export:\n')
@@ -863,4 +901,6 @@ class ExportWorker(QRunnable):
                 'Failed to export, contact OptiCORD team')
             self.item.state = ComparisonItem.FAILURE
         finally:
+            # taken when the export was queued
+            Export.release_memory(self.memory)
             self.signals.finished.emit()
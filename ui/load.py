@@ -12,7 +12,7 @@ from PyQt5.uic import loadUi
 from uuid import uuid4
 from ui.new import NewPosition, EditPosition
 from visualisations import VisualisationList
-from util import StandardFormats, TempFile, resource_path
+from util import Catalog, StandardFormats, TempFile, resource_path
 import h5py
 
 
@@ -76,24 +76,25 @@ class ImportExisting(QDialog):
         TempFile.manager.lockForWrite()
         iter_text = self.list.currentItem().text()
         path = f'positions/{iter_text}'
-        with h5py.File(self.filepath, 'r') as source,\
-                h5py.File(TempFile.path, 'r+') as destination:
-            # rename the position if it already exists in destination
-            existing = destination['positions'].keys()
-            if iter_text in existing:
-                # create compile function for filtering items that match
-                compilation = re.compile(f'^{iter_text} \(\d+\)$')
-                # list of just the integers within the brackets
-                copies_list = [re.match(f'^{iter_text} \((\d+)\)$', match).group(1)
-                               for match in list(filter(compilation.match, existing))]
-                # if list is empty make the copy number the max + 1
-                if copies_list:
-                    c = int(max(copies_list))+1
-                else:
-                    c = 1
-                name = f'{iter_text} ({c})'
+        # rename the position if it already exists in destination
+        existing = Catalog.children('positions')
+        if iter_text in existing:
+            # create compile function for filtering items that match
+            compilation = re.compile(f'^{iter_text} \(\d+\)$')
+            # list of just the integers within the brackets
+            copies_list = [re.match(f'^{iter_text} \((\d+)\)$', match).group(1)
+                           for match in list(filter(compilation.match, existing))]
+            # if list is empty make the copy number the max + 1
+            if copies_list:
+                c = int(max(copies_list))+1
             else:
-                name = iter_text
+                c = 1
+            name = f'{iter_text} ({c})'
+        else:
+            name = iter_text
+        TempFile.manager.mark(f'positions/{name}')
+        with h5py.File(self.filepath, 'r') as source,\
+                TempFile.store() as destination:
             source.copy(path, destination['positions'], name=name)
             if 'history' in destination[f'positions/{name}'].attrs.keys():
                 destination[f'positions/{name}'].attrs['history'] += \
@@ -103,6 +104,7 @@ class ImportExisting(QDialog):
                 destination[f'positions/{name}'].attrs['history'] = \
                     f'({datetime.now().strftime(StandardFormats.DATETIME)})'\
                     f' - Imported from {source.attrs["name"]} by {os.getlogin()}'
+            Catalog.update(destination, f'positions/{name}')
         TempFile.manager.unlock()
         self.name = name
         super().accept()
@@ -196,36 +198,29 @@ class LoadWidget(QWidget, object):
         self.edit_position.setEnabled(True)
         # create description list
         desc = []
-        # get info from file
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            position = store[f'positions/{selection}']
-            desc.append(f'Description: {position.attrs["description"]}')
-            desc.append('')
-            desc.append(f'Created by: {position.attrs["creator"]}')
-            desc.append('Creation Date: '
-                        f'{position.attrs["creation_date"]}')
-            if 'history' in position.attrs.keys():
-                desc.append(f'History: {position.attrs["history"]}')
-        TempFile.manager.unlock()
+        # get info from the catalog
+        attrs = Catalog.attrs(f'positions/{selection}')
+        desc.append(f'Description: {attrs["description"]}')
+        desc.append('')
+        desc.append(f'Created by: {attrs["creator"]}')
+        desc.append(f'Creation Date: {attrs["creation_date"]}')
+        if 'history' in attrs.keys():
+            desc.append(f'History: {attrs["history"]}')
         # write to info box
         self.selection_info.setText('\n'.join(desc))
 
     def get_positions(self) -> List[str]:
         """Returns a list of position names from current change tracker
         file sorted by creation date."""
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            # store in dataframe for easier sorting
-            df = pd.DataFrame(columns=['Name', 'Datetime'])
-            # fetch name of each position as list
-            df['Name'] = list(store['positions'].keys())
-            # fetch assosciated creation date for each position
-            df['Datetime'] = [pd.to_datetime(
-                store[f'positions/{x}'].attrs['creation_date'],
-                format=StandardFormats.DATETIME)
-                for x in df['Name'].tolist()]
-        TempFile.manager.unlock()
+        # store in dataframe for easier sorting
+        df = pd.DataFrame(columns=['Name', 'Datetime'])
+        # fetch name of each position as list
+        df['Name'] = Catalog.children('positions')
+        # fetch assosciated creation date for each position
+        df['Datetime'] = [pd.to_datetime(
+            Catalog.attrs(f'positions/{x}')['creation_date'],
+            format=StandardFormats.DATETIME)
+            for x in df['Name'].tolist()]
         # sort by creation date and return as list
         return df.sort_values(by='Datetime')['Name'].tolist()
 
@@ -266,7 +261,8 @@ class LoadWidget(QWidget, object):
             return
         # create the new position in file
         TempFile.manager.lockForWrite()
-        with h5py.File(TempFile.path, 'r+') as store:
+        TempFile.manager.mark(f'positions/{new_dlg.name}')
+        with TempFile.store() as store:
             position = store['positions'].create_group(new_dlg.name)
             # generate a unique id for the position
             position.attrs['id'] = uuid4().hex
@@ -274,6 +270,7 @@ class LoadWidget(QWidget, object):
             position.attrs['creator'] = os.getlogin()
             position.attrs['creation_date'] = datetime.now().strftime(
                 StandardFormats.DATETIME)
+            Catalog.update(store, f'positions/{new_dlg.name}')
         TempFile.manager.unlock()
         self.refresh_position_dropdown()
         self.position_dropdown_select(new_dlg.name)
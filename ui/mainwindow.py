@@ -1,14 +1,17 @@
 
 
+import os
 import re
 from PyQt5 import QtCore
-from PyQt5.QtCore import QObject, QSettings, Qt
+from PyQt5.QtCore import QObject, QSettings, Qt, pyqtSlot
 from PyQt5.QtGui import QCloseEvent, QPixmap
-from PyQt5.QtWidgets import QAction, QApplication, QDialog, QDialogButtonBox, QMainWindow, QMessageBox
+from PyQt5.QtWidgets import QAction, QApplication, QDialog, QDialogButtonBox, QMainWindow, QMessageBox, QProgressBar
 from PyQt5.uic import loadUi
 from themes import ThemeRegistry, Theme
 import actions
-from util import TempFile, resource_path
+from blocks import ParseEngine, arrow_available
+from util import ProcessPool, TempFile, resource_path
+from visualisations import VisualisationParser
 
 
 class QThemeAction(QAction):
@@ -57,6 +60,47 @@ class QFontAction(QAction):
         self.setChecked(True)
 
 
+class QWorkersAction(QAction):
+    """A QAction Object for the number of processes in the ProcessPool"""
+
+    def __init__(self, workers: int, parent: QObject):
+        super(QAction, self).__init__(parent, text=str(workers))
+        self.workers = workers
+        self.setCheckable(True)
+        self.setObjectName(f'action_workers_{workers}')
+        self.triggered['bool'].connect(self.apply)
+        if ProcessPool.workers() == workers:
+            self.setChecked(True)
+
+    def apply(self):
+        """Apply the selected number of processes"""
+        ProcessPool.set_workers(self.workers)
+        [x.setChecked(False) for x in self.parentWidget()
+            .findChildren(QWorkersAction)]
+        self.setChecked(True)
+
+
+class QEngineAction(QAction):
+    """A QAction Object for the engine used to read visualisations,
+    only lasts for the current session"""
+
+    def __init__(self, text: str, engine: int, parent: QObject):
+        super(QAction, self).__init__(parent, text=text)
+        self.engine = engine
+        self.setCheckable(True)
+        self.setObjectName(f'action_engine_{text.lower()}')
+        self.triggered['bool'].connect(self.apply)
+        if VisualisationParser.engine == engine:
+            self.setChecked(True)
+
+    def apply(self):
+        """Apply the selected engine"""
+        VisualisationParser.engine = self.engine
+        [x.setChecked(False) for x in self.parentWidget()
+            .findChildren(QEngineAction)]
+        self.setChecked(True)
+
+
 class UnsavedChanges(QDialog):
     """Popup window to get direction from user on what to do with
     unsaved changes."""
@@ -106,10 +150,17 @@ class UnsavedChanges(QDialog):
 
 class MainWindow(QMainWindow, object):
     """Main window of application"""
+    saving: bool = False  # True while a SaveWorker is running
 
     def __init__(self):
         super(QMainWindow, self).__init__()
         loadUi(resource_path()+"/ui/mainwindow.ui", self)
+        # shows the progress of saves running in the background
+        self.save_bar = QProgressBar(self)
+        self.save_bar.setMaximumWidth(200)
+        self.save_bar.setFormat('Saving... %p%')
+        self.save_bar.hide()
+        self.statusbar.addPermanentWidget(self.save_bar)
         self.themes = ThemeRegistry()  # load all themes
         # apply the users selected theme defaulted to dark purple
         QSettings().value("active_theme", self.themes[2]).apply()
@@ -125,6 +176,24 @@ class MainWindow(QMainWindow, object):
         self.menu_font_size.addAction(QFontAction('Large',
                                                   14, self))
 
+        # add options for the number of processes used to load, compare
+        # and export
+        self.menu_workers = self.menu_preferences.addMenu(
+            'Worker processes')
+        self.menu_workers.setObjectName('menu_workers')
+        for workers in range(1, os.cpu_count()+1):
+            self.menu_workers.addAction(QWorkersAction(workers, self))
+
+        # add options for the engine used to read visualisations
+        self.menu_engine = self.menu_preferences.addMenu('CSV engine')
+        self.menu_engine.setObjectName('menu_engine')
+        self.menu_engine.addAction(QEngineAction('Pandas',
+                                                 ParseEngine.PANDAS, self))
+        arrow_action = QEngineAction('Arrow', ParseEngine.ARROW, self)
+        # pyarrow is an optional dependency
+        arrow_action.setEnabled(arrow_available)
+        self.menu_engine.addAction(arrow_action)
+
         self.action_new.triggered[bool].connect(
             lambda: actions.create_new(self))
         self.action_open.triggered[bool].connect(
@@ -138,10 +207,50 @@ class MainWindow(QMainWindow, object):
         self.action_contact_support.triggered[bool].connect(
             lambda: actions.contact_support(self))
 
+    def file_actions(self) -> list:
+        """Returns the actions that replace or save the TempFile"""
+        return [self.action_new, self.action_open, self.action_save,
+                self.action_save_as]
+
+    def save_started(self) -> None:
+        """Shows the save progress bar and stops further edits, and
+        other files being created or opened, until the save finishes.
+        Edits already running in the background wait for the save to
+        release the TempFile."""
+        self.saving = True
+        for action in self.file_actions():
+            action.setEnabled(False)
+        if self.centralWidget():
+            self.centralWidget().setEnabled(False)
+        self.save_bar.setValue(0)
+        self.save_bar.show()
+
+    @pyqtSlot(int, int)
+    def save_progress(self, done: int, total: int) -> None:
+        """Updates the save progress bar"""
+        # scaled to a percentage as QProgressBar only holds 32 bit ints
+        self.save_bar.setValue(int(100*done/total) if total else 100)
+
+    @pyqtSlot(bool)
+    def save_finished(self, success: bool) -> None:
+        """Hides the save progress bar and re-enables edits"""
+        self.saving = False
+        for action in self.file_actions():
+            action.setEnabled(True)
+        if self.centralWidget():
+            self.centralWidget().setEnabled(True)
+        self.save_bar.hide()
+        if success:
+            self.statusbar.showMessage('Saved', 3000)
+        else:
+            QMessageBox.critical(self, 'Save failed',
+                                 'The file could not be saved, '
+                                 'contact OptiCORD team')
+
     def closeEvent(self, a0: QCloseEvent) -> None:
         """Additional checks when user tries to intentionally close
         the window"""
-        if TempFile.proc_manager.processing:
+        if TempFile.proc_manager.processing or self.saving:
             QApplication.beep()
             return a0.ignore()
         if TempFile.manager.changed:
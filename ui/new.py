@@ -2,10 +2,10 @@ from typing import List
 from PyQt5.QtCore import Qt, QObject, pyqtSlot
 from PyQt5.QtWidgets import QApplication, QDialog, QMessageBox, QWidget
 from PyQt5.uic import loadUi
+import json
 import os
 import logging
-import h5py
-from util import CharacterSet, DeleteConfirmation, NameValidator, TempFile, resource_path, MetaDict
+from util import Catalog, CharacterSet, DeleteConfirmation, NameValidator, TempFile, resource_path, MetaDict
 
 log = logging.getLogger('OptiCORD')
 
@@ -204,29 +204,46 @@ class EditPosition(QDialog, object):
         self.edit_position()
 
     def edit_position(self):
-        """Copy/paste a position with the new name and desc in file
-        then delete the old one"""
+        """Move a position to the new name and set its desc in file"""
         TempFile.manager.lockForWrite()
-        with h5py.File(TempFile.path, 'r+') as store:
-            if self.old_name != self.name:
-                # copy position to new name
-                store.copy(f'positions/{self.old_name}',
-                           f'positions/{self.name}')
-                # delete old position
-                del store[f'positions/{self.old_name}']
-                # copy assosciated comparisons to new name and delete old
-                for comp in store['comparisons'].keys():
-                    positions = comp.split(' vs ')
-                    if self.old_name == positions[0]:
-                        store.copy(
-                            f'comparisons/{comp}', f'comparisons/{self.name} vs {positions[1]}')
-                        del (store[f'comparisons/{comp}'])
-                    if self.old_name == positions[1]:
-                        store.copy(
-                            f'comparisons/{comp}', f'comparisons/{positions[0]} vs {self.name}')
-                        del (store[f'comparisons/{comp}'])
+        # groups moved with the position, as (old path, new path)
+        moved = []
+        if self.old_name != self.name:
+            moved.append((f'positions/{self.old_name}',
+                          f'positions/{self.name}'))
+            # assosciated comparisons are moved to the new name too
+            for comp in Catalog.children('comparisons'):
+                positions = comp.split(' vs ')
+                if self.old_name in positions:
+                    positions = [self.name if p == self.old_name else p
+                                 for p in positions]
+                    moved.append((f'comparisons/{comp}',
+                                  f'comparisons/{" vs ".join(positions)}'))
+        # comparisons made before their positions were saved with them
+        # keep the names they were made with, exports label them by name
+        named = []
+        for old, new in moved[1:]:
+            positions = old[len('comparisons/'):].split(' vs ')
+            for vis in Catalog.children(old):
+                if 'positions' not in Catalog.attrs(f'{old}/{vis}'):
+                    named.append((f'{new}/{vis}', positions))
+        for old, new in moved:
+            TempFile.manager.mark_moved(old, new)
+        for path, _ in named:
+            TempFile.manager.mark_attrs(path)
+        TempFile.manager.mark_attrs(f'positions/{self.name}')
+        with TempFile.store() as store:
+            if moved:
+                # moving only relinks the groups, their data isn't copied
+                for old, new in moved:
+                    store.move(old, new)
+                for path, positions in named:
+                    store[path].attrs['positions'] = json.dumps(positions)
+                Catalog.remove(f'positions/{self.old_name}')
+                Catalog.update(store, 'comparisons')
             position = store[f'positions/{self.name}']
             position.attrs['description'] = self.desc
+            Catalog.update(store, f'positions/{self.name}')
         TempFile.manager.unlock()
         log.debug(f'Edited position: {self.name}')
         return super().accept()
@@ -240,12 +257,17 @@ class EditPosition(QDialog, object):
                                         '\n\nThis operation is irreversible.')
         if delete_dlg.exec():
             TempFile.manager.lockForWrite()
-            with h5py.File(TempFile.path, 'r+') as store:
-                del (store[f'positions/{self.old_name}'])
-                for comp in store['comparisons'].keys():
-                    positions = comp.split(' vs ')
-                    if self.old_name in positions:
-                        del (store[f'comparisons/{comp}'])
+            paths = [f'positions/{self.old_name}']
+            for comp in Catalog.children('comparisons'):
+                positions = comp.split(' vs ')
+                if self.old_name in positions:
+                    paths.append(f'comparisons/{comp}')
+            for path in paths:
+                TempFile.manager.mark(path)
+            with TempFile.store() as store:
+                for path in paths:
+                    del (store[path])
+                    Catalog.remove(path)
             TempFile.manager.unlock()
         self.name = 'Select position...'  # so it switches index after deletion
         log.debug(f'Deleted position: {self.old_name}')
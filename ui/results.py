@@ -0,0 +1,233 @@
+from collections import OrderedDict
+import logging
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QObject, QRunnable, QThreadPool, Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtWidgets import QDialog, QListView
+from PyQt5.uic import loadUi
+from export import date_labels
+from frames import CHUNK_DATES, StoredFrame
+from util import Catalog, MetaDict, resource_path
+
+log = logging.getLogger('OptiCORD')
+
+
+class BlockSignals(QObject):
+    """"""
+    read = pyqtSignal(tuple, object, object)
+
+
+class BlockReader(QRunnable):
+    """A QRunnable object to read a block of a ResultModel off the GUI
+    thread, so the browser isn't held up while the file is locked"""
+
+    def __init__(self, model: 'ResultModel', key: tuple) -> None:
+        super(QRunnable, self).__init__()
+        self.key = key
+        self.read = model.read_block
+        self.signals = BlockSignals()
+        self.signals.read.connect(model.add_block)
+
+    def run(self) -> None:
+        """"""
+        try:
+            values, codes = self.read(*self.key)
+        except:
+            log.exception(f'failed to read block {self.key}:\n')
+            # shown blank rather than read again each time it's shown
+            values, codes = None, None
+        self.signals.read.emit(self.key, values, codes)
+
+
+class ResultModel(QAbstractTableModel):
+    """Table model of the differences of a compared periodicity, showing
+    the dimensions of each series then a column for each date. Values are
+    read from the TempFile a block of rows and dates at a time as the view
+    shows them, so only the index of the differences is held in memory
+    along with the blocks shown most recently. Blocks are read in the
+    background and shown blank until they arrive."""
+    # a block is a chunk of the stored values, 512 rows of 64 dates
+    BLOCK_ROWS = 512
+    BLOCK_DATES = CHUNK_DATES
+    # most blocks held, the least recently shown are dropped first
+    MAX_BLOCKS = 64
+    pool: QThreadPool = None  # reads blocks, created by the first model
+    diff: StoredFrame  # differences, None if there are none saved
+    status: StoredFrame  # status codes, None if compared before them
+    series: pd.Index  # index of the differences
+    headers: list  # header of each column
+    labels: list  # string of each status code
+    blocks: OrderedDict  # (values, codes) of each block by its position
+    reading: set  # positions of the blocks being read
+
+    def __init__(self, path: str, per: str, parent: QObject = None) -> None:
+        super().__init__(parent)
+        meta = MetaDict(path)
+        self.diff = None
+        self.status = None
+        self.series = pd.Index([])
+        self.headers = []
+        self.labels = meta.get('status_labels')
+        self.blocks = OrderedDict()
+        self.reading = set()
+        if ResultModel.pool is None:
+            ResultModel.pool = QThreadPool()
+            ResultModel.pool.setMaxThreadCount(1)
+        # identical periodicities are saved without data
+        if meta.get('identical'):
+            return
+        self.diff = StoredFrame(f'{path}/data')
+        if self.labels is not None:
+            self.status = StoredFrame(f'{path}/status')
+        self.series = self.diff.index
+        dates = date_labels(self.diff.columns, per)
+        if isinstance(dates, pd.DatetimeIndex):
+            dates = dates.strftime('%Y-%m-%d')
+        self.headers = [name or '' for name in self.series.names] + \
+            list(dates)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.series)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section: int, orientation: Qt.Orientation,
+                   role: int = Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            # the header is sized from section 0 even with no columns
+            return self.headers[section] if section < len(self.headers) \
+                else None
+        return section + 1
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        # position of the column's date, negative for the dimensions
+        date = index.column() - self.series.nlevels
+        if role == Qt.TextAlignmentRole and date >= 0:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        if role != Qt.DisplayRole:
+            return None
+        if date < 0:
+            return self._label(row, index.column())
+        block = self._block(row // ResultModel.BLOCK_ROWS,
+                            date // ResultModel.BLOCK_DATES)
+        if block is None:
+            return None
+        values, codes = block
+        row %= ResultModel.BLOCK_ROWS
+        date %= ResultModel.BLOCK_DATES
+        if not np.isnan(values[row, date]):
+            return f'{values[row, date]:.15g}'
+        # the status code tells why there's no difference
+        return '' if codes is None else self.labels[codes[row, date]]
+
+    def _label(self, row: int, level: int) -> str:
+        """Returns the label of the series at row in the dimension at
+        level"""
+        if isinstance(self.series, pd.MultiIndex):
+            code = self.series.codes[level][row]
+            return '' if code < 0 else str(self.series.levels[level][code])
+        label = self.series[row]
+        return '' if pd.isna(label) else str(label)
+
+    def _block(self, rows: int, dates: int) -> tuple:
+        """Returns the values and status codes of the block at the given
+        position in a tuple (values, codes), or None if it isn't held, in
+        which case it's read in the background. codes is None if compared
+        before status codes."""
+        key = (rows, dates)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        if key not in self.reading:
+            self.reading.add(key)
+            ResultModel.pool.start(BlockReader(self, key))
+        return None
+
+    def _span(self, rows: int, dates: int) -> tuple:
+        """Returns the rows and date columns of the values covered by the
+        block at the given position in a tuple (start, stop, cols)"""
+        start = rows * ResultModel.BLOCK_ROWS
+        stop = min(start + ResultModel.BLOCK_ROWS, len(self.series))
+        cols = np.arange(dates * ResultModel.BLOCK_DATES,
+                         min((dates + 1) * ResultModel.BLOCK_DATES,
+                             len(self.diff.columns)))
+        return start, stop, cols
+
+    def read_block(self, rows: int, dates: int) -> tuple:
+        """Reads the values and status codes of the block at the given
+        position from the TempFile, returned in a tuple (values, codes).
+        Run by BlockReaders, off the GUI thread."""
+        key = (rows, dates)
+        start, stop, cols = self._span(rows, dates)
+        values = self.diff.read(start, stop, cols).astype(float, copy=False)
+        if values.shape != (stop - start, len(cols)):
+            # blank cells are better than cells shown under the wrong date
+            log.error(f'block {key} of {self.diff.key} read with shape '
+                      f'{values.shape}, expected {(stop - start, len(cols))}')
+            values = np.full((stop - start, len(cols)), np.nan)
+        codes = None
+        if self.status is not None:
+            codes = self.status.read(start, stop, cols)
+            if codes.shape != values.shape:
+                log.error(f'block {key} of {self.status.key} read with shape '
+                          f'{codes.shape}, expected {values.shape}')
+                codes = None
+        return values, codes
+
+    @pyqtSlot(tuple, object, object)
+    def add_block(self, key: tuple, values: np.ndarray,
+                  codes: np.ndarray) -> None:
+        """Holds a block read by a BlockReader and updates its cells"""
+        self.reading.discard(key)
+        start, stop, cols = self._span(*key)
+        if values is None:
+            values = np.full((stop - start, len(cols)), np.nan)
+        self.blocks[key] = (values, codes)
+        if len(self.blocks) > ResultModel.MAX_BLOCKS:
+            self.blocks.popitem(last=False)
+        if len(cols):
+            first = self.series.nlevels + cols[0]
+            self.dataChanged.emit(self.index(start, first),
+                                  self.index(stop - 1, first + len(cols) - 1),
+                                  [Qt.DisplayRole])
+
+
+class ResultBrowser(QDialog, object):
+    """Dialog window for browsing the differences of a comparison without
+    exporting them. Only the series with differences are shown."""
+    path: str  # path to the visualisation's comparison
+    model: ResultModel  # model of the periodicity shown
+
+    def __init__(self, parent: QObject, pre: str, post: str,
+                 vis: str) -> None:
+        super(QDialog, self).__init__(
+            parent, Qt.WindowCloseButtonHint | Qt.WindowMaximizeButtonHint)
+        # load the vanilla elements from QT Designer file
+        loadUi(resource_path()+"/ui/results.ui", self)
+        self.setWindowTitle(f'{vis} ({pre} vs {post})')
+        self.path = f'comparisons/{pre} vs {post}/{vis}'
+        self.model = None
+        # magic line to get styling to work
+        self.per_dropdown.setView(QListView(self))
+        self.per_dropdown.currentTextChanged.connect(self.show_periodicity)
+        self.per_dropdown.addItems(Catalog.children(self.path))
+
+    @pyqtSlot(str)
+    def show_periodicity(self, per: str) -> None:
+        """Shows the differences of the periodicity per"""
+        log.debug(f'browsing {self.path}/{per}')
+        old = self.model
+        self.model = ResultModel(f'{self.path}/{per}', per, self)
+        self.table.setModel(self.model)
+        if old is not None:
+            old.deleteLater()
+        rows = self.model.rowCount()
+        self.info_label.setText(
+            f'{rows:,} series with differences' if rows else
+            'No differences')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# Form implementation generated from reading ui file 'results.ui'
+#
+# Created by: PyQt5 UI code generator 5.15.11
+#
+# WARNING: Any manual changes made to this file will be lost when pyuic5 is
+# run again.  Do not edit this file unless you know what you are doing.
+
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+
+class Ui_results(object):
+    def setupUi(self, results):
+        results.setObjectName("results")
+        results.resize(960, 600)
+        self.gridLayout = QtWidgets.QGridLayout(results)
+        self.gridLayout.setObjectName("gridLayout")
+        self.per_label = QtWidgets.QLabel(results)
+        font = QtGui.QFont()
+        font.setFamily("Segoe UI")
+        font.setPointSize(12)
+        self.per_label.setFont(font)
+        self.per_label.setObjectName("per_label")
+        self.gridLayout.addWidget(self.per_label, 0, 0, 1, 1)
+        self.per_dropdown = QtWidgets.QComboBox(results)
+        self.per_dropdown.setMinimumSize(QtCore.QSize(80, 0))
+        self.per_dropdown.setObjectName("per_dropdown")
+        self.gridLayout.addWidget(self.per_dropdown, 0, 1, 1, 1)
+        self.info_label = QtWidgets.QLabel(results)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Preferred)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.info_label.sizePolicy().hasHeightForWidth())
+        self.info_label.setSizePolicy(sizePolicy)
+        font = QtGui.QFont()
+        font.setFamily("Segoe UI")
+        font.setPointSize(12)
+        font.setItalic(True)
+        self.info_label.setFont(font)
+        self.info_label.setText("")
+        self.info_label.setObjectName("info_label")
+        self.gridLayout.addWidget(self.info_label, 0, 2, 1, 1)
+        self.table = QtWidgets.QTableView(results)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setWordWrap(False)
+        self.table.setObjectName("table")
+        self.gridLayout.addWidget(self.table, 1, 0, 1, 3)
+
+        self.retranslateUi(results)
+        QtCore.QMetaObject.connectSlotsByName(results)
+
+    def retranslateUi(self, results):
+        _translate = QtCore.QCoreApplication.translate
+        results.setWindowTitle(_translate("results", "Results"))
+        self.per_label.setText(_translate("results", "Periodicity:"))
@@ -1,12 +1,19 @@
 import sys
 import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator, List
 from PyQt5.QtGui import QValidator, QPainter, QPixmap
-from PyQt5.QtCore import QDir, QObject, QReadWriteLock, QTemporaryFile, QPropertyAnimation, QRectF, QSize, Qt, pyqtProperty, pyqtSignal, pyqtSlot, QCoreApplication, QSettings
+from PyQt5.QtCore import QDir, QMutex, QObject, QReadWriteLock, QTemporaryFile, QPropertyAnimation, QRectF, QSize, Qt, pyqtProperty, pyqtSignal, pyqtSlot, QCoreApplication, QSettings
 from shutil import copyfile
 from PyQt5.QtWidgets import QApplication, QAbstractButton, QSizePolicy, QDialog
 from PyQt5.uic import loadUi
 import os
 import json
+import struct
+from uuid import uuid4
 import h5py
 
 log = logging.getLogger('OptiCORD')
@@ -30,12 +37,52 @@ class StandardFormats():
 
 class FileManager(QReadWriteLock):
     """QReadWriteLock with additional function to tell if file
-    has been written to."""
+    has been written to, and which groups have changed since the
+    last save."""
     changed: bool = False
+    changed_paths: set  # paths of groups written to or removed
+    pending: list  # changes marked under the current write lock, in order
 
-    def lockForWrite(self) -> None:
+    def __init__(self) -> None:
+        super().__init__()
+        self.changed_paths = set()
+        self.pending = []
+
+    def unlock(self) -> None:
+        # changes marked by a writer are journaled before it lets go
+        if self.pending:
+            changes, self.pending = self.pending, []
+            Journal.record(changes)
+        super().unlock()
+
+    def mark(self, path: str) -> None:
+        """Records that the group at path is being written to or
+        removed so it's included in the next incremental save and the
+        journal. Must be called with the write lock held, before the
+        change is made through TempFile.store(), as the first mark
+        switches from an opened file to its copy so it can be written."""
+        self._change(Journal.WRITE, path)
+
+    def mark_attrs(self, path: str) -> None:
+        """Like mark(), for a group whose attributes are the only thing
+        changed, so a replayed journal doesn't copy the data under it"""
+        self._change(Journal.ATTRS, path)
+
+    def mark_moved(self, source: str, dest: str) -> None:
+        """Like mark(), for a group being moved from source to dest, so
+        a replayed journal doesn't copy the data under it"""
+        self._change(Journal.MOVE, source, dest)
+
+    def _change(self, op: str, *paths: str) -> None:
+        """Records a change to the groups at paths for the journal
+        operation op"""
         self.changed = True
-        return super().lockForWrite()
+        TempFile.detach()
+        self.changed_paths.update(paths)
+        if (op, *paths) not in self.pending:
+            self.pending.append((op, *paths))
+        for path in paths:
+            ResultCache.discard(path)
 
 
 class ProcessingManager(QObject):
@@ -59,28 +106,121 @@ class ProcessingManager(QObject):
 
 class TempFile:
     """Holds information of the temporary file where changes are made
-    before saving."""
+    before saving. An opened file is read in place while it's copied in
+    the background, the first write switches to the copy as the working
+    temp file."""
     saved_path: str = ''
     recovery_path: str = ''
-    path: str = ''
+    path: str = ''  # file being read and written
+    working_path: str = ''  # temp file written to, once it's created
+    # copies an opened file off the GUI thread
+    copier: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1)
+    copying: Future = None  # copy of the opened file, True once made
+    copy_path: str = ''  # where the opened file is copied to
+    copy_cancelled: bool = False  # stops the copy being made
+    # file the TempFile was identical to at the last open or save
+    synced_path: str = ''
+    COPY_CHUNK: int = 16*1024*1024  # bytes copied at a time
     manager: FileManager = FileManager()
     proc_manager: ProcessingManager = ProcessingManager()
+    # long lived h5py handle shared by all readers and writers
+    handle: h5py.File = None
+    handle_mutex: QMutex = QMutex()
+    # held for reading while the handle is in use, for writing to close it
+    # under a read lock so pandas can open the file
+    handle_lock: QReadWriteLock = QReadWriteLock(QReadWriteLock.Recursive)
+
+    @contextmanager
+    def store() -> Iterator[h5py.File]:
+        """Provides the shared h5py handle to the temp file, opening it
+        if needed. The handle isn't closed on exit, only flushed, so the
+        superblock and B-tree metadata are read once rather than on every
+        access. TempFile.manager must still be locked while it's in use,
+        h5py serialises calls so readers on other threads can share it."""
+        TempFile.handle_lock.lockForRead()
+        TempFile.handle_mutex.lock()
+        try:
+            if not TempFile.handle:
+                # never write to an opened file before it's copied
+                TempFile.handle = h5py.File(
+                    TempFile.path,
+                    'r+' if TempFile.is_working_copy() else 'r')
+            handle = TempFile.handle
+        except Exception:
+            TempFile.handle_lock.unlock()
+            raise
+        finally:
+            TempFile.handle_mutex.unlock()
+        try:
+            yield handle
+        finally:
+            handle.flush()
+            TempFile.handle_lock.unlock()
+
+    @contextmanager
+    def released() -> Iterator[str]:
+        """Provides the path of the temp file with the shared handle
+        closed, for pandas to read legacy frames without opening the file
+        twice. TempFile.manager must be locked for reading, readers using
+        the handle on other threads are waited for and the next call to
+        TempFile.store() reopens it."""
+        TempFile.handle_lock.lockForWrite()
+        try:
+            TempFile.release()
+            yield TempFile.path
+        finally:
+            TempFile.handle_lock.unlock()
+
+    def release() -> None:
+        """Closes the shared h5py handle. Must be called with the write
+        lock held before the temp file is copied or removed, it's
+        reopened by the next call to TempFile.store()."""
+        TempFile.handle_mutex.lock()
+        try:
+            if TempFile.handle:
+                TempFile.handle.close()
+            TempFile.handle = None
+        finally:
+            TempFile.handle_mutex.unlock()
 
     def check_existing() -> bool:
-        """Checks for an existing TempFile in case user wants to 
-        attempt recovery"""
+        """Checks for an existing journal, or TempFile left by an older
+        version, in case user wants to attempt recovery"""
+        # other OptiCORD temp files, such as an export's sheets, can't be
+        # recovered from
         existing_files = [filename for filename in os.listdir(
-            QDir.temp().absolutePath()) if filename.startswith("OptiCORD-")]
+            QDir.temp().absolutePath()) if filename.startswith("OptiCORD-")
+            and filename.endswith(('.tmp', Journal.EXTENSION))]
+        # copies of opened files are left unchanged, so never recovered
+        for filename in os.listdir(QDir.temp().absolutePath()):
+            if filename.startswith("OptiCORD-") and \
+                    filename.endswith('.copy'):
+                os.remove(QDir.temp().absoluteFilePath(filename))
+        journals = [filename for filename in existing_files
+                    if filename.endswith('.journal')]
+        if journals:
+            existing_files = journals
         if len(existing_files) > 1:
             # TODO raise error?
             log.error('Too many unexpected files')
         if existing_files:
             TempFile.recovery_path = QDir.temp().absoluteFilePath(
                 existing_files[0])
+        if journals and not Journal.entries(TempFile.recovery_path):
+            # nothing was changed since the last save
+            TempFile.discard_recovery()
 
-    def create_new() -> None:
-        """Creates a brand new temp file"""
-        TempFile.reset()
+    def discard_recovery() -> None:
+        """Deletes the recovery file and the temp file of a journal"""
+        for path in [TempFile.recovery_path,
+                     Journal.temp_path(TempFile.recovery_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+        TempFile.recovery_path = ''
+
+    def _create_working() -> None:
+        """Creates the empty temp file written to in place of the
+        opened file, and the journal path that goes with it"""
         f = QTemporaryFile(QDir.temp().absoluteFilePath(
             'OptiCORD-XXXXXX.tmp'))
         # open and close the temp file to ensure it gets a fileName
@@ -88,53 +228,829 @@ class TempFile:
         f.close()
         # auto remove = false so we can use file for recovery
         f.setAutoRemove(False)
-        TempFile.path = f.fileName()
+        TempFile.working_path = f.fileName()
+        Journal.path = Journal.journal_path(TempFile.working_path)
 
-    def create_from_existing(existing_path: str) -> None:
-        """Creates a temp file by copying an existing file"""
-        TempFile.reset()
-        log.debug('creating temp file from existing')
+    def is_working_copy() -> bool:
+        """Returns True once reads and writes go to the temp file"""
+        return TempFile.path != '' and \
+            TempFile.path == TempFile.working_path
+
+    def _start_copy() -> None:
+        """Starts copying the opened file in the background, so it's
+        ready to be written to without the GUI waiting on the copy"""
         f = QTemporaryFile(QDir.temp().absoluteFilePath(
-            'OptiCORD-XXXXXX.tmp'))
-        # open and close the temp file to ensure it gets a fileName
+            'OptiCORD-XXXXXX.copy'))
         f.open()
         f.close()
-        # auto remove = false so we can use file for recovery
         f.setAutoRemove(False)
+        TempFile.copy_path = f.fileName()
+        TempFile.copy_cancelled = False
+        TempFile.copying = TempFile.copier.submit(
+            TempFile._copy, TempFile.path, TempFile.copy_path)
+
+    def _copy(source_path: str, target_path: str) -> bool:
+        """Copies source_path to target_path a chunk at a time, returns
+        False if stopped by TempFile.copy_cancelled first"""
+        log.debug('Copying opened file for editing')
+        with open(source_path, 'rb') as source, \
+                open(target_path, 'wb') as target:
+            while not TempFile.copy_cancelled:
+                chunk = source.read(TempFile.COPY_CHUNK)
+                if not chunk:
+                    return True
+                target.write(chunk)
+        return False
+
+    def _stop_copy() -> None:
+        """Stops the copy of the opened file and removes it"""
+        if TempFile.copying is not None:
+            TempFile.copy_cancelled = True
+            TempFile.copying.exception()
+            TempFile.copying = None
+        if TempFile.copy_path != '' and os.path.exists(TempFile.copy_path):
+            os.remove(TempFile.copy_path)
+        TempFile.copy_path = ''
+
+    def detach() -> None:
+        """Switches from the opened file to the copy made of it as the
+        temp file, starting the journal. Called by each
+        FileManager.mark() so the copy is only written to once changed,
+        does nothing once the temp file is in use. Waits for the copy if
+        it's still being made. Any handle taken from TempFile.store()
+        before is closed."""
+        if TempFile.path == '' or TempFile.is_working_copy():
+            return
+        TempFile.release()
+        try:
+            copied = TempFile.copying is not None and \
+                TempFile.copying.result()
+        except OSError:
+            log.exception('Failed to copy opened file in background:\n')
+            copied = False
+        if not copied:
+            copyfile(TempFile.path, TempFile.copy_path)
+        TempFile.copying = None
+        TempFile._create_working()
+        os.replace(TempFile.copy_path, TempFile.working_path)
+        TempFile.copy_path = ''
+        base = TempFile.path
+        TempFile.path = TempFile.working_path
+        with TempFile.store() as store:
+            token = store.attrs.get('save_token', '')
+        Journal.start(base, token)
+
+    def create_new() -> None:
+        """Creates a brand new temp file"""
+        TempFile.reset()
+        TempFile._create_working()
+        TempFile.path = TempFile.working_path
+        Journal.start('', '')
+
+    def create_from_existing(existing_path: str) -> None:
+        """Opens an existing file, it's read in place until the first
+        write switches to a copy of it made in the background. Raises a
+        ValueError if the file was left part way through a save and can't
+        be rolled back, the file currently open is kept."""
+        if TempFile.incomplete(existing_path):
+            raise ValueError(f'{existing_path} was not completely saved')
+        TempFile.reset()
+        log.debug('opening existing file')
         TempFile.saved_path = existing_path
-        TempFile.path = f.fileName()
-        copyfile(existing_path, f.fileName())
+        TempFile.synced_path = existing_path
+        TempFile.path = existing_path
+        Catalog.load()
+        TempFile._start_copy()
+
+    def incomplete(filepath: str) -> bool:
+        """Returns True if filepath was left part way through a save, so
+        some of its groups may be missing or partly written. An
+        interrupted incremental save is rolled back first, so this is
+        only True if that fails. Only a full save over it repairs it."""
+        try:
+            RollbackFile.restore(filepath)
+        except OSError:
+            log.exception(f'Failed to roll back {filepath}:\n')
+        return os.path.exists(RollbackFile.journal_path(filepath))
 
     def recover() -> None:
-        """Opens the recovery file"""
+        """Opens the recovery file. A journal is replayed over the file
+        it was started from, falling back to the temp file it was kept
+        with if that fails."""
         log.debug('Opening recovered file')
-        TempFile.path = TempFile.recovery_path
-        # lock and unlock so that save changes warning appears
-        TempFile.manager.lockForWrite()
-        TempFile.manager.unlock()
+        TempFile.release()
+        if TempFile.recovery_path.endswith('.journal'):
+            Journal.path = TempFile.recovery_path
+            TempFile.working_path = Journal.temp_path(Journal.path)
+            try:
+                Journal.replay(TempFile.working_path)
+            except (OSError, ValueError, KeyError):
+                log.exception('Failed to replay journal, '
+                              'recovering the temp file instead:\n')
+        else:
+            # temp file left by a version without the journal
+            TempFile.working_path = TempFile.recovery_path
+        TempFile.path = TempFile.working_path
+        # what changed since the last save is unknown so the first save
+        # must be a full copy
+        TempFile.synced_path = ''
+        ResultCache.clear()
+        Catalog.load()
+        # so that save changes warning appears
+        TempFile.manager.changed = True
 
-    def save_to_location(filepath: str) -> None:
+    def save_to_location(filepath: str,
+                         progress: Callable[[int, int], None] = None) -> None:
         """Saves the temp file to a specified filepath, overwriting any
-        existing files in that path."""
+        existing files in that path. Only the groups changed since the
+        last save are written if the file at filepath is the one last
+        saved to, otherwise the whole temp file is copied. progress is
+        called with the bytes written so far and the total to write.
+        The write lock is only held while the save is set up, the data
+        is copied under a read lock so readers can carry on."""
         log.debug(f'Saving to location: {filepath}')
+        if not TempFile.is_working_copy():
+            # nothing has been written since the file was opened
+            if filepath != TempFile.path:
+                TempFile.manager.lockForRead()
+                try:
+                    TempFile._save_full(filepath, progress)
+                finally:
+                    TempFile.manager.unlock()
+            TempFile.saved_path = filepath
+            TempFile.synced_path = filepath
+            return
         TempFile.manager.lockForWrite()
-        copyfile(TempFile.path, filepath)
-        TempFile.manager.unlock()
+        try:
+            incremental = TempFile._can_save_incremental(filepath)
+            # tokens match only while the saved file and TempFile agree
+            token = uuid4().hex
+            with TempFile.store() as store:
+                store.attrs['save_token'] = token
+            # changes made from here on are left for the next save
+            paths = TempFile.manager.changed_paths
+            TempFile.manager.changed_paths = set()
+            TempFile.manager.changed = False
+        finally:
+            TempFile.manager.unlock()
+        TempFile.manager.lockForRead()
+        try:
+            if incremental:
+                incremental = TempFile._save_incremental(
+                    filepath, paths, token, progress)
+            if not incremental:
+                TempFile._save_full(filepath, progress)
+        except:
+            TempFile.manager.changed_paths |= paths
+            TempFile.manager.changed = True
+            raise
+        else:
+            # the saved file is the journal's new base, changes made
+            # since the save was set up stay in it
+            Journal.start(filepath, token)
+            Journal.record([(Journal.WRITE, path) for path in
+                            sorted(TempFile.manager.changed_paths)])
+        finally:
+            TempFile.manager.unlock()
         TempFile.saved_path = filepath
-        TempFile.manager.changed = False
+        TempFile.synced_path = filepath
+
+    def _can_save_incremental(filepath: str) -> bool:
+        """Returns True if filepath is still identical to the TempFile
+        as of the last save, apart from the changed paths"""
+        if filepath != TempFile.synced_path or \
+                not os.path.exists(filepath):
+            return False
+        # space freed by deleted groups isn't reused once a file is
+        # closed, a full copy stops the saved file growing indefinitely
+        if os.path.getsize(filepath) > 2*os.path.getsize(TempFile.path):
+            return False
+        # a previous save was interrupted and couldn't be rolled back
+        if TempFile.incomplete(filepath):
+            return False
+        try:
+            with h5py.File(filepath, 'r') as target, \
+                    TempFile.store() as store:
+                return target.attrs.get('id') == store.attrs.get('id') \
+                    and target.attrs.get('save_token') == \
+                    store.attrs.get('save_token')
+        except OSError:
+            return False
+
+    def _save_full(filepath: str,
+                   progress: Callable[[int, int], None] = None) -> None:
+        """Copies the whole temp file to filepath. The copy is made next
+        to filepath and then moved over it so a failed save never
+        leaves a partly written file behind."""
+        log.debug('Saving full copy')
+        total = os.path.getsize(TempFile.path)
+        done = 0
+        partial = f'{filepath}.saving'
+        with open(TempFile.path, 'rb') as source, \
+                open(partial, 'wb') as target:
+            while True:
+                chunk = source.read(TempFile.COPY_CHUNK)
+                if not chunk:
+                    break
+                target.write(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, total)
+        # the rollback of an interrupted save doesn't apply to the copy
+        rollback = RollbackFile.journal_path(filepath)
+        if os.path.exists(rollback):
+            os.remove(rollback)
+        os.replace(partial, filepath)
+
+    def _save_incremental(filepath: str, paths: set, token: str,
+                          progress: Callable[[int, int], None] = None
+                          ) -> bool:
+        """Replaces only the changed groups in filepath with their
+        versions from the temp file, or removes them if they no longer
+        exist. The bytes overwritten are kept in a rollback journal until
+        the save is committed, so filepath holds either its old or new
+        version even if the save is interrupted. Returns False without
+        writing anything if the rollback journal can't be made."""
+        try:
+            rollback = RollbackFile(filepath)
+        except OSError:
+            log.exception(f'Cannot save {filepath} incrementally:\n')
+            return False
+        log.debug(f'Saving {len(paths)} changed groups')
+        try:
+            with TempFile.store() as store, \
+                    h5py.File(rollback, 'r+') as target:
+                TempFile._copy_groups(store, target, paths, progress)
+                for key, val in store.attrs.items():
+                    target.attrs[key] = val
+                target.attrs['save_token'] = token
+        except:
+            rollback.rollback()
+            raise
+        rollback.commit()
+        return True
+
+    def _copy_groups(source: h5py.File, target: h5py.File, paths: set,
+                     progress: Callable[[int, int], None] = None) -> None:
+        """Replaces the groups at paths in target with their versions
+        from source, or removes them if they're not in source"""
+        # a changed group already includes everything under it
+        paths = sorted(p for p in paths if not any(
+            p.startswith(f'{q}/') for q in paths))
+        sizes = [TempFile._storage_size(source, p) for p in paths]
+        done = 0
+        for path, size in zip(paths, sizes):
+            if path in target:
+                del target[path]
+            if path in source:
+                parent, _, name = path.rpartition('/')
+                if parent:
+                    TempFile._require_group(source, target, parent)
+                source.copy(source[path], target[parent or '/'], name=name)
+            done += size
+            if progress is not None:
+                progress(done, sum(sizes))
+
+    def _storage_size(store: h5py.File, path: str) -> int:
+        """Returns the bytes stored by the datasets under path"""
+        if path not in store:
+            return 0
+        sizes = []
+        store[path].visititems(
+            lambda _, obj: sizes.append(obj.id.get_storage_size())
+            if isinstance(obj, h5py.Dataset) else None)
+        return sum(sizes)
+
+    def _require_group(source: h5py.File, target: h5py.File,
+                       path: str) -> None:
+        """Creates the group at path and any of its parents missing in
+        target, copying their attributes from source"""
+        parts = path.split('/')
+        for i in range(1, len(parts)+1):
+            group = '/'.join(parts[:i])
+            if group not in target:
+                target.create_group(group)
+                for key, val in source[group].attrs.items():
+                    target[group].attrs[key] = val
 
     def delete() -> None:
-        """Delete's the temp file (if it exists)"""
-        if TempFile.path != '':
-            os.remove(TempFile.path)
+        """Delete's the temp file and journal (if they exist)"""
+        TempFile.release()
+        TempFile._stop_copy()
+        # TempFile.path may be the opened file, so it's never removed
+        if os.path.exists(TempFile.working_path):
+            os.remove(TempFile.working_path)
+        Journal.delete()
 
     def reset() -> None:
         """Reset the TempFile as if it were brand new"""
+        TempFile.release()
+        TempFile._stop_copy()
         TempFile.saved_path = ''
         TempFile.recovery_path = ''
         TempFile.path = ''
+        TempFile.working_path = ''
+        Journal.path = ''
+        TempFile.synced_path = ''
         TempFile.manager = FileManager()
         TempFile.proc_manager = ProcessingManager()
+        Catalog.clear()
+        ResultCache.clear()
+
+
+class Journal:
+    """Record of the changes made since the file the TempFile was opened
+    from or last saved to, its base. Each writer's changes are recorded
+    in order as it releases the write lock. Only the changes are listed,
+    their data is never copied in: it's stored once, in the temp file
+    kept with the journal. After a crash the TempFile is rebuilt by
+    copying the base, moving and removing its groups as listed, then
+    taking just the groups written to from the temp file, so the data
+    that never changed doesn't rely on the temp file surviving intact.
+    Kept next to the TempFile and restarted on every save."""
+    path: str = ''
+    EXTENSION: str = '.journal'
+    # operations a change is recorded as, with the paths they apply to
+    WRITE: str = 'write'  # path, taken from the temp file
+    ATTRS: str = 'attrs'  # path, only its attributes are taken
+    MOVE: str = 'move'  # source, dest
+    REMOVE: str = 'remove'  # path
+
+    def journal_path(temp_path: str) -> str:
+        """Returns the path of the journal for the temp file"""
+        return f'{os.path.splitext(temp_path)[0]}{Journal.EXTENSION}'
+
+    def temp_path(journal_path: str) -> str:
+        """Returns the path of the temp file kept with the journal"""
+        return f'{os.path.splitext(journal_path)[0]}.tmp'
+
+    def start(base: str, token: str) -> None:
+        """Replaces the journal with an empty one over base, where token
+        is the save_token base was saved with"""
+        if Journal.path == '':
+            Journal.path = Journal.journal_path(TempFile.working_path)
+        try:
+            with h5py.File(Journal.path, 'w') as journal:
+                info = journal.create_group('journal')
+                info.attrs['base'] = base
+                info.attrs['base_token'] = token
+                info.attrs['changes'] = json.dumps([])
+        except OSError:
+            # an old journal fails to replay as its base has changed
+            log.exception(f'Failed to start journal over {base}:\n')
+
+    def record(changes: list) -> None:
+        """Records changes, a list of tuples (op, *paths) in the order
+        they were made, appending them to the changes listed in the
+        journal. A change to a group no longer in the TempFile is
+        recorded as its removal. Must be called with the TempFile locked
+        against writes. Failures are only logged so they never lose the
+        change being recorded."""
+        if Journal.path == '' or not changes:
+            return
+        try:
+            with TempFile.store() as store, \
+                    h5py.File(Journal.path, 'r+') as journal:
+                info = journal['journal']
+                recorded = json.loads(info.attrs['changes'])
+                for op, *paths in changes:
+                    if op != Journal.MOVE and paths[0] not in store:
+                        op = Journal.REMOVE
+                    recorded.append([op, *paths])
+                for key, val in store.attrs.items():
+                    journal.attrs[key] = val
+                info.attrs['changes'] = json.dumps(recorded)
+        except:
+            log.exception(f'Failed to journal {changes}:\n')
+
+    def entries(journal_path: str) -> list:
+        """Returns the changes recorded in a journal, an unreadable
+        journal is treated as having changes so it can still be
+        recovered from its temp file"""
+        try:
+            with h5py.File(journal_path, 'r') as journal:
+                return json.loads(journal['journal'].attrs['changes'])
+        except (OSError, KeyError, ValueError):
+            return [['']]
+
+    def replay(target_path: str) -> None:
+        """Rebuilds the TempFile at target_path from the journal's base
+        and its changes, with the groups written to taken from the temp
+        file already at target_path. Raises a ValueError if the base has
+        been saved over since the journal was started."""
+        log.debug(f'Replaying journal {Journal.path}')
+        rebuilt = f'{target_path}.replay'
+        with h5py.File(Journal.path, 'r') as journal:
+            info = journal['journal']
+            base = info.attrs['base']
+            if base:
+                # a save over the base was interrupted part way
+                if TempFile.incomplete(base):
+                    raise ValueError(f'{base} was not completely saved')
+                with h5py.File(base, 'r') as f:
+                    if f.attrs.get('save_token', '') != \
+                            info.attrs['base_token']:
+                        raise ValueError(f'{base} changed since journal')
+                copyfile(base, rebuilt)
+            with h5py.File(rebuilt, 'a') as target, \
+                    h5py.File(target_path, 'r') as source:
+                # paths taken from the temp file, where later moves left
+                # them
+                written, attrs = set(), set()
+                for op, *paths in json.loads(info.attrs['changes']):
+                    if op == Journal.MOVE:
+                        Journal._move(target, *paths)
+                        written = Journal._moved(written, *paths)
+                        attrs = Journal._moved(attrs, *paths)
+                    elif op == Journal.REMOVE:
+                        if paths[0] in target:
+                            del target[paths[0]]
+                    elif op == Journal.ATTRS:
+                        attrs.add(paths[0])
+                    else:
+                        written.add(paths[0])
+                TempFile._copy_groups(source, target, written)
+                for path in attrs:
+                    if path in source and path in target:
+                        target[path].attrs.clear()
+                        for key, val in source[path].attrs.items():
+                            target[path].attrs[key] = val
+                for key, val in journal.attrs.items():
+                    target.attrs[key] = val
+        os.replace(rebuilt, target_path)
+
+    def _move(target: h5py.File, source: str, dest: str) -> None:
+        """Moves the group at source in target to dest, replacing
+        whatever was there"""
+        if source not in target:
+            # written after the journal was started, so it's taken from
+            # the temp file instead
+            return
+        if dest in target:
+            del target[dest]
+        parent = dest.rpartition('/')[0]
+        target.require_group(parent or '/')
+        target.move(source, dest)
+
+    def _moved(paths: set, source: str, dest: str) -> set:
+        """Returns paths with those at or under source moved to dest"""
+        return {f'{dest}{path[len(source):]}' if path == source or
+                path.startswith(f'{source}/') else path for path in paths}
+
+    def delete() -> None:
+        """Deletes the journal (if it exists)"""
+        if Journal.path != '' and os.path.exists(Journal.path):
+            os.remove(Journal.path)
+
+
+class RollbackFile:
+    """A file written in place, for h5py's fileobj driver, that keeps the
+    original bytes of each page before it's first overwritten in a
+    rollback journal next to the file. The journal is synced to disk
+    before the page is written, so if the writing is interrupted the
+    file can always be restored to how it was. commit() makes the
+    changes permanent by syncing the file and removing the journal."""
+    EXTENSION: str = '.rollback'
+    PAGE: int = 4096  # bytes kept at a time
+    HEADER: struct.Struct = struct.Struct('<Q')  # size of the original
+    RECORD: struct.Struct = struct.Struct('<QI')  # offset, bytes kept
+    file: BinaryIO  # file being written
+    journal: BinaryIO  # rollback journal
+    size: int  # size of the file before it was written to
+    kept: set  # pages whose original bytes are in the journal
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self.file = open(filepath, 'r+b')
+        try:
+            self.size = os.fstat(self.file.fileno()).st_size
+            self.kept = set()
+            # never replaces a journal another write left to be restored
+            self.journal = open(RollbackFile.journal_path(filepath), 'xb')
+        except:
+            self.file.close()
+            raise
+        self.journal.write(RollbackFile.HEADER.pack(self.size))
+        RollbackFile._sync(self.journal)
+
+    def journal_path(filepath: str) -> str:
+        """Returns the path of the rollback journal for filepath"""
+        return f'{filepath}{RollbackFile.EXTENSION}'
+
+    def _sync(file: BinaryIO) -> None:
+        """Writes the contents of file through to the disk"""
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _keep(self, start: int, stop: int) -> None:
+        """Keeps the original bytes of the pages between the offsets
+        start and stop that aren't in the journal already"""
+        stop = min(stop, self.size)
+        if start >= stop:
+            return
+        pages = [page for page in range(start // RollbackFile.PAGE,
+                                        (stop-1) // RollbackFile.PAGE + 1)
+                 if page not in self.kept]
+        if not pages:
+            return
+        position = self.file.tell()
+        for page in pages:
+            offset = page * RollbackFile.PAGE
+            self.file.seek(offset)
+            data = self.file.read(min(RollbackFile.PAGE, self.size - offset))
+            self.journal.write(RollbackFile.RECORD.pack(offset, len(data)))
+            self.journal.write(data)
+            self.kept.add(page)
+        RollbackFile._sync(self.journal)
+        self.file.seek(position)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def readinto(self, buffer) -> int:
+        return self.file.readinto(buffer)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def write(self, data) -> int:
+        start = self.file.tell()
+        self._keep(start, start + memoryview(data).nbytes)
+        return self.file.write(data)
+
+    def truncate(self, size: int = None) -> int:
+        if size is None:
+            size = self.file.tell()
+        self._keep(size, self.size)
+        return self.file.truncate(size)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def commit(self) -> None:
+        """Makes the changes written permanent"""
+        RollbackFile._sync(self.file)
+        self.file.close()
+        self.journal.close()
+        os.remove(RollbackFile.journal_path(self.filepath))
+
+    def rollback(self) -> None:
+        """Undoes the changes written"""
+        self.file.close()
+        self.journal.close()
+        RollbackFile.restore(self.filepath)
+
+    def restore(filepath: str) -> None:
+        """Restores filepath from the rollback journal left by an
+        interrupted write, if there is one. The page being kept when it
+        was interrupted, if any, was never overwritten so it's ignored."""
+        path = RollbackFile.journal_path(filepath)
+        if not os.path.exists(path):
+            return
+        log.warning(f'Rolling back interrupted save of {filepath}')
+        with open(path, 'rb') as journal:
+            header = journal.read(RollbackFile.HEADER.size)
+            if len(header) == RollbackFile.HEADER.size:
+                size, = RollbackFile.HEADER.unpack(header)
+                with open(filepath, 'r+b') as file:
+                    while True:
+                        record = journal.read(RollbackFile.RECORD.size)
+                        if len(record) < RollbackFile.RECORD.size:
+                            break
+                        offset, length = RollbackFile.RECORD.unpack(record)
+                        data = journal.read(length)
+                        if len(data) < length:
+                            break
+                        file.seek(offset)
+                        file.write(data)
+                    file.truncate(size)
+                    RollbackFile._sync(file)
+        os.remove(path)
+
+
+class ProcessPool:
+    """Holds the pool of processes used for CPU bound work such as
+    parsing csv's, which gains nothing from threads as it holds the GIL.
+    The pool is only started the first time it's needed."""
+    executor: ProcessPoolExecutor = None
+    pending: set = set()  # futures submitted but not yet finished
+    # held while the executor is started, used or stopped
+    mutex: QMutex = QMutex()
+
+    def workers() -> int:
+        """Returns the number of processes the user has chosen for the
+        pool, defaulted to the number of cores"""
+        return int(QSettings().value('process_workers', os.cpu_count()))
+
+    def set_workers(workers: int) -> None:
+        """Sets the number of processes for the pool, the pool is
+        restarted when next needed for the change to take effect"""
+        QSettings().setValue('process_workers', workers)
+        ProcessPool.mutex.lock()
+        try:
+            if ProcessPool.executor is not None:
+                # let running work finish in the old pool
+                ProcessPool.executor.shutdown(wait=False)
+                ProcessPool.executor = None
+        finally:
+            ProcessPool.mutex.unlock()
+
+    def submit(fn: Callable, *args, **kwargs) -> Future:
+        """Submits fn to the process pool, starting it if not yet
+        running, and returns its future"""
+        ProcessPool.mutex.lock()
+        try:
+            if ProcessPool.executor is None:
+                # always spawn, as on windows, forked processes would
+                # inherit TempFile's open handle and hold its file lock
+                ProcessPool.executor = ProcessPoolExecutor(
+                    max_workers=ProcessPool.workers(),
+                    mp_context=multiprocessing.get_context('spawn'))
+            future = ProcessPool.executor.submit(fn, *args, **kwargs)
+            ProcessPool.pending.add(future)
+        finally:
+            ProcessPool.mutex.unlock()
+        future.add_done_callback(ProcessPool.pending.discard)
+        return future
+
+    def shutdown() -> None:
+        """Stops the process pool (if it's running), cancelling work
+        that hasn't started"""
+        ProcessPool.mutex.lock()
+        try:
+            if ProcessPool.executor is not None:
+                # shutdown only cancels futures itself from python 3.9
+                for future in list(ProcessPool.pending):
+                    future.cancel()
+                ProcessPool.executor.shutdown()
+                ProcessPool.executor = None
+        finally:
+            ProcessPool.mutex.unlock()
+
+
+class Catalog:
+    """In memory copy of the attributes of every group under positions
+    and comparisons in the TempFile, keyed by path. Loaded once when a
+    file is opened and kept up to date by the code that writes to the
+    file, so the UI can list positions, visualisations and comparisons
+    without touching the disk. Data held in pandas nodes and stored
+    frames isn't included.
+    Has its own lock so reads aren't held up by long file operations."""
+    entries: dict = dict()
+    lock: QReadWriteLock = QReadWriteLock()
+
+    def _read(store: h5py.File, path: str) -> None:
+        """Reads the attributes of the group at path and its subgroups
+        into entries. Must be called with Catalog.lock held for writing."""
+        group = store[path]
+        Catalog.entries[path] = dict(group.attrs)
+        for name, child in group.items():
+            # pandas nodes and stored frames are groups but hold data,
+            # not metadata
+            if isinstance(child, h5py.Group) and \
+                    'pandas_type' not in child.attrs and \
+                    'frame_layout' not in child.attrs:
+                Catalog._read(store, f'{path}/{name}')
+
+    def _drop(path: str) -> None:
+        """Removes path and everything under it from entries. Must be
+        called with Catalog.lock held for writing."""
+        for key in [k for k in Catalog.entries
+                    if k == path or k.startswith(f'{path}/')]:
+            del Catalog.entries[key]
+
+    def load() -> None:
+        """Loads the catalog from the TempFile"""
+        TempFile.manager.lockForRead()
+        Catalog.lock.lockForWrite()
+        Catalog.entries = dict()
+        with TempFile.store() as store:
+            for root in ['positions', 'comparisons']:
+                if root in store:
+                    Catalog._read(store, root)
+        Catalog.lock.unlock()
+        TempFile.manager.unlock()
+
+    def clear() -> None:
+        """Empties the catalog"""
+        Catalog.lock.lockForWrite()
+        Catalog.entries = dict()
+        Catalog.lock.unlock()
+
+    def update(store: h5py.File, path: str) -> None:
+        """Re-reads the group at path, its subgroups and any parent
+        groups missing from the catalog. Called by writers with the
+        TempFile's write lock still held."""
+        Catalog.lock.lockForWrite()
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            parent = '/'.join(parts[:i])
+            if parent not in Catalog.entries:
+                Catalog.entries[parent] = dict(store[parent].attrs)
+        Catalog._drop(path)
+        Catalog._read(store, path)
+        Catalog.lock.unlock()
+
+    def remove(path: str) -> None:
+        """Removes path and everything under it from the catalog"""
+        Catalog.lock.lockForWrite()
+        Catalog._drop(path)
+        Catalog.lock.unlock()
+
+    def exists(path: str) -> bool:
+        """Returns True if the group at path is in the catalog"""
+        Catalog.lock.lockForRead()
+        exists = path in Catalog.entries
+        Catalog.lock.unlock()
+        return exists
+
+    def attrs(path: str) -> dict:
+        """Returns a copy of the attributes of the group at path"""
+        Catalog.lock.lockForRead()
+        try:
+            return dict(Catalog.entries[path])
+        finally:
+            Catalog.lock.unlock()
+
+    def children(path: str) -> List[str]:
+        """Returns the names of the groups directly under path, in the
+        same order h5py would list them"""
+        Catalog.lock.lockForRead()
+        depth = path.count('/') + 1
+        children = [k.split('/')[-1] for k in Catalog.entries
+                    if k.startswith(f'{path}/') and k.count('/') == depth]
+        Catalog.lock.unlock()
+        return sorted(children)
+
+
+class ResultCache:
+    """Keeps the data of the latest comparisons in memory, so exporting
+    straight after comparing doesn't read it back from the TempFile.
+    Entries are keyed by (pre position, post position, visualisation,
+    periodicity) and the least recently used are dropped once their size
+    is over the budget the user has chosen. An entry is dropped as soon
+    as either of its positions' data is written to."""
+    entries: OrderedDict = OrderedDict()
+    sizes: dict = dict()
+    mutex: QMutex = QMutex()
+    DEFAULT_BUDGET = 512  # MB
+
+    def budget() -> int:
+        """Returns the most bytes the cache may hold"""
+        return int(QSettings().value(
+            'result_cache_budget', ResultCache.DEFAULT_BUDGET)) * 2**20
+
+    def put(key: tuple, entry: dict, size: int) -> None:
+        """Adds entry of size bytes at key, dropping the least recently
+        used entries until the cache is within budget. Entries bigger than
+        the whole budget aren't kept."""
+        budget = ResultCache.budget()
+        ResultCache.mutex.lock()
+        ResultCache.entries.pop(key, None)
+        ResultCache.sizes.pop(key, None)
+        if size <= budget:
+            ResultCache.entries[key] = entry
+            ResultCache.sizes[key] = size
+        while sum(ResultCache.sizes.values()) > budget:
+            oldest, _ = ResultCache.entries.popitem(last=False)
+            del ResultCache.sizes[oldest]
+        ResultCache.mutex.unlock()
+
+    def get(key: tuple) -> dict:
+        """Returns the entry at key, or None if it isn't cached"""
+        ResultCache.mutex.lock()
+        entry = ResultCache.entries.get(key)
+        if entry is not None:
+            ResultCache.entries.move_to_end(key)
+        ResultCache.mutex.unlock()
+        return entry
+
+    def discard(path: str) -> None:
+        """Drops the entries holding data from the group at path, or from
+        a group above or below it"""
+        def _overlaps(key: tuple) -> bool:
+            pre, post, vis, per = key
+            for data in [f'positions/{pre}/{vis}/{per}',
+                         f'positions/{post}/{vis}/{per}']:
+                if data == path or data.startswith(f'{path}/') or \
+                        path.startswith(f'{data}/'):
+                    return True
+            return False
+        ResultCache.mutex.lock()
+        for key in [k for k in ResultCache.entries if _overlaps(k)]:
+            del ResultCache.entries[key]
+            del ResultCache.sizes[key]
+        ResultCache.mutex.unlock()
+
+    def clear() -> None:
+        """Empties the cache"""
+        ResultCache.mutex.lock()
+        ResultCache.entries = OrderedDict()
+        ResultCache.sizes = dict()
+        ResultCache.mutex.unlock()
 
 
 class MetaDict(dict):
@@ -143,22 +1059,18 @@ class MetaDict(dict):
         - path: path to the visualisation within the TempFile"""
 
     def __init__(self, path) -> None:
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            i = store[path]
-            for key, val in i.attrs.items():
-                # if val is a string attempt to decode it assuming it's json
-                if type(val) is str:
-                    try:
-                        self[key] = json.loads(val)
-                    except ValueError:
-                        # json will raise a value error if string
-                        # couldn't be converted, in this case just use
-                        # its string value
-                        self[key] = val
-                else:
+        for key, val in Catalog.attrs(path).items():
+            # if val is a string attempt to decode it assuming it's json
+            if type(val) is str:
+                try:
+                    self[key] = json.loads(val)
+                except ValueError:
+                    # json will raise a value error if string
+                    # couldn't be converted, in this case just use
+                    # its string value
                     self[key] = val
-        TempFile.manager.unlock()
+            else:
+                self[key] = val
 
 
 class CharacterSet:
@@ -13,6 +13,12 @@ class InvalidVisualisation(Exception):
         self.full = full
         self.short = short
 
+    def __reduce__(self):
+        # exceptions are pickled using self.args, which only holds full,
+        # so both messages must be given for it to be raised across
+        # processes
+        return (self.__class__, (self.full, self.short))
+
 
 def validate_filepath(filepath: str) -> None:
     """Validates that the filepath is of expected CORD format"""
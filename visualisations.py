@@ -1,7 +1,10 @@
+import hashlib
+import io
+import itertools
 import json
 import os
 import re
-from typing import List
+from typing import List, Tuple
 import warnings
 from PyQt5 import QtCore
 from PyQt5.Qt import QSvgRenderer
@@ -12,7 +15,9 @@ from PyQt5.uic import loadUi
 import h5py
 import numpy as np
 import pandas as pd
-from util import DeleteConfirmation, TempFile, resource_path
+from blocks import ENCODING, BlockIndex, ParseEngine, read_block
+from frames import Dimensions, write_frames
+from util import Catalog, DeleteConfirmation, ProcessPool, TempFile, resource_path
 from validation import InvalidVisualisation, validate_date, validate_filepath, validate_meta, validate_unique
 import logging
 
@@ -104,21 +109,17 @@ class VisualisationList(QListView):
     def read_from_file(self) -> None:
         """Reads the visualisation names already stored in the 
         file and adds them to the visualisation list."""
-        # add visualisations from file to the list
-        TempFile.manager.lockForRead()
-        with h5py.File(TempFile.path, 'r+') as store:
-            i = store[f'positions/{self.position}']
-            for vis in i.keys():
-                self.existing.append(vis)
-                vis_item = VisualisationFile(vis)
-                vis_item.state = VisualisationFile.SUCCESS
-                self.model.appendRow(vis_item)
+        # add visualisations from the catalog to the list
+        for vis in Catalog.children(f'positions/{self.position}'):
+            self.existing.append(vis)
+            vis_item = VisualisationFile(vis)
+            vis_item.state = VisualisationFile.SUCCESS
+            self.model.appendRow(vis_item)
         # make sure visualisation list is shown/hidden
         if self.existing != []:
             self.show_in_tabs()
         else:
             self.hide_in_tabs()
-        TempFile.manager.unlock()
 
     @pyqtSlot(str)
     def add_to_existing(self, vis: str) -> None:
@@ -163,13 +164,18 @@ class VisualisationList(QListView):
                                         'and all of its data (including assosciated comparisons)?\n\nThis operation is irreversible.')
         if delete_dlg.exec():
             TempFile.manager.lockForWrite()
-            with h5py.File(TempFile.path, 'r+') as store:
-                del (store[f'positions/{self.position}/{item.text()}'])
-                for comp in store['comparisons'].keys():
-                    poss = comp.split(' vs ')
-                    if self.position in poss:
-                        if item.text() in store[f'comparisons/{comp}'].keys():
-                            del (store[f'comparisons/{comp}/{item.text()}'])
+            paths = [f'positions/{self.position}/{item.text()}']
+            for comp in Catalog.children('comparisons'):
+                poss = comp.split(' vs ')
+                if self.position in poss:
+                    if Catalog.exists(f'comparisons/{comp}/{item.text()}'):
+                        paths.append(f'comparisons/{comp}/{item.text()}')
+            for path in paths:
+                TempFile.manager.mark(path)
+            with TempFile.store() as store:
+                for path in paths:
+                    del (store[path])
+                    Catalog.remove(path)
             TempFile.manager.unlock()
             self.remove_existing(item.text())
             self.model.removeRow(self.currentIndex().row())
@@ -283,6 +289,12 @@ class VisualisationDeligate(QStyledItemDelegate):
 class VisualisationParser():
     """A parser to read a CORD visualisation csv into
     an OptiCORD python Visualisation"""
+    # parse modes
+    INDEXED = 0  # blocks are located by a BlockIndex then read directly
+    STREAMING = 1  # single pass, each periodicity is parsed as it ends
+    mode: int = INDEXED
+    # engine used to read the blocks of data, chosen per session
+    engine: int = ParseEngine.PANDAS
     filepath: str  # full filepath of visualisation file
     name: str  # visualisation name
     info: dict  # info dict used by various internal functions
@@ -312,24 +324,34 @@ class VisualisationParser():
         """Attempt to parse csv from filepath as an
         OptiCORD Visualisation. Returns a Visualisation."""
         log.debug(f'Parsing visualisation "{self.name}"')
-        # create info through a preliminary read
-        self._prelim_read()
-        # determine if file has been modified
-        self.info['modified'] = self._determine_modified()
-        # TODO clean up this print
+        if self.mode == self.STREAMING:
+            # meta and data are created while walking the file once
+            self._stream_read()
+        else:
+            # memory map the file to find where each part of it lies
+            with BlockIndex(self.filepath) as index:
+                # create info through a preliminary read
+                self._prelim_read(index)
+                # create the metadata dict
+                self._read_meta(io.StringIO(
+                    index.read(self.info['markers'][0]).decode(ENCODING)))
+                # create the data dict
+                self._create_data(index)
         if self.info['modified']:
-            print("File has been modified in excel")
-        # create the metadata dict
-        self._read_meta()
-        # create the data dict
-        self._create_data()
+            log.debug(f'{self.filepath} has been modified in excel')
 
-    def save(self) -> None:
+    def save(self, staged: bytes = None, digests: dict = None) -> None:
         """Saves the visualisation to the TempFile under a given 
-        position"""
+        position. If the data has already been compressed by stage() the
+        staged file image can be given to copy it in as is, along with
+        the digests() of the data."""
+        if digests is None:
+            digests = self.digests()
         # safely write to the file using TempFile's manager
         TempFile.manager.lockForWrite()
-        with h5py.File(TempFile.path, 'r+') as store:
+        TempFile.manager.mark(
+            f'positions/{self.vis_list.position}/{self.name}')
+        with TempFile.store() as store:
             iter_group = store[f'positions/{self.vis_list.position}']
             vis_store = iter_group.create_group(self.name)
             # save the metadata to attributes
@@ -338,52 +360,74 @@ class VisualisationParser():
                 if type(val) is dict:
                     val = json.dumps(val)
                 vis_store.attrs[key] = val
-        # save the visualisation data via pandas
-        for per in self.meta['Periodicities']:
-            # format='fixed' is a lot faster to read/write than 'table'
-            # but means that the data cannot be read in parallel.
-            # After testing with dask it took longer to read data in
-            # parallel anyway and 58M obs can be read/written and compared
-            # using pandas so there should be no need to run in parallel.
-            self.data[per].to_hdf(TempFile.path,
-                                  f'positions/{self.vis_list.position}/{self.name}/{per}',
-                                  mode='a', complib='blosc:zlib', complevel=9,
-                                  format='fixed')
-            # complibs were benchmarked using the lines below.
-            # blosc:zlib was chosen for its small file size
-            # and speedy execution.
-            # visualisation_compression_test.benchmark(
-            #   f'{self.name}_{per}', self.data[per])
+            if staged is not None:
+                # copy the compressed data across without decompressing
+                with h5py.File(io.BytesIO(staged), 'r') as stage:
+                    for per in self.meta['Periodicities']:
+                        stage.copy(stage[per], vis_store, name=per)
+                    stage.copy(stage[Dimensions.NAME], vis_store)
+            else:
+                # Each periodicity is stored in chunks of rows and dates so
+                # it can be read in parts, pandas' 'fixed' format can only
+                # be read whole and 'table' is a lot slower to read/write.
+                write_frames(vis_store, self.data)
+            # digests of the data so comparisons can skip unchanged data
+            digest_store = vis_store.create_group('digests')
+            for per, (frame, rows) in digests.items():
+                digest_store.attrs[per] = frame
+                digest_store.create_dataset(per, data=rows)
+            Catalog.update(
+                store, f'positions/{self.vis_list.position}/{self.name}')
         TempFile.manager.unlock()
 
-    def _determine_modified(self):
+    def digests(self) -> dict:
+        """Returns a digest of each periodicity's dataframe, with a
+        digest of each of its rows, as a dict of tuples (frame, rows).
+        A row's digest covers its dimensions and values, the frame's
+        covers its dates and each row in order."""
+        digests = dict()
+        for per in self.meta['Periodicities']:
+            df = self.data[per]
+            rows = pd.util.hash_pandas_object(df, index=True).to_numpy()
+            frame = hashlib.sha1(json.dumps(
+                [list(df.index.names), [str(c) for c in df.columns]]
+            ).encode())
+            frame.update(rows.tobytes())
+            digests[per] = (frame.hexdigest(), rows)
+        return digests
+
+    def stage(self) -> bytes:
+        """Compresses the visualisation data into an in memory hdf5 file
+        with the same layout used by save(), returns the file image so
+        it can be passed between processes."""
+        image = io.BytesIO()
+        with h5py.File(image, 'w') as stage:
+            write_frames(stage, self.data)
+        return image.getvalue()
+
+    def _determine_modified(self, head: List[str]) -> bool:
         """Determines whether or not a csv file has been opened and saved
-        in excel which changes the format from the default CORD format.
+        in excel which changes the format from the default CORD format,
+        given the first 3 lines of the file 'head'.
         Returns:
             True if file has been modified in excel
             False if file has not been modified"""
-        # read the csv into a single column
-        df = pd.read_csv(self.filepath, encoding='unicode_escape',
-                         header=None, names=[0], skip_blank_lines=False,
-                         dtype=str, nrows=3, delimiter='|')
         # by CORD definition one line of the first 3 should be blank
-        if not df.isnull().values.any():
-            return True
-        else:
-            return False
+        for line in head:
+            if line.rstrip('\r\n') == '':
+                return False
+        return True
 
     def _determine_periodicity(self) -> List[str]:
-        """Determines the periodicity of a marked row of dates, returns
+        """Determines the periodicity of each row of dates, returns
         a list of periodicities in the order they appear"""
         periods = []
-        # for each marked slice except first which is metadata
-        for start, _ in self.info['markers'][1:]:
-            # retrieve a date from the slice
-            date = pd.read_csv(self.filepath, encoding='unicode_escape',
-                               header=None, skiprows=start+1, nrows=1, dtype=str)\
-                .dropna(axis='columns').iloc[0].tolist()[0]
+        for dates in self.info['dates']:
+            if not dates:
+                raise InvalidVisualisation(f'{self.filepath} has a block '
+                                           'with no dates', 'File format error')
             # validate that the date is of known format then add to list
-            periods.append(validate_date(date))
+            periods.append(validate_date(dates[0]))
         return periods
 
     def _determine_name(self) -> tuple:
@@ -395,86 +439,51 @@ class VisualisationParser():
         else:
             return results.group(2)
 
-    def _retrieve_markers(self) -> List[tuple]:
-        """Find start and end indices that will later be used to slice
-        the visualisation into parts. Returns list of tuples containing
-        the start and end indices for each slice."""
-        df = self.info['prelim_df']
-        date = df.loc[df[0].str.contains(',Date', na=False)].index.tolist()
-        criteria = df.loc[df[0].str.contains(
-            'Criteria: ', na=False)].index.tolist()
-        markers = [(0, date[0]-1)]  # initialize markers with metadata
-        # create markers for each periodicity of data within csv
-        for i, d in enumerate(date):
-            # if its the last section dont expect a criteria marker
-            if d == date[-1]:
-                last = len(df.index)-1  # -1 because pandas counts from 0
-                # ensure we get the last line with data
-                while pd.isna(df.loc[last, 0]):
-                    last -= 1
-                markers.append((d, last))
-            # otherwise get end index from criteria marker
-            else:
-                # TODO check this doesn't include the criteria line in slice
-                # criteria[i+1] to get start of next periodicity as end marker
-                # -2 as last data line is 2 above criteria
-                markers.append((d, criteria[i+1]-2))
-        return markers
-
-    def _retrieve_dates(self) -> List[List[str]]:
-        """Process rows from prelim_df that contain dates into
+    def _split_line(self, line: str) -> List[str]:
+        """Split a raw line of the csv into a list of its non-empty
+        items with quotations removed."""
+        # strip newline and trailing commas then split by commas
+        items = line.rstrip('\r\n').rstrip(',').split(',')
+        # remove any quotations
+        items = [item.replace('"', '') for item in items]
+        # filter out any empty items
+        return list(filter(lambda item: item != '', items))
+
+    def _retrieve_dates(self, index: BlockIndex) -> List[List[str]]:
+        """Process the lines from the index that contain dates into
         a list of lists containing only the date values."""
-        master_list = []
-        # retrieve the lines containing dates using markers
-        for x, _ in self.info['markers'][1:]:
-            # strip trailing commas then split by commas
-            dates = self.info['prelim_df'].loc[x+1, 0].rstrip(',').split(',')
-            # remove any quotations
-            dates = [date.replace('"', '') for date in dates]
-            # filter out any empty items
-            dates = list(filter(lambda date: date != '', dates))
-            master_list.append(dates)  # add to master list
-        return master_list
-
-    def _retrieve_dimensions(self) -> List[str]:
-        """Read rows from prelim_df that contain the dimension headers 
-        and return a list of dimensions."""
-        # retrieve the lines containing dates using markers
-        for x, _ in self.info['markers'][1:]:
-            # strip trailing commas then split by commas
-            dimensions = self.info['prelim_df'].loc[x,
-                                                    0].rstrip(',').split(',')
-            # remove any quotations
-            dimensions = [dim.replace('"', '') for dim in dimensions]
-            # filter out any empty items
-            dimensions = list(filter(lambda dim: dim != '', dimensions))
+        return [self._split_line(block.dates) for block in index.blocks]
+
+    def _retrieve_dimensions(self, index: BlockIndex) -> List[str]:
+        """Read the lines from the index that contain the dimension
+        headers and return a list of dimensions."""
+        for block in index.blocks:
+            dimensions = self._split_line(block.header)
             # remove the Date
             dimensions.remove('Date')
         return dimensions
 
-    def _prelim_read(self) -> dict:
-        """Preliminarily read the csv file as a much smaller dataframe
-        to gather info for full read of dataframe."""
+    def _prelim_read(self, index: BlockIndex) -> None:
+        """Gather info for full read of dataframes from the BlockIndex
+        of the csv file."""
         # TODO add validation for structure of visualisation here
-        # read the input csv as a single column
         self.info = dict()
-        self.info['prelim_df'] = pd.read_csv(self.filepath,
-                                             encoding='unicode_escape', delimiter='|',
-                                             skip_blank_lines=False, header=None, dtype=str, names=[0])
-        # gather marker points where dataframe will be sliced
-        self.info['markers'] = self._retrieve_markers()
+        # determine if file has been modified
+        self.info['modified'] = self._determine_modified(index.head)
+        # byte ranges of the metadata followed by each block of data
+        self.info['markers'] = [index.meta] + \
+            [block.data for block in index.blocks]
         # get the dates for each slice as a list
-        self.info['dates'] = self._retrieve_dates()
-        self.meta['Dimensions'] = self._retrieve_dimensions()
+        self.info['dates'] = self._retrieve_dates(index)
+        self.meta['Dimensions'] = self._retrieve_dimensions(index)
         # get the periodicities in the order they appear
         self.meta['Periodicities'] = self._determine_periodicity()
 
-    def _read_meta(self):
-        """Read the metadata from the top of the visualisation file."""
-        _, end = self.info['markers'][0]
-        # read the csv into a single column
-        df = pd.read_csv(self.filepath, encoding='unicode_escape',
-                         header=None, nrows=end, skip_blank_lines=False,
+    def _read_meta(self, source) -> None:
+        """Read the metadata from the 'source' buffer holding the lines
+        at the top of the visualisation file."""
+        # read the lines into a single column
+        df = pd.read_csv(source, header=None, skip_blank_lines=False,
                          dtype=str, delimiter='|')
         meta_series = df[0].str.rstrip(',').replace('', np.nan)\
             .dropna().reset_index(drop=True)
@@ -503,21 +512,9 @@ class VisualisationParser():
         self.meta['Coverage Descriptors'] = coverage
         self.meta
 
-    def _convert_column_dates(self, per: str,
-                              columns: pd.Series) -> pd.Series:
-        """Convert a given series 'columns' to a datetime series based
-        on periodicity 'per'."""
-        if per == "A":
-            return pd.to_datetime(columns, format="%Y")
-        if per == "Q":
-            return pd.to_datetime(pd.PeriodIndex(
-                columns, freq='Q').to_timestamp())
-        if per == "M":
-            return pd.to_datetime(columns, format="%Y%b")
-
-    def _create_data(self) -> pd.DataFrame:
-        """Reads the visualisation in explicit slices to create self.data,
-        a dict of dataframes with their periods as the keys."""
+    def _create_data(self, index: BlockIndex) -> None:
+        """Reads the visualisation in explicit byte ranges to create
+        self.data, a dict of dataframes with their periods as the keys."""
         self.data = dict()  # init data dict
         # ignore data loss warnings if file has been modified
         if self.info['modified']:
@@ -527,35 +524,87 @@ class VisualisationParser():
                                   category=pd.errors.ParserWarning)
         # create a dataframe for each periodicity of data
         for i, per in enumerate(self.meta['Periodicities']):
-            # get start and end markers (skipping meta marker with +1)
-            start, end = self.info['markers'][i+1]
-            start += 2  # +2 to get where data starts
-            # create names
-            names = self.meta['Dimensions'] + self.info['dates'][i]
-            # create dtypes list
-            # without compression 'category' type for dimensions uses less
-            # memory, a compressed object however uses less memory than a
-            # compressed category
-            dtype_list = (['object']*len(self.meta['Dimensions'])) +\
-                (['float64']*len(self.info['dates'][i]))
-            # read the data slice
-            df = pd.read_csv(self.filepath,
-                             encoding='unicode_escape', header=None, skiprows=start,
-                             nrows=end-start+1, skip_blank_lines=False, index_col=False,
-                             names=names, dtype=dict(zip(names, dtype_list)),
-                             keep_default_na=False, na_values=['.', 'NULL', ''])
-            # forward fill the dimension columns
-            df[self.meta['Dimensions']] = df[self.meta['Dimensions']].ffill()
-            # set dimension columns as index
-            df.set_index(self.meta['Dimensions'], inplace=True)
-            # convert the columns to regular python datetime
-            df.columns = self._convert_column_dates(per, df.columns)
-            # store dataset in data dict under the key: periodicity
-            self.data[per] = df
+            # get byte range of data (skipping meta marker with +1)
+            data = index.read(self.info['markers'][i+1])
+            # read the data slice and store dataset in data dict under
+            # the key: periodicity
+            self.data[per] = read_block(
+                data.decode(ENCODING), per, self.meta['Dimensions'],
+                self.info['dates'][i], self.engine)
+            del data
         # stop ignoring any parser warnings
         warnings.simplefilter(action='default',
                               category=pd.errors.ParserWarning)
 
+    def _stream_read(self) -> None:
+        """Walks the csv file once, line by line, creating the metadata
+        as soon as the first block of data is found and a dataframe for
+        each periodicity as soon as its block ends. Only the lines of the
+        block currently being read are held in memory."""
+        self.info = dict()
+        self.data = dict()
+        # init so meta keeps the same order as a multi pass read
+        self.meta['Dimensions'] = []
+        self.meta['Periodicities'] = []
+        meta_lines = []  # lines above the first block
+        block = None  # [per, dates, lines] of the block being read
+        with open(self.filepath, encoding=ENCODING) as f:
+            # the first 3 lines tell if the file was modified, they're
+            # read before anything else as a block can start within them
+            head = list(itertools.islice(f, 3))
+            self.info['modified'] = self._determine_modified(head)
+            lines = itertools.chain(head, f)
+            for line in lines:
+                if ',Date' in line:
+                    if block is not None:
+                        self._stream_block(*block)
+                    else:
+                        # by CORD definition the line above the first
+                        # block header is the criteria line, not metadata
+                        self._read_meta(io.StringIO(''.join(meta_lines[:-1])))
+                    self.meta['Dimensions'] = self._split_line(line)
+                    self.meta['Dimensions'].remove('Date')
+                    # the dates are always on the line after the header
+                    dates = self._split_line(next(lines, ''))
+                    if not dates:
+                        raise InvalidVisualisation(
+                            f'{self.filepath} has no dates below the header '
+                            f'"{line.rstrip()}"', 'File format error')
+                    block = [validate_date(dates[0]), dates, []]
+                elif 'Criteria: ' in line and block is not None:
+                    # criteria marks the start of the next periodicity
+                    self._stream_block(*block)
+                    block = None
+                elif block is not None:
+                    block[2].append(line)
+                elif not self.meta['Periodicities']:
+                    meta_lines.append(line)
+        if block is not None:
+            self._stream_block(*block)
+        if not self.meta['Periodicities']:
+            raise InvalidVisualisation(f'No data blocks found in '
+                                       f'{self.filepath}', 'File format error')
+
+    def _stream_block(self, per: str, dates: List[str],
+                      lines: List[str]) -> None:
+        """Parses the lines of a single periodicity read by _stream_read
+        and stores the dataframe in self.data"""
+        # drop the blank lines between the data and the next marker
+        while lines and lines[-1].strip().rstrip(',') == '':
+            lines.pop()
+        with warnings.catch_warnings():
+            # ignore data loss warnings if file has been modified, we're
+            # not actually losing data, it's just the extra commas added
+            # in by excels saving format
+            if self.info['modified']:
+                warnings.simplefilter(action='ignore',
+                                      category=pd.errors.ParserWarning)
+            self.data[per] = read_block(
+                ''.join(lines), per, self.meta['Dimensions'], dates,
+                self.engine)
+        self.meta['Periodicities'].append(per)
+        lines.clear()  # free the raw lines as soon as they're parsed
+
 
 class VisualisationSignals(QObject):
     """Signals for VisualisationWorkers, must be in it's
@@ -566,8 +615,27 @@ class VisualisationSignals(QObject):
     finished = QtCore.pyqtSignal()
 
 
+def stage_visualisation(filepath: str, name: str, meta: dict,
+                        engine: int) -> Tuple[dict, bytes, dict]:
+    """Parses and compresses a visualisation ready to be saved, run in
+    the ProcessPool by VisualisationWorkers using the PROCESS backend.
+    Returns the completed metadata, the staged file image and the
+    digests of the data."""
+    parser = VisualisationParser(filepath, None)
+    parser.name = name
+    parser.meta = meta
+    # class attributes set in the GUI process aren't shared with children
+    parser.engine = engine
+    parser.parse()
+    return parser.meta, parser.stage(), parser.digests()
+
+
 class VisualisationWorker(QRunnable):
     """A QRunnable object to handle reading visualisation files"""
+    # backends
+    THREAD = 0  # parse and save within the thread
+    PROCESS = 1  # parse and compress in the ProcessPool, save in thread
+    backend: int = PROCESS
     item: VisualisationFile
     parser: VisualisationParser
 
@@ -615,8 +683,17 @@ class VisualisationWorker(QRunnable):
         """Attempts to read the csv as a visualisation"""
         self.item.state = VisualisationFile.LOADING
         try:
-            self.parser.parse()
-            self.parser.save()
+            if self.backend == self.PROCESS:
+                # the thread waits on the process, then writes the staged
+                # data so the TempFile only ever has one writer
+                meta, staged, digests = ProcessPool.submit(
+                    stage_visualisation, self.filepath, self.parser.name,
+                    self.parser.meta, self.parser.engine).result()
+                self.parser.meta = meta
+                self.parser.save(staged, digests)
+            else:
+                self.parser.parse()
+                self.parser.save()
             self.item.state = VisualisationFile.SUCCESS
         except InvalidVisualisation as e:
             self.signals.update_tooltip.emit(e.full)